@@ -1,6 +1,9 @@
 import streamlit as st
 import time
-from backend import main
+from backend import main, get_longitudinal_store
+from settings import warmup_on_start
+from warmup import start_warmup
+from structured_output import GEMMA_SCHEMA, MEDGEMMA_SCHEMA, parse_result
 
 # =====
 # 表示
@@ -17,6 +20,10 @@ text = st.text_area(
     (相談テキストを張り付けてください。)""",
     height=200
 )
+# 任意：クライアント・セッションを指定すると履歴に保存する
+col_client, col_session = st.columns(2)
+client_id = col_client.text_input("Client ID (optional / 任意)")
+session_id = col_session.text_input("Session ID (optional / 任意)")
 analyze_btn = st.button("Analyze")
 
 
@@ -51,7 +58,12 @@ if analyze_btn and text.strip():
         unsafe_allow_html=True
     )
     # 結果取得
-    medical_assistant_result, counselor_assistant_result, scores_data = main(text)
+    medical_assistant_result, counselor_assistant_result, scores_data, dedup_match = main(
+        text,
+        client_id=client_id.strip() or None,
+        session_id=session_id.strip() or None,
+        return_match=True
+    )
     # 結果表示
     status.markdown(
         loading("✓ Analyzing structured signals...", "#2f855a") + "<br><br>" +
@@ -60,6 +72,14 @@ if analyze_btn and text.strip():
         unsafe_allow_html=True
     )
     
+    # 類似した分析済みの会話（settings.dedup_mode が "flag" / "reuse" の場合）
+    if dedup_match and dedup_match["hit"]:
+        note = "LLM output reused from" if dedup_match["reused"] else "Near-duplicate of"
+        st.info(
+            f"{note} an earlier transcript ({dedup_match['doc_id']}, "
+            f"cosine {dedup_match['cosine']:.2f}, overlap {dedup_match['jaccard']:.2f})"
+        )
+
     st.subheader("Psychological Profile")
     st.caption("（MiniLM層）")
     st.caption("心理プロファイル")
@@ -87,11 +107,44 @@ if analyze_btn and text.strip():
     else:
         st.write("None data (該当なし)")
 
+    # 構造化出力（settings.structured_output）の場合は LLM の評価項目を並べて表示
+    gemma_fields = parse_result(counselor_assistant_result, GEMMA_SCHEMA)
+    medgemma_fields = parse_result(medical_assistant_result, MEDGEMMA_SCHEMA)
+
+    if gemma_fields:
+        st.markdown("### LLM Scores (Gemma, 0–2)")
+        score_keys = [k for k, v in GEMMA_SCHEMA["properties"].items() if "enum" in v]
+        for col, key in zip(st.columns(len(score_keys)), score_keys):
+            col.metric(GEMMA_SCHEMA["properties"][key]["title"], gemma_fields[key])
+
+    if medgemma_fields:
+        st.markdown("### Risk Levels (MedGemma)")
+        props = MEDGEMMA_SCHEMA["properties"]
+        flag_props = props["red_flags"]["properties"]
+        rows = [
+            {"Item": props[k]["title"], "Level": v}
+            for k, v in medgemma_fields.items() if "enum" in props[k]
+        ] + [
+            {"Item": f"Red flag: {flag_props[k]['title']}", "Level": v}
+            for k, v in medgemma_fields["red_flags"].items()
+        ]
+        st.table(rows)
+
+
+    if client_id.strip() and session_id.strip():
+        st.subheader("Signal History")
+        st.caption("セッション推移（禁止令・直近10セッション）")
+        history = get_longitudinal_store().label_history(client_id.strip(), "injunctions", last_n=10)
+        if history:
+            st.dataframe(history)
+
 
     st.subheader("Psychological Insights (Counselor Assistant)")
     st.caption("（Gemma層）")
     st.caption("心理学的な洞察")
-    if counselor_assistant_result:
+    if gemma_fields:
+        st.write(gemma_fields["summary"])
+    elif counselor_assistant_result:
         st.write(counselor_assistant_result)
     else:
         st.write("None data (該当なし)")
@@ -100,7 +153,16 @@ if analyze_btn and text.strip():
     st.subheader("Clinical Risk Assessment (Medical Assistant)")
     st.caption("（MedGemma層）")
     st.caption("臨床的リスクアセスメント")
-    if medical_assistant_result:
+    if medgemma_fields:
+        st.write(medgemma_fields["evidence"])
+    elif medical_assistant_result:
         st.write(medical_assistant_result)
     else:
-        st.write("None data (該当なし)")
\ No newline at end of file
+        st.write("None data (該当なし)")
+
+
+# =====
+# モデル先読み（UI描画後にバックグラウンドで実行）
+# =====
+if warmup_on_start:
+    start_warmup()
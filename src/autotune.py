@@ -0,0 +1,620 @@
+"""
+autotune
+マシンごとに MiniLM / Gemma の実行設定（スレッド数・バッチサイズ・dtype・量子化・配置）を自動で選ぶ
+
+1. RAM・コア数・CPU 命令セット・GPU を調べる
+2. 候補設定ごとに短いベンチマーク（MiniLM のエンコード、Gemma の prefill / decode）を実行する
+3. メモリに収まる（安全な）設定のうち最速のものをマシンプロファイル（JSON）に保存する
+
+text_analyzer.load_minilm と gemmas_engine.make_model は起動時にプロファイルを読み込む。
+torch のスレッド数はプロセス全体の設定のため、apply_thread_config で起動時に1回だけ設定する。
+プロファイルがない、またはハードウェアが一致しない場合は従来の既定値を使う。
+
+Usage:
+    python autotune.py probe
+    python autotune.py run
+    python autotune.py run --skip-gemma
+    python autotune.py show
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import threading
+import time
+from datetime import datetime, timezone
+import psutil
+from settings import mnilm_url, gemma_url, use_machine_profile, machine_profile_path
+
+# 2: ベンチマーク用の文を修正（1 のプロファイルは1文字の文で計測されているため読み込まない）
+PROFILE_VERSION = 2
+
+# 既定値（プロファイルがない場合。従来のハードコード値）
+DEFAULT_MINILM = {
+    "device": "cpu",
+    "threads": None,
+    "batch_size": 32
+}
+DEFAULT_GEMMA = {
+    "device_map": "auto",
+    "max_memory": {0: "5.5GiB", "cpu": "16GiB"},
+    "dtype": "bfloat16",
+    "quantization": None,
+    "threads": None
+}
+
+# ベンチマーク設定
+MINILM_BATCH_SIZES = [16, 32, 64, 128]
+MINILM_SENTENCES = 256
+GEMMA_PREFILL_TOKENS = 128
+GEMMA_DECODE_TOKENS = 16
+
+# 設定の比較に使う典型的な1回の推論（プロンプト長・生成トークン数）
+TYPICAL_PROMPT_TOKENS = 800
+TYPICAL_NEW_TOKENS = 500
+
+# 安全とみなすメモリ使用率（重み推定値 / 利用可能メモリ）
+SAFE_MEMORY_FRACTION = 0.8
+
+# dtype ごとの1要素あたりのバイト数（量子化は重みのみ）
+DTYPE_BYTES = {"float32": 4, "bfloat16": 2, "float16": 2}
+QUANT_BYTES = {"int8": 1, "int4": 0.5}
+
+_profile = None
+_profile_loaded = False
+
+
+# =====
+# ハードウェア調査
+# =====
+def _cpu_info():
+    model_name, flags = platform.processor() or platform.machine(), set()
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                key = key.strip()
+                if key == "model name":
+                    model_name = value.strip()
+                elif key == "flags":
+                    flags = set(value.split())
+                if flags and model_name:
+                    break
+    except OSError:
+        pass
+    return model_name, flags
+
+
+def probe_hardware():
+    """
+    RAM・コア数・CPU 命令セット・GPU を調べる
+
+    :return: ハードウェア情報の辞書（fingerprint を含む）
+    """
+    model_name, flags = _cpu_info()
+    memory = psutil.virtual_memory()
+    physical = psutil.cpu_count(logical=False) or os.cpu_count() or 1
+    logical = psutil.cpu_count(logical=True) or physical
+
+    # コンテナ等で使えるコアが制限されている場合
+    try:
+        usable = len(os.sched_getaffinity(0))
+    except AttributeError:
+        usable = logical
+
+    hw = {
+        "hostname": platform.node(),
+        "cpu_model": model_name,
+        "physical_cores": min(physical, usable),
+        "logical_cores": min(logical, usable),
+        "ram_total_gb": round(memory.total / 2**30, 1),
+        "ram_available_gb": round(memory.available / 2**30, 1),
+        "cpu_flags": sorted(flags & {"avx2", "avx512f", "avx512_bf16", "avx512_vnni", "amx_bf16", "amx_int8", "fma"}),
+        "accelerators": [],
+        "torch": None,
+        "bitsandbytes": False
+    }
+
+    try:
+        import torch
+        hw["torch"] = torch.__version__
+        if torch.cuda.is_available():
+            for i in range(torch.cuda.device_count()):
+                free, total = torch.cuda.mem_get_info(i)
+                hw["accelerators"].append({
+                    "type": "cuda",
+                    "index": i,
+                    "name": torch.cuda.get_device_name(i),
+                    "memory_total_gb": round(total / 2**30, 1),
+                    "memory_free_gb": round(free / 2**30, 1),
+                    "bf16": torch.cuda.is_bf16_supported()
+                })
+        elif getattr(torch.backends, "mps", None) and torch.backends.mps.is_available():
+            hw["accelerators"].append({"type": "mps", "index": 0, "name": "mps"})
+    except ImportError:
+        pass
+
+    try:
+        import bitsandbytes # noqa: F401
+        hw["bitsandbytes"] = True
+    except Exception:
+        pass
+
+    hw["fingerprint"] = hardware_fingerprint(hw)
+    return hw
+
+
+def hardware_fingerprint(hw):
+    """
+    プロファイルが同じ構成のマシンで作られたかを判定するためのハッシュ
+    （空きメモリなど変動する値は含めない）
+    """
+    key = {
+        "cpu_model": hw["cpu_model"],
+        "physical_cores": hw["physical_cores"],
+        "logical_cores": hw["logical_cores"],
+        "ram_total_gb": round(hw["ram_total_gb"]),
+        "accelerators": [(a["type"], a["name"]) for a in hw["accelerators"]]
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def thread_candidates(hw):
+    """
+    試すスレッド数（1・物理コアの半分・物理コア数・論理コア数）
+    """
+    physical, logical = hw["physical_cores"], hw["logical_cores"]
+    return sorted({1, max(1, physical // 2), physical, logical})
+
+
+def cpu_bf16_native(hw):
+    return bool({"avx512_bf16", "amx_bf16"} & set(hw["cpu_flags"]))
+
+
+def weight_bytes(url):
+    """
+    保存済みの重みファイルの合計サイズ（bfloat16 保存を想定）
+    """
+    total = 0
+    for root, _, files in os.walk(url):
+        for name in files:
+            if name.endswith((".safetensors", ".bin", ".pt")):
+                total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def estimate_gemma_bytes(url, dtype, quantization=None):
+    """
+    設定ごとの重みのメモリ使用量の推定値
+    """
+    per_param = QUANT_BYTES[quantization] if quantization else DTYPE_BYTES[dtype]
+    return int(weight_bytes(url) * per_param / 2)
+
+
+# =====
+# MiniLM
+# =====
+def _sample_sentences(n=MINILM_SENTENCES):
+    """
+    ベンチマーク用の文（参照DBの英語の定義文を繰り返して使用）
+    """
+    from taxonomy import definition_texts
+
+    pool = definition_texts("en")
+    return [pool[i % len(pool)] for i in range(n)]
+
+
+def _timed(fn, repeat=2):
+    """
+    1回目（ウォームアップ）を除いた最速の実行時間
+    """
+    fn()
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def tune_minilm(hw, url=mnilm_url, sentences=None):
+    """
+    MiniLM のデバイス・スレッド数・バッチサイズを計測して選ぶ
+
+    :return: (最速の設定, 全試行のリスト)
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    sentences = sentences or _sample_sentences()
+    devices = ["cpu"] + [f"cuda:{a['index']}" for a in hw["accelerators"] if a["type"] == "cuda"]
+    default_threads = torch.get_num_threads()
+
+    trials = []
+    for device in devices:
+        model = SentenceTransformer(url, local_files_only=True, device=device)
+        # GPU ではスレッド数の影響が小さいため既定値のみ
+        threads_list = thread_candidates(hw) if device == "cpu" else [None]
+
+        for threads in threads_list:
+            torch.set_num_threads(threads or default_threads)
+            for batch_size in MINILM_BATCH_SIZES:
+                trial = {"device": device, "threads": threads, "batch_size": batch_size}
+                try:
+                    seconds = _timed(lambda: model.encode(sentences, batch_size=batch_size))
+                    trial["sentences_per_sec"] = len(sentences) / seconds
+                    trial["ok"] = True
+                except Exception as e:
+                    trial["ok"] = False
+                    trial["error"] = repr(e)
+                trials.append(trial)
+
+        del model
+        if device.startswith("cuda"):
+            torch.cuda.empty_cache()
+
+    torch.set_num_threads(default_threads)
+
+    ok = [t for t in trials if t["ok"]]
+    if not ok:
+        return dict(DEFAULT_MINILM), trials
+
+    best = max(ok, key=lambda t: t["sentences_per_sec"])
+    return {
+        "device": best["device"],
+        "threads": best["threads"],
+        "batch_size": best["batch_size"],
+        "sentences_per_sec": best["sentences_per_sec"]
+    }, trials
+
+
+# =====
+# Gemma
+# =====
+def gemma_candidates(hw, url=gemma_url):
+    """
+    Gemma の候補設定（配置・dtype・量子化・スレッド数）と安全性の判定
+
+    :return: 候補設定のリスト（"safe" と "estimated_gb" を含む）
+    """
+    ram_gb = hw["ram_available_gb"]
+    candidates = []
+
+    # CPU のみ（bfloat16 は対応命令がなくても動くため両方試す）
+    for dtype in ["bfloat16", "float32"]:
+        for threads in sorted({hw["physical_cores"], hw["logical_cores"]}):
+            candidates.append({
+                "device_map": "cpu",
+                "max_memory": None,
+                "dtype": dtype,
+                "quantization": None,
+                "threads": threads,
+                "budget_gb": ram_gb * SAFE_MEMORY_FRACTION
+            })
+
+    # GPU（空き容量の範囲で配置し、溢れた分は CPU に置く）
+    for acc in hw["accelerators"]:
+        if acc["type"] != "cuda":
+            continue
+
+        gpu_gb = acc["memory_free_gb"] * SAFE_MEMORY_FRACTION
+        cpu_gb = ram_gb * SAFE_MEMORY_FRACTION
+        dtype = "bfloat16" if acc["bf16"] else "float16"
+        quantizations = [None] + (["int8", "int4"] if hw["bitsandbytes"] else [])
+
+        for quantization in quantizations:
+            candidates.append({
+                "device_map": "auto",
+                "max_memory": {acc["index"]: f"{gpu_gb:.1f}GiB", "cpu": f"{cpu_gb:.0f}GiB"},
+                "dtype": dtype,
+                "quantization": quantization,
+                "threads": None,
+                "budget_gb": gpu_gb + cpu_gb
+            })
+
+    for cand in candidates:
+        cand["estimated_gb"] = round(estimate_gemma_bytes(url, cand["dtype"], cand["quantization"]) / 2**30, 2)
+        cand["safe"] = cand["estimated_gb"] <= cand.pop("budget_gb")
+
+    return candidates
+
+
+def gemma_model_kwargs(config):
+    """
+    from_pretrained に渡す配置・dtype・量子化の引数
+
+    :param config: gemma_load_config() の結果
+    """
+    import torch
+
+    kwargs = {
+        "device_map": config["device_map"],
+        "torch_dtype": getattr(torch, config["dtype"])
+    }
+    if config["device_map"] == "auto" and config["max_memory"]:
+        kwargs["max_memory"] = config["max_memory"]
+
+    if config["quantization"]:
+        from transformers import BitsAndBytesConfig
+
+        if config["quantization"] == "int8":
+            kwargs["quantization_config"] = BitsAndBytesConfig(load_in_8bit=True)
+        else:
+            kwargs["quantization_config"] = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_compute_dtype=kwargs["torch_dtype"]
+            )
+    return kwargs
+
+
+def benchmark_gemma(config, url=gemma_url):
+    """
+    1つの設定で Gemma を読み込み、prefill / decode の速度を計測する
+
+    :return: 計測結果の辞書
+    """
+    import gc
+    import torch
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+
+    apply_threads(config["threads"])
+    process = psutil.Process()
+    rss_before = process.memory_info().rss
+
+    start = time.perf_counter()
+    model = AutoModelForCausalLM.from_pretrained(
+        url,
+        **gemma_model_kwargs(config),
+        low_cpu_mem_usage=True,
+        attn_implementation="sdpa",
+        local_files_only=True
+    )
+    tokenizer = AutoTokenizer.from_pretrained(url, local_files_only=True)
+    load_seconds = time.perf_counter() - start
+
+    # 固定長の入力（参照DBの文を繰り返してトークン数を揃える）
+    text = " ".join(_sample_sentences(64))
+    input_ids = tokenizer(text, return_tensors="pt")["input_ids"][:, :GEMMA_PREFILL_TOKENS].to(model.device)
+    attention_mask = torch.ones_like(input_ids)
+
+    with torch.no_grad():
+        prefill = _timed(lambda: model(input_ids=input_ids, attention_mask=attention_mask), repeat=1)
+        generate = _timed(lambda: model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            max_new_tokens=GEMMA_DECODE_TOKENS,
+            min_new_tokens=GEMMA_DECODE_TOKENS,
+            do_sample=False,
+            pad_token_id=tokenizer.eos_token_id
+        ), repeat=1)
+
+    result = {
+        "load_seconds": load_seconds,
+        "prefill_tokens_per_sec": input_ids.shape[-1] / prefill,
+        # 生成時間から prefill 分を除いたものを decode とする
+        "decode_tokens_per_sec": GEMMA_DECODE_TOKENS / max(generate - prefill, 1e-6),
+        "rss_delta_gb": round((process.memory_info().rss - rss_before) / 2**30, 2)
+    }
+    if torch.cuda.is_available():
+        result["cuda_peak_gb"] = round(torch.cuda.max_memory_allocated() / 2**30, 2)
+
+    del model
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats()
+
+    # 典型的な1回の推論時間の推定値（設定の比較に使用）
+    result["estimated_request_seconds"] = (
+        TYPICAL_PROMPT_TOKENS / result["prefill_tokens_per_sec"]
+        + TYPICAL_NEW_TOKENS / result["decode_tokens_per_sec"]
+    )
+    return result
+
+
+def tune_gemma(hw, url=gemma_url):
+    """
+    安全な候補設定をすべて計測し、推定推論時間が最短の設定を選ぶ
+    （メモリ不足などで失敗した設定は除外）
+
+    :return: (最速の設定, 全試行のリスト)
+    """
+    trials = []
+    for cand in gemma_candidates(hw, url):
+        trial = dict(cand)
+        if not cand["safe"]:
+            trial["ok"] = False
+            trial["error"] = "estimated weights exceed the memory budget"
+        else:
+            try:
+                trial.update(benchmark_gemma(cand, url))
+                trial["ok"] = True
+            except Exception as e:
+                trial["ok"] = False
+                trial["error"] = repr(e)
+        trials.append(trial)
+
+    ok = [t for t in trials if t["ok"]]
+    if not ok:
+        return dict(DEFAULT_GEMMA), trials
+
+    best = min(ok, key=lambda t: t["estimated_request_seconds"])
+    config = {k: best[k] for k in DEFAULT_GEMMA}
+    config["prefill_tokens_per_sec"] = best["prefill_tokens_per_sec"]
+    config["decode_tokens_per_sec"] = best["decode_tokens_per_sec"]
+    return config, trials
+
+
+# =====
+# プロファイル
+# =====
+def run_autotune(skip_minilm=False, skip_gemma=False, path=machine_profile_path):
+    """
+    ハードウェア調査とベンチマークを実行し、マシンプロファイルを保存する
+
+    :return: プロファイル
+    """
+    hw = probe_hardware()
+    profile = {
+        "version": PROFILE_VERSION,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "hardware": hw,
+        "trials": {}
+    }
+
+    if not skip_minilm:
+        profile["minilm"], profile["trials"]["minilm"] = tune_minilm(hw)
+    if not skip_gemma:
+        profile["gemma"], profile["trials"]["gemma"] = tune_gemma(hw)
+
+    save_machine_profile(profile, path)
+    return profile
+
+
+def profile_path(path=machine_profile_path):
+    """
+    プロファイルのパス（"{hostname}" はこのマシンのホスト名に置き換える。
+    共有ディレクトリでノードごとにファイルを分ける場合に使用）
+    """
+    return path.replace("{hostname}", platform.node())
+
+
+def save_machine_profile(profile, path=machine_profile_path):
+    """
+    プロファイルを保存する（一時ファイルに書いてから置き換え）
+    """
+    global _profile, _profile_loaded
+
+    path = profile_path(path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(profile, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+    _profile, _profile_loaded = None, False
+
+
+def _restore_max_memory(max_memory):
+    # JSON ではキーが文字列になるため GPU 番号を int に戻す
+    if not max_memory:
+        return max_memory
+    return {int(k) if str(k).isdigit() else k: v for k, v in max_memory.items()}
+
+
+def load_machine_profile(path=machine_profile_path):
+    """
+    このマシンのプロファイルを読み込む（プロセス内で1回のみ）。
+    ファイルがない、壊れている、または別構成のマシンで作られた場合は None
+
+    :return: プロファイル or None
+    """
+    global _profile, _profile_loaded
+
+    if _profile_loaded:
+        return _profile
+    _profile_loaded = True
+
+    path = profile_path(path)
+    if not use_machine_profile or not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, encoding="utf-8") as f:
+            profile = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if profile.get("version") != PROFILE_VERSION:
+        return None
+    # 共有ディレクトリに別ノードのプロファイルが置かれている場合は使わない
+    if profile["hardware"]["fingerprint"] != probe_hardware()["fingerprint"]:
+        return None
+
+    if "gemma" in profile:
+        profile["gemma"]["max_memory"] = _restore_max_memory(profile["gemma"]["max_memory"])
+    _profile = profile
+    return _profile
+
+
+def minilm_config():
+    """
+    MiniLM の実行設定（プロファイルがなければ既定値）
+    """
+    profile = load_machine_profile() or {}
+    return {**DEFAULT_MINILM, **{k: v for k, v in profile.get("minilm", {}).items() if k in DEFAULT_MINILM}}
+
+
+def gemma_load_config():
+    """
+    Gemma / MedGemma の読み込み設定（プロファイルがなければ既定値）
+    """
+    profile = load_machine_profile() or {}
+    return {**DEFAULT_GEMMA, **{k: v for k, v in profile.get("gemma", {}).items() if k in DEFAULT_GEMMA}}
+
+
+def apply_threads(threads):
+    """
+    torch のスレッド数を設定する（None の場合は変更しない）
+    """
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
+
+
+_threads_applied = False
+_threads_lock = threading.Lock()
+
+
+def apply_thread_config():
+    """
+    プロファイルのスレッド数をプロセスに1回だけ設定する（起動時の先読み・バッチのワーカーごと）
+
+    torch のスレッド数はプロセス全体の設定のため、リクエストごとには変更しない。
+    生成が処理時間の大半を占めるため Gemma の設定を優先し、なければ MiniLM の設定を使う。
+    """
+    global _threads_applied
+
+    with _threads_lock:
+        if _threads_applied:
+            return
+        _threads_applied = True
+        apply_threads(gemma_load_config()["threads"] or minilm_config()["threads"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MILD-7 hardware auto-tuner")
+    parser.add_argument("--profile", default=machine_profile_path)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    sub.add_parser("probe", help="print detected hardware")
+    run = sub.add_parser("run", help="benchmark candidate settings and write the machine profile")
+    run.add_argument("--skip-minilm", action="store_true")
+    run.add_argument("--skip-gemma", action="store_true")
+    sub.add_parser("show", help="print the settings the pipeline will use on this machine")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "probe":
+        hw = probe_hardware()
+        hw["thread_candidates"] = thread_candidates(hw)
+        hw["cpu_bf16_native"] = cpu_bf16_native(hw)
+        print(json.dumps(hw, indent=2))
+
+    elif args.command == "run":
+        profile = run_autotune(args.skip_minilm, args.skip_gemma, args.profile)
+        print(json.dumps({k: profile.get(k) for k in ["hardware", "minilm", "gemma"]}, indent=2, default=str))
+        print(f"# written to {profile_path(args.profile)}")
+
+    elif args.command == "show":
+        profile = load_machine_profile(args.profile)
+        print(json.dumps({
+            "profile": profile_path(args.profile) if profile else None,
+            "minilm": minilm_config(),
+            "gemma": gemma_load_config()
+        }, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
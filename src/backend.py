@@ -1,9 +1,143 @@
+import hashlib
+import threading
+import time
+from contextlib import contextmanager
 from text_analyzer import text_analyzer, build_medgemma_payload
 from gemmas_engine import madgemma_engine, gemma_engine
 from front_score_totalling import front_score_totalling
+from settings import llm_gating, dedup_mode, evidence_index_enabled, parquet_export_enabled
 
 
-def main(text):
+# 各ストアの初回作成を1回に限定する（同時実行時の二重作成防止）
+_singleton_lock = threading.Lock()
+
+# 段階ごとの処理時間の通知先 listener(stage, seconds)（loadtest などが登録する）
+stage_listeners = []
+
+
+@contextmanager
+def timed_stage(stage):
+    """
+    処理段階の時間を計測し、stage_listeners に通知する
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        for listener in list(stage_listeners):
+            listener(stage, elapsed)
+
+
+_longitudinal_store = None
+
+
+def get_longitudinal_store():
+    """
+    セッション履歴ストアを取得する（初回のみ作成）
+    """
+    global _longitudinal_store
+
+    with _singleton_lock:
+        if _longitudinal_store is None:
+            from longitudinal_store import LongitudinalStore
+            _longitudinal_store = LongitudinalStore()
+    return _longitudinal_store
+
+
+_dedup_index = None
+
+
+def get_dedup_index():
+    """
+    類似文書インデックスを取得する（初回のみ作成）
+    """
+    global _dedup_index
+
+    with _singleton_lock:
+        if _dedup_index is None:
+            from dedup_index import DedupIndex
+            _dedup_index = DedupIndex()
+    return _dedup_index
+
+
+_evidence_index = None
+_parquet_exporter = None
+
+
+def get_evidence_index():
+    """
+    全文検索インデックスを取得する（初回のみ作成）
+    """
+    global _evidence_index
+
+    with _singleton_lock:
+        if _evidence_index is None:
+            from evidence_index import EvidenceIndex
+            _evidence_index = EvidenceIndex()
+    return _evidence_index
+
+
+def get_parquet_exporter():
+    """
+    Parquet 書き出しを取得する（初回のみ作成、書き込みはバックグラウンド）
+    """
+    global _parquet_exporter
+
+    with _singleton_lock:
+        if _parquet_exporter is None:
+            from parquet_export import ParquetExporter
+            _parquet_exporter = ParquetExporter()
+    return _parquet_exporter
+
+
+def run_minilm_stage(text):
+    """
+    MiniLM 層（前処理・シグナル抽出）
+
+    :return: (gemma_prompt, payload, expand_payload, analysis)
+    """
+    return text_analyzer(text, return_analysis=True)
+
+
+def run_llm_stage(text, gemma_prompt, expand_payload, plan=None):
+    """
+    LLM 層（Gemma / MedGemma 推論）
+
+    :param plan: llm_scheduler の実行計画（None の場合は Gemma → MedGemma を全長で実行）
+    :return: (medgemma_result, gemma_result)
+    """
+    order = plan["order"] if plan else ["gemma", "medgemma"]
+    max_new_tokens = plan["max_new_tokens"] if plan else {"gemma": 1000, "medgemma": 1000}
+
+    results = {}
+    for engine in order:
+        if engine == "gemma":
+            # Gemma: psychological reasoning (structured interpretation)
+            # Gemma推論
+            results["gemma"] = gemma_engine(gemma_prompt, max_new_tokens["gemma"])
+        else:
+            # MedGemma: contextual clinical-style interpretation
+            # MedGemma推論
+            medgemma_prompt = build_medgemma_payload(text, expand_payload)
+            results["medgemma"] = madgemma_engine(medgemma_prompt, max_new_tokens["medgemma"])
+
+    return results["medgemma"], results["gemma"]
+
+
+def document_id(text, client_id=None, session_id=None):
+    """
+    検索・重複判定・エクスポートで使う文書ID
+
+    セッションIDはクライアントごとの連番のため、クライアント指定時は "client_id/session_id"。
+    クライアントなしの実行は本文のハッシュ（同じ本文は同じID）。
+    """
+    if client_id and session_id:
+        return f"{client_id}/{session_id}"
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def main(text, client_id=None, session_id=None, return_match=False):
     """
     Main inference pipeline for MILD-7.
 
@@ -11,27 +145,88 @@ def main(text):
     1. Text preprocessing and signal extraction
     2. LLM-based psychological reasoning (Gemma / MedGemma)
     3. Front-end score aggregation (7-level signal output)
+
+    When client_id and session_id are given, the MiniLM-stage aggregates
+    are also recorded in the longitudinal store.
+    When settings.llm_gating is on, the MiniLM signals decide the LLM
+    order and output length (see llm_scheduler).
+    When settings.dedup_mode is "reuse", LLM output of a near-duplicate
+    transcript of the same client is reused instead of generating again
+    (see dedup_index); with "flag" the match is only returned (return_match=True).
+    When settings.evidence_index_enabled is on, every analysed sentence is
+    added to the corpus-wide search index (see evidence_index).
+    When settings.parquet_export_enabled is on, the results are buffered for
+    the partitioned Parquet export (see parquet_export).
+    Stage durations are reported to backend.stage_listeners.
+
+    :param return_match: True の場合は類似文書の判定結果（dedup_index.lookup、なければ None）も返す
+    :return: (medgemma_result, gemma_result, front_score)（return_match 時は末尾に match）
     """
+    doc_id = document_id(text, client_id, session_id)
+
     # === 1. Preprocessing MiniML(前処理) ===
     # Generate prompts for LLM inference and extract structured signal candidates
     # MedGemma・Gemmaに投げる文字列プロンプトと会話ピックアップリスト（dct）を作成
-    gemma_prompt, payload, expand_payload = text_analyzer(text)
+    with timed_stage("minilm"):
+        gemma_prompt, payload, expand_payload, analysis = run_minilm_stage(text)
+
+    # クライアント指定時はセッション履歴に保存（再エンコード不要な集計値のみ）
+    if client_id and session_id:
+        with timed_stage("longitudinal"):
+            get_longitudinal_store().record_session(client_id, session_id, analysis, text=text)
+
+    # 全セッション横断の検索用に文ベクトル・ラベルスコアを登録
+    if evidence_index_enabled:
+        with timed_stage("evidence_index"):
+            get_evidence_index().add_document(doc_id, analysis)
     
     
     # === 2. LLM Inference(推論) ===
-    # Gemma: psychological reasoning (structured interpretation)
-    # Gemma推論
-    gemma_result = gemma_engine(gemma_prompt)
-    
-    # # MedGemma: contextual clinical-style interpretation
-    # MedGemma推論
-    medgemma_prompt = build_medgemma_payload(text, expand_payload)
-    medgemma_result = madgemma_engine(medgemma_prompt)
+    # 類似文書の結果があれば再利用（MiniLM の文ベクトルから指紋を作成）
+    match = None
+    reused = False
+    if dedup_mode != "off":
+        from dedup_index import fingerprint
+
+        with timed_stage("dedup"):
+            fp = fingerprint(analysis)
+            match = get_dedup_index().lookup(fp, doc_id, client_id=client_id)
+
+    if match and match["hit"] and dedup_mode == "reuse":
+        get_dedup_index().mark_reused(doc_id)
+        reused = True
+        medgemma_result, gemma_result = match["medgemma_result"], match["gemma_result"]
+    else:
+        # シグナルに応じて実行順・生成長を決める（単発実行のため後回しにはしない）
+        plan = None
+        if llm_gating:
+            from llm_scheduler import schedule
+            with timed_stage("schedule"):
+                plan = schedule(session_id or "interactive", payload, expand_payload)
+
+        with timed_stage("llm"):
+            medgemma_result, gemma_result = run_llm_stage(text, gemma_prompt, expand_payload, plan)
+
+        if dedup_mode != "off":
+            with timed_stage("dedup"):
+                get_dedup_index().add(doc_id, fp, gemma_result, medgemma_result, client_id)
     
     
     # === 3. Front-end Scoring(フロント表示用スコア集計) ===
     # Aggregate cosine-based scores into a 7-level signal representation
-    front_score = front_score_totalling(payload, expand_payload)
-    
-    return medgemma_result, gemma_result, front_score
+    with timed_stage("front_score"):
+        front_score = front_score_totalling(payload, expand_payload)
 
+    # 分析用の列指向データに追加（書き込みはまとめてバックグラウンドで行う）
+    if parquet_export_enabled:
+        with timed_stage("export"):
+            get_parquet_exporter().add(
+                doc_id, analysis, payload, front_score, gemma_result, medgemma_result, client_id, session_id
+            )
+
+    if return_match:
+        if match is not None:
+            match = {k: v for k, v in match.items() if k not in ("gemma_result", "medgemma_result")}
+            match["reused"] = reused
+        return medgemma_result, gemma_result, front_score, match
+    return medgemma_result, gemma_result, front_score
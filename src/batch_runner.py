@@ -0,0 +1,815 @@
+"""
+batch_runner
+大量の会話テキストをシャードに分割し、複数プロセス・複数ノードで処理する
+
+作業キューは RUN_DIR/queue.sqlite3 に作成する（共有ファイルシステム上に置けば複数ノードで共有可能）。
+ワーカーはシャード単位でリース（期限付きの担当権）を取得し、
+文書ごとに各段階（minilm / gemma / medgemma）の完了を記録する。
+途中でプロセスが停止しても、リース期限切れ後に別ワーカーが引き継ぎ、完了済みの段階は再実行しない。
+
+シャード内では MiniLM 層をすべて実行してから、LLM 層を llm_scheduler の優先度順
+（高リスクが先）に実行する。低シグナルで後回しになった文書の LLM 層は deferred として残し、
+work --include-deferred で他の作業がなくなってから実行する。
+
+Usage:
+    python batch_runner.py init RUN_DIR --input transcripts/ --shards 16
+    python batch_runner.py work RUN_DIR --workers 4
+    python batch_runner.py work RUN_DIR --workers 4 --standin
+    python batch_runner.py work RUN_DIR --include-deferred
+    python batch_runner.py status RUN_DIR
+    python batch_runner.py collect RUN_DIR --out results.jsonl
+    python batch_runner.py selftest --workers 3
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+STAGES = ["minilm", "gemma", "medgemma"]
+
+QUEUE_FILE = "queue.sqlite3"
+
+# リース期間（秒）。処理中はハートビートが延長し、プロセスが停止すると期限切れ後に他ワーカーが引き継ぐ
+LEASE_SECONDS = 600
+
+# 同じ段階をこの回数試して失敗したら failed として先に進む
+MAX_ATTEMPTS = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    doc_id TEXT PRIMARY KEY,
+    shard  INTEGER NOT NULL,
+    source TEXT,
+    text   TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_documents_shard ON documents (shard);
+CREATE TABLE IF NOT EXISTS shards (
+    shard       INTEGER PRIMARY KEY,
+    status      TEXT NOT NULL DEFAULT 'pending',
+    worker      TEXT,
+    lease_until REAL,
+    updated_at  REAL
+);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    doc_id      TEXT NOT NULL,
+    stage       TEXT NOT NULL,
+    status      TEXT NOT NULL DEFAULT 'running',
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    worker      TEXT,
+    output_path TEXT,
+    error       TEXT,
+    finished_at REAL,
+    PRIMARY KEY (doc_id, stage)
+);
+"""
+
+# LLM 段階の実測値（llm_scheduler.summarize_usage で集計する）
+USAGE_COLUMNS = {
+    "tier": "TEXT",
+    "max_new_tokens": "INTEGER",
+    "new_tokens": "INTEGER",
+    "load_seconds": "REAL",
+    "generate_seconds": "REAL"
+}
+
+
+# =====
+# キュー操作
+# =====
+def connect(run_dir):
+    """
+    作業キューに接続する。
+    複数ノードから共有できるよう WAL ではなく通常のジャーナルを使う。
+    """
+    conn = sqlite3.connect(
+        os.path.join(run_dir, QUEUE_FILE),
+        timeout=60,
+        isolation_level=None # BEGIN IMMEDIATE を明示的に使う
+    )
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+
+    # 旧バージョンで作成したキューには実測値の列がないため追加する
+    columns = {r["name"] for r in conn.execute("PRAGMA table_info(checkpoints)")}
+    for name, kind in USAGE_COLUMNS.items():
+        if name not in columns:
+            conn.execute(f"ALTER TABLE checkpoints ADD COLUMN {name} {kind}")
+    return conn
+
+
+def iter_input(path):
+    """
+    入力（.txt を含むディレクトリ、または {"id", "text"} の JSON Lines）を読み込む
+
+    :return: (doc_id, source, text) のイテレータ。ディレクトリの場合 text は None（処理時に読む）
+    """
+    if os.path.isdir(path):
+        for root, _, files in os.walk(path):
+            for name in sorted(files):
+                if name.endswith(".txt"):
+                    full = os.path.join(root, name)
+                    yield os.path.relpath(full, path), os.path.abspath(full), None
+    else:
+        with open(path, encoding="utf-8") as f:
+            for line_no, line in enumerate(f, 1):
+                if line.strip():
+                    record = json.loads(line)
+                    yield str(record.get("id", line_no)), None, record["text"]
+
+
+def shard_of(doc_id, n_shards):
+    """
+    文書IDからシャード番号を決める（実行環境によらず同じ結果になるハッシュ）
+    """
+    digest = hashlib.sha1(doc_id.encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "little") % n_shards
+
+
+def init_run(run_dir, input_path, n_shards=16):
+    """
+    入力をシャードに分割して作業キューを作成する（既存の文書は追加しない）
+
+    :return: 登録した文書数
+    """
+    os.makedirs(run_dir, exist_ok=True)
+    conn = connect(run_dir)
+
+    conn.execute("BEGIN IMMEDIATE")
+    added = 0
+    for doc_id, source, text in iter_input(input_path):
+        cur = conn.execute(
+            "INSERT OR IGNORE INTO documents VALUES (?, ?, ?, ?)",
+            (doc_id, shard_of(doc_id, n_shards), source, text)
+        )
+        added += cur.rowcount
+
+    conn.executemany(
+        "INSERT OR IGNORE INTO shards (shard) VALUES (?)",
+        [(s,) for s in range(n_shards)]
+    )
+    # 文書が追加されたシャードは再処理対象に戻す
+    if added:
+        conn.execute("UPDATE shards SET status = 'pending' WHERE status IN ('done', 'deferred')")
+    conn.execute("COMMIT")
+    conn.close()
+
+    return added
+
+
+def claim_shard(conn, worker_id, lease_seconds=LEASE_SECONDS, include_deferred=False):
+    """
+    未処理、またはリース期限切れのシャードを1つ取得する
+
+    :param include_deferred: 後回しの LLM 層だけが残ったシャードも取得する（未処理のシャードを優先）
+    :return: シャード番号（なければ None）
+    """
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    row = conn.execute(
+        """
+        SELECT shard FROM shards
+        WHERE status = 'pending' OR (status = 'running' AND lease_until < ?)
+           OR (? AND status = 'deferred')
+        ORDER BY status = 'deferred', shard LIMIT 1
+        """,
+        (now, include_deferred)
+    ).fetchone()
+
+    shard = None
+    if row is not None:
+        shard = row["shard"]
+        conn.execute(
+            "UPDATE shards SET status = 'running', worker = ?, lease_until = ?, updated_at = ? WHERE shard = ?",
+            (worker_id, now + lease_seconds, now, shard)
+        )
+    conn.execute("COMMIT")
+    return shard
+
+
+def renew_lease(conn, shard, worker_id, lease_seconds=LEASE_SECONDS):
+    """
+    リースを延長する。他ワーカーに引き継がれていた場合は False
+    """
+    now = time.time()
+    cur = conn.execute(
+        "UPDATE shards SET lease_until = ?, updated_at = ? WHERE shard = ? AND worker = ? AND status = 'running'",
+        (now + lease_seconds, now, shard, worker_id)
+    )
+    return cur.rowcount == 1
+
+
+class LeaseHeartbeat:
+    """
+    Renews a shard lease from a background thread while its stages run.
+
+    A single LLM stage can take longer than the lease, so renewing only
+    between stages would let another worker take over a live shard.
+    The thread uses its own connection; if the lease has moved to another
+    worker, lost is set and the shard is abandoned after the current stage.
+    """
+
+    def __init__(self, run_dir, shard, worker_id, lease_seconds=LEASE_SECONDS):
+        self.run_dir = run_dir
+        self.shard = shard
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        # 期限の 1/3 ごとに延長（1回失敗しても期限内に再試行できる）
+        self.interval = lease_seconds / 3
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True, name=f"mild7-lease-{self.shard}")
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        conn = connect(self.run_dir)
+        try:
+            while not self._stop.wait(self.interval):
+                try:
+                    if not renew_lease(conn, self.shard, self.worker_id, self.lease_seconds):
+                        self.lost = True
+                        break
+                except sqlite3.OperationalError as e:
+                    # 共有ファイルシステムのロック待ちなど（次の周期で再試行）
+                    print(f"Lease renewal for shard {self.shard} failed: {e}", file=sys.stderr)
+        finally:
+            conn.close()
+
+
+def complete_shard(conn, shard, worker_id, status="done"):
+    conn.execute(
+        "UPDATE shards SET status = ?, lease_until = NULL, updated_at = ? WHERE shard = ? AND worker = ?",
+        (status, time.time(), shard, worker_id)
+    )
+
+
+def remaining_shards(conn):
+    """
+    未完了のシャード数（後回しの LLM 層だけが残ったシャードは含めない）
+    """
+    return conn.execute(
+        "SELECT COUNT(*) FROM shards WHERE status NOT IN ('done', 'deferred')"
+    ).fetchone()[0]
+
+
+# =====
+# チェックポイント
+# =====
+def output_path(run_dir, stage, doc_id):
+    name = hashlib.sha1(doc_id.encode("utf-8")).hexdigest()
+    return os.path.join(run_dir, "outputs", stage, name[:2], f"{name}.json")
+
+
+def write_output(path, data):
+    """
+    段階の出力を書き込む（一時ファイル経由で置き換え、途中停止で壊れないようにする）
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def read_output(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def stage_states(conn, doc_id):
+    rows = conn.execute("SELECT * FROM checkpoints WHERE doc_id = ?", (doc_id,)).fetchall()
+    return {r["stage"]: dict(r) for r in rows}
+
+
+def start_stage(conn, doc_id, stage, worker_id):
+    """
+    段階の開始を記録し、試行回数を返す
+    (プロセスごと落ちる失敗も回数に数えるため、実行前に加算する)
+    """
+    conn.execute(
+        """
+        INSERT INTO checkpoints (doc_id, stage, status, attempts, worker) VALUES (?, ?, 'running', 1, ?)
+        ON CONFLICT (doc_id, stage) DO UPDATE SET attempts = attempts + 1, worker = excluded.worker
+        """,
+        (doc_id, stage, worker_id)
+    )
+    return conn.execute(
+        "SELECT attempts FROM checkpoints WHERE doc_id = ? AND stage = ?", (doc_id, stage)
+    ).fetchone()[0]
+
+
+def finish_stage(conn, doc_id, stage, status, path=None, error=None, usage=None):
+    """
+    段階の終了を記録する
+
+    :param usage: LLM 段階の実測値（USAGE_COLUMNS の各項目）
+    """
+    usage = usage or {}
+    conn.execute(
+        """
+        UPDATE checkpoints SET status = ?, output_path = ?, error = ?, finished_at = ?,
+            tier = ?, max_new_tokens = ?, new_tokens = ?, load_seconds = ?, generate_seconds = ?
+        WHERE doc_id = ? AND stage = ?
+        """,
+        (status, path, error, time.time(), *(usage.get(name) for name in USAGE_COLUMNS), doc_id, stage)
+    )
+
+
+def defer_stage(conn, doc_id, stage):
+    """
+    LLM 段階を後回し（deferred）として記録する（完了・失敗済みの段階は変更しない）
+    """
+    conn.execute(
+        """
+        INSERT INTO checkpoints (doc_id, stage, status, attempts) VALUES (?, ?, 'deferred', 0)
+        ON CONFLICT (doc_id, stage) DO UPDATE SET status = 'deferred' WHERE status NOT IN ('done', 'failed')
+        """,
+        (doc_id, stage)
+    )
+
+
+# =====
+# 各段階の処理
+# =====
+def run_minilm(doc_id, text):
+    """
+    MiniLM 層。LLM 層で使うプロンプト・実行計画もここで作成して保存する
+    """
+    import backend
+    from front_score_totalling import front_score_totalling
+    from settings import llm_gating
+    from text_analyzer import build_medgemma_payload
+
+    gemma_prompt, payload, expand_payload, analysis = backend.run_minilm_stage(text)
+
+    plan = None
+    if llm_gating:
+        from llm_scheduler import schedule
+        plan = schedule(doc_id, payload, expand_payload)
+
+    return {
+        "lang": analysis["lang"],
+        "taxonomy_version": analysis.get("taxonomy_version"),
+        "n_sentences": len(analysis["sentences"]),
+        "gemma_prompt": gemma_prompt,
+        "medgemma_prompt": build_medgemma_payload(text, expand_payload),
+        "payload": payload,
+        "expand_payload": expand_payload,
+        "front_score": front_score_totalling(payload, expand_payload),
+        "plan": plan
+    }
+
+
+def run_llm(stage, minilm_output):
+    """
+    Gemma / MedGemma 層（MiniLM 層の保存結果から実行）
+    """
+    import backend
+    from gemmas_engine import track_generation
+
+    plan = minilm_output["plan"]
+    max_new_tokens = plan["max_new_tokens"][stage] if plan else 1000
+
+    started = time.perf_counter()
+    with track_generation() as generations:
+        if stage == "gemma":
+            result = backend.gemma_engine(minilm_output["gemma_prompt"], max_new_tokens)
+        else:
+            result = backend.madgemma_engine(minilm_output["medgemma_prompt"], max_new_tokens)
+
+    # 実測値（生成トークン数・生成時間。読み込み時間は分けて記録）
+    usage = {
+        "tier": plan["tier"] if plan else "normal",
+        "max_new_tokens": max_new_tokens,
+        "new_tokens": sum(g["new_tokens"] for g in generations),
+        "load_seconds": sum(g["load_seconds"] for g in generations),
+        "generate_seconds": sum(g["generate_seconds"] for g in generations)
+    }
+    return {"result": result, "seconds": time.perf_counter() - started, "usage": usage}
+
+
+def load_text(doc):
+    if doc["text"] is not None:
+        return doc["text"]
+    with open(doc["source"], encoding="utf-8") as f:
+        return f.read()
+
+
+class LeaseLost(Exception):
+    """
+    シャードのリースが他ワーカーに移った
+    """
+
+
+def process_shard(run_dir, conn, docs, shard, worker_id, on_stage_done=None,
+                  lease_seconds=LEASE_SECONDS, include_deferred=False, heartbeat=None):
+    """
+    1シャードの未完了段階を実行する
+
+    MiniLM 層をすべての文書で実行した後、LLM 層を llm_scheduler.LLMScheduler で
+    優先度順（高リスクが先）に実行する。後回しの文書は include_deferred の場合のみ最後に実行し、
+    それ以外は deferred として記録する。
+
+    :param heartbeat: 実行中のリースを延長する LeaseHeartbeat（None の場合は段階の完了ごとに延長）
+    :return: この呼び出しで完了した段階数
+    """
+    from llm_scheduler import LLMScheduler
+
+    completed = 0
+
+    def run_stage(doc_id, states, stage, fn):
+        nonlocal completed
+        state = states.get(stage)
+        if state and state["status"] in ("done", "failed"):
+            return state
+
+        attempts = start_stage(conn, doc_id, stage, worker_id)
+        if attempts > MAX_ATTEMPTS:
+            # 前回までの実行中にプロセスごと停止した場合など
+            finish_stage(conn, doc_id, stage, "failed", error="max attempts exceeded")
+            return {"status": "failed"}
+
+        path = output_path(run_dir, stage, doc_id)
+        try:
+            output = fn()
+            write_output(path, output)
+        except Exception as e:
+            status = "failed" if attempts >= MAX_ATTEMPTS else "pending"
+            finish_stage(conn, doc_id, stage, status, error=repr(e))
+            return {"status": status}
+
+        finish_stage(conn, doc_id, stage, "done", path, usage=output.get("usage"))
+        completed += 1
+        if on_stage_done:
+            on_stage_done()
+        if heartbeat is not None:
+            if heartbeat.lost:
+                raise LeaseLost(shard)
+        elif not renew_lease(conn, shard, worker_id, lease_seconds):
+            raise LeaseLost(shard)
+        return {"status": "done", "output_path": path}
+
+    # === MiniLM 層（シャード内の全文書） ===
+    scheduler = LLMScheduler()
+    llm_stages = {}
+    for doc in docs:
+        doc_id = doc["doc_id"]
+        states = stage_states(conn, doc_id)
+        state = run_stage(doc_id, states, "minilm", lambda: run_minilm(doc_id, load_text(doc)))
+        if state["status"] != "done":
+            continue
+        minilm_output = read_output(state["output_path"])
+        plan = minilm_output["plan"]
+
+        # === LLM 層（実行計画の順。高リスクは MedGemma を先に実行） ===
+        order = plan["order"] if plan else ["gemma", "medgemma"]
+        llm_stages[doc_id] = order
+
+        def run(doc_id=doc_id, states=states, order=order, minilm_output=minilm_output):
+            for stage in order:
+                run_stage(doc_id, states, stage, lambda: run_llm(stage, minilm_output))
+
+        scheduler.enqueue(doc_id, plan, run)
+
+    scheduler.drain(include_deferred=include_deferred)
+
+    # 後回しのまま残った文書は deferred として記録（work --include-deferred で実行）
+    for doc_id in scheduler.deferred_ids():
+        for stage in llm_stages[doc_id]:
+            defer_stage(conn, doc_id, stage)
+
+    return completed
+
+
+def worker_loop(run_dir, worker_id=None, standin=False, poll_seconds=5.0,
+                lease_seconds=LEASE_SECONDS, fail_after=None, include_deferred=False):
+    """
+    作業キューが空になるまでシャードを取得して処理する
+
+    :param worker_id: ワーカー識別子（省略時は ホスト名-PID）
+    :param standin: スタンドインモデルを使用する
+    :param poll_seconds: 他ワーカーが処理中のシャードしか残っていない場合の待機間隔
+    :param fail_after: 指定した段階数を完了した時点でプロセスを強制終了する（再開の確認用）
+    :param include_deferred: 後回しにした低シグナル文書の LLM 層も実行する
+    :return: 完了した段階数
+    """
+    if standin:
+        from standin_models import install_standin_models
+        install_standin_models()
+    else:
+        # マシンプロファイルのスレッド数をワーカープロセスごとに1回設定する
+        from autotune import apply_thread_config
+        apply_thread_config()
+
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    conn = connect(run_dir)
+    done_count = 0
+
+    def on_stage_done():
+        nonlocal done_count
+        done_count += 1
+        if fail_after is not None and done_count >= fail_after:
+            # 異常終了を再現（チェックポイント以外は何も後始末しない）
+            os._exit(3)
+
+    while True:
+        shard = claim_shard(conn, worker_id, lease_seconds, include_deferred)
+        if shard is None:
+            if remaining_shards(conn) == 0:
+                break
+            # 他ワーカーが処理中（リース切れを待つ）
+            time.sleep(poll_seconds)
+            continue
+
+        docs = conn.execute(
+            "SELECT * FROM documents WHERE shard = ? ORDER BY doc_id", (shard,)
+        ).fetchall()
+
+        # 段階の実行中もリースを延長する（長い LLM 段階の途中で引き継がれないように）
+        heartbeat = LeaseHeartbeat(run_dir, shard, worker_id, lease_seconds).start()
+        try:
+            process_shard(
+                run_dir, conn, docs, shard, worker_id, on_stage_done, lease_seconds, include_deferred, heartbeat
+            )
+        except LeaseLost:
+            continue
+        finally:
+            heartbeat.stop()
+
+        # pending（再試行待ち）の段階が残っていればシャードを未処理に戻す
+        retry = conn.execute(
+            """
+            SELECT COUNT(*) FROM checkpoints c JOIN documents d USING (doc_id)
+            WHERE d.shard = ? AND c.status = 'pending'
+            """,
+            (shard,)
+        ).fetchone()[0]
+        if retry:
+            conn.execute(
+                "UPDATE shards SET status = 'pending', worker = NULL, lease_until = NULL WHERE shard = ? AND worker = ?",
+                (shard, worker_id)
+            )
+            continue
+
+        # 後回しの LLM 層だけが残っていれば deferred（--include-deferred で再取得）
+        deferred = conn.execute(
+            """
+            SELECT COUNT(*) FROM checkpoints c JOIN documents d USING (doc_id)
+            WHERE d.shard = ? AND c.status = 'deferred'
+            """,
+            (shard,)
+        ).fetchone()[0]
+        complete_shard(conn, shard, worker_id, "deferred" if deferred else "done")
+
+    conn.close()
+    return done_count
+
+
+def run_workers(run_dir, n_workers=1, **kwargs):
+    """
+    ローカルで n_workers 個のワーカープロセスを起動し、終了を待つ
+
+    :return: 各プロセスの終了コード
+    """
+    ctx = multiprocessing.get_context("spawn")
+    procs = [
+        ctx.Process(target=worker_loop, args=(run_dir,), kwargs=kwargs, name=f"mild7-worker-{i}")
+        for i in range(n_workers)
+    ]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    return [p.exitcode for p in procs]
+
+
+# =====
+# 状況確認・結果出力
+# =====
+def run_status(run_dir):
+    """
+    進捗と LLM 層の実測値の集計（llm_scheduler.summarize_usage）
+
+    後回しのまま未実行の文書は llm.deferred_pending に件数のみ示し、短縮量には含めない。
+    """
+    from llm_scheduler import summarize_usage
+
+    conn = connect(run_dir)
+    status = {
+        "documents": conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0],
+        "shards": {
+            r["status"]: r["n"]
+            for r in conn.execute("SELECT status, COUNT(*) AS n FROM shards GROUP BY status")
+        },
+        "stages": {stage: {} for stage in STAGES}
+    }
+    for r in conn.execute("SELECT stage, status, COUNT(*) AS n FROM checkpoints GROUP BY stage, status"):
+        status["stages"][r["stage"]][r["status"]] = r["n"]
+
+    records = [
+        {"engine": r["stage"], **{name: r[name] for name in USAGE_COLUMNS}}
+        for r in conn.execute(
+            "SELECT * FROM checkpoints WHERE stage != 'minilm' AND status = 'done' AND new_tokens IS NOT NULL"
+        )
+    ]
+    status["llm"] = summarize_usage(records)
+    status["llm"]["generations_by_tier"] = {}
+    for r in records:
+        status["llm"]["generations_by_tier"][r["tier"]] = status["llm"]["generations_by_tier"].get(r["tier"], 0) + 1
+    status["llm"]["deferred_pending"] = conn.execute(
+        "SELECT COUNT(DISTINCT doc_id) FROM checkpoints WHERE status = 'deferred'"
+    ).fetchone()[0]
+    conn.close()
+    return status
+
+
+def collect_results(run_dir, out_path):
+    """
+    完了した文書の結果を JSON Lines にまとめる
+
+    :return: 出力した文書数
+    """
+    conn = connect(run_dir)
+    n = 0
+    with open(out_path, "w", encoding="utf-8") as out:
+        for doc in conn.execute("SELECT doc_id FROM documents ORDER BY doc_id"):
+            states = stage_states(conn, doc["doc_id"])
+            if "minilm" not in states or states["minilm"]["status"] != "done":
+                continue
+
+            minilm_output = read_output(states["minilm"]["output_path"])
+            record = {
+                "doc_id": doc["doc_id"],
+                "lang": minilm_output["lang"],
+                "taxonomy_version": minilm_output.get("taxonomy_version"),
+                "front_score": minilm_output["front_score"],
+                "plan": minilm_output["plan"]
+            }
+            for stage in ["gemma", "medgemma"]:
+                state = states.get(stage)
+                record[stage] = (
+                    read_output(state["output_path"])["result"]
+                    if state and state["status"] == "done" else None
+                )
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            n += 1
+    conn.close()
+    return n
+
+
+# =====
+# 動作確認
+# =====
+SELFTEST_TEXTS = [
+    "I feel so alone lately. Nobody at work talks to me.",
+    "I always have to be perfect, otherwise they will leave me.",
+    "We went hiking on Sunday and it was lovely.",
+    "I don't want to be here anymore. Everything feels pointless.",
+    "My sister called and we laughed about old times.",
+    "I should be stronger than this. I hate that I cry.",
+]
+
+
+def selftest(n_workers=3, n_docs=12, lease_seconds=1.0, stage_seconds=2.0):
+    """
+    スタンドインモデルを使い、複数プロセスでリース・再開を確認する
+
+    1. 1ワーカーを最初の段階の完了直後に強制終了させる（リースはハートビート停止後に期限切れ）
+    2. n_workers 個のワーカーで残りを処理する（各 LLM 段階はリースより長くかかる）
+
+    リース期限より長い段階が他ワーカーに引き継がれず1回だけ実行されたこと、
+    強制終了したシャードが引き継がれてすべての段階が完了したことを確認する。
+
+    :return: {"elapsed", "exit_codes", "stages", "max_attempts", "duplicate_runs", "ok"}
+    """
+    started = time.perf_counter()
+    run_dir = tempfile.mkdtemp(prefix="mild7-batch-selftest-")
+
+    input_path = os.path.join(run_dir, "input.jsonl")
+    with open(input_path, "w", encoding="utf-8") as f:
+        for i in range(n_docs):
+            text = SELFTEST_TEXTS[i % len(SELFTEST_TEXTS)] + f" (note {i})"
+            f.write(json.dumps({"id": f"doc-{i:03d}", "text": text}) + "\n")
+    init_run(run_dir, input_path, n_shards=max(2, n_workers))
+
+    # スタンドインの生成時間（子プロセスは環境変数から読む）：1段階が stage_seconds かかる
+    from standin_models import STANDIN_OUTPUT_TOKENS
+    os.environ["MILD7_STANDIN_SECONDS_PER_TOKEN"] = str(stage_seconds / STANDIN_OUTPUT_TOKENS)
+    os.environ["MILD7_STANDIN_LOAD_SECONDS"] = "0"
+
+    kwargs = {"standin": True, "poll_seconds": lease_seconds / 4, "lease_seconds": lease_seconds}
+    exit_codes = run_workers(run_dir, 1, fail_after=1, **kwargs)
+    exit_codes += run_workers(run_dir, n_workers, **kwargs)
+
+    # 1つの段階を複数のワーカーが実行すると、attempts が実行回数だけ増える
+    conn = connect(run_dir)
+    rows = conn.execute("SELECT * FROM checkpoints").fetchall()
+    conn.close()
+    stages = {}
+    for r in rows:
+        stages.setdefault(r["stage"], {}).setdefault(r["status"], 0)
+        stages[r["stage"]][r["status"]] += 1
+    duplicate_runs = sum(1 for r in rows if r["stage"] != "minilm" and r["attempts"] > 1)
+    max_attempts = max((r["attempts"] for r in rows), default=0)
+
+    all_done = all(
+        stages.get(stage, {}).get("done", 0) == n_docs and len(stages[stage]) == 1
+        for stage in STAGES
+    )
+    return {
+        "run_dir": run_dir,
+        "elapsed": time.perf_counter() - started,
+        "exit_codes": exit_codes,
+        "stages": stages,
+        "max_attempts": max_attempts,
+        "duplicate_runs": duplicate_runs,
+        "ok": all_done and duplicate_runs == 0 and exit_codes[0] == 3 and not any(exit_codes[1:])
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MILD-7 sharded batch runner")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    init = sub.add_parser("init", help="split an input archive into shards")
+    init.add_argument("run_dir")
+    init.add_argument("--input", required=True, help="directory of .txt files or JSON Lines")
+    init.add_argument("--shards", type=int, default=16)
+
+    work = sub.add_parser("work", help="drain the work queue")
+    work.add_argument("run_dir")
+    work.add_argument("--workers", type=int, default=1)
+    work.add_argument("--standin", action="store_true", help="use stand-in models (offline)")
+    work.add_argument("--poll-seconds", type=float, default=5.0)
+    work.add_argument("--lease-seconds", type=float, default=LEASE_SECONDS)
+    work.add_argument("--fail-after", type=int, help="exit abruptly after N stages (resume testing)")
+    work.add_argument("--include-deferred", action="store_true",
+                      help="also run the LLM stage of deferred low-signal documents")
+
+    status = sub.add_parser("status", help="show queue progress and measured LLM usage")
+    status.add_argument("run_dir")
+
+    collect = sub.add_parser("collect", help="write finished results as JSON Lines")
+    collect.add_argument("run_dir")
+    collect.add_argument("--out", required=True)
+
+    test = sub.add_parser("selftest", help="multi-process lease and resume check with stand-in models")
+    test.add_argument("--workers", type=int, default=3)
+    test.add_argument("--docs", type=int, default=12)
+    test.add_argument("--lease-seconds", type=float, default=1.0)
+    test.add_argument("--stage-seconds", type=float, default=2.0, help="stand-in time per LLM stage")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "init":
+        added = init_run(args.run_dir, args.input, args.shards)
+        print(f"Registered {added} documents in {args.shards} shards")
+
+    elif args.command == "work":
+        kwargs = {
+            "standin": args.standin,
+            "poll_seconds": args.poll_seconds,
+            "lease_seconds": args.lease_seconds,
+            "fail_after": args.fail_after,
+            "include_deferred": args.include_deferred
+        }
+        if args.workers == 1:
+            worker_loop(args.run_dir, **kwargs)
+        else:
+            codes = run_workers(args.run_dir, args.workers, **kwargs)
+            if any(codes):
+                print(f"Worker exit codes: {codes}", file=sys.stderr)
+                sys.exit(1)
+        print(json.dumps(run_status(args.run_dir), indent=2))
+
+    elif args.command == "status":
+        print(json.dumps(run_status(args.run_dir), indent=2))
+
+    elif args.command == "collect":
+        n = collect_results(args.run_dir, args.out)
+        print(f"Wrote {n} results to {args.out}")
+
+    elif args.command == "selftest":
+        result = selftest(args.workers, args.docs, args.lease_seconds, args.stage_seconds)
+        print(json.dumps(result, indent=2))
+        if not result["ok"]:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
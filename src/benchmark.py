@@ -0,0 +1,530 @@
+"""
+benchmark
+MILD-7 の性能計測スクリプト
+
+Usage:
+    python benchmark.py imports
+    python benchmark.py imports --json
+    python benchmark.py evidence --sentences 5000
+    python benchmark.py evidence-index --sentences 100000 200000
+    python benchmark.py token-pooling --docs 20
+    python benchmark.py token-pooling-check
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 起動時に読み込まれてはいけない重いライブラリ
+HEAVY_MODULES = ["torch", "transformers", "sentence_transformers", "sklearn", "pysbd"]
+
+# 起動時間を計測する対象モジュール
+IMPORT_TARGETS = ["backend", "text_analyzer", "gemmas_engine"]
+
+
+def parse_importtime(stderr):
+    """
+    `python -X importtime` の出力を解析する
+
+    :param stderr: importtime の出力
+    :return: [{"module", "self_us", "cumulative_us", "depth"}] のリスト
+    """
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+
+        self_us, cumulative_us, name = line.split(":", 1)[1].split("|", 2)
+
+        rows.append({
+            "module": name.strip(),
+            "self_us": int(self_us),
+            "cumulative_us": int(cumulative_us),
+            "depth": (len(name) - len(name.lstrip())) // 2
+        })
+    return rows
+
+
+def profile_import(target):
+    """
+    新しいプロセスで target を import し、import 時間を計測する
+
+    :param target: モジュール名
+    :return: 計測結果の辞書
+    """
+    cmd = [sys.executable, "-X", "importtime", "-c", f"import {target}"]
+
+    start = time.perf_counter()
+    proc = subprocess.run(cmd, cwd=BASE_DIR, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+
+    rows = parse_importtime(proc.stderr)
+    loaded = {r["module"] for r in rows}
+
+    return {
+        "target": target,
+        "ok": proc.returncode == 0,
+        "wall_seconds": wall,
+        "import_seconds": sum(r["self_us"] for r in rows) / 1e6,
+        "modules": len(rows),
+        # 起動時点で読み込まれてしまった重いライブラリ（空であるべき）
+        "heavy_loaded": [m for m in HEAVY_MODULES if m in loaded],
+        "rows": rows
+    }
+
+
+def profile_imports(targets=IMPORT_TARGETS, top=10):
+    """
+    起動時 import のプロファイル。
+    各対象の起動コストと、遅延読み込みにした重いライブラリの初回使用時コストを計測する。
+
+    :param targets: 計測対象モジュール
+    :param top: 表示する上位モジュール数
+    :return: 計測結果
+    """
+    startup = []
+    for target in targets:
+        result = profile_import(target)
+        # 直接 import したモジュール（depth=0 以外も含む）から累積時間上位を抽出
+        rows = sorted(result.pop("rows"), key=lambda r: r["cumulative_us"], reverse=True)
+        result["top"] = [
+            {"module": r["module"], "cumulative_ms": r["cumulative_us"] / 1e3}
+            for r in rows[:top]
+        ]
+        startup.append(result)
+
+    # 初回使用時に支払う import コスト
+    deferred = []
+    for module in HEAVY_MODULES:
+        result = profile_import(module)
+        result.pop("rows")
+        deferred.append({
+            "module": module,
+            "ok": result["ok"],
+            "import_seconds": result["import_seconds"]
+        })
+
+    return {"startup": startup, "deferred": deferred}
+
+
+def print_import_profile(profile):
+    """
+    import プロファイルを表示する
+
+    :param profile: profile_imports() の結果
+    """
+    print("=== Import-time profile (startup) ===")
+    for result in profile["startup"]:
+        status = "" if result["ok"] else " (import failed)"
+        print(
+            f"{result['target']:<16} wall {result['wall_seconds']:.3f}s  "
+            f"import {result['import_seconds']:.3f}s  "
+            f"modules {result['modules']}{status}"
+        )
+        if result["heavy_loaded"]:
+            print(f"  !! heavy modules loaded at import: {', '.join(result['heavy_loaded'])}")
+        for row in result["top"]:
+            print(f"  {row['cumulative_ms']:>9.1f} ms  {row['module']}")
+
+    print("=== Deferred import cost (first use) ===")
+    for row in profile["deferred"]:
+        status = f"{row['import_seconds']:.3f}s" if row["ok"] else "not installed"
+        print(f"{row['module']:<24} {status}")
+
+
+def load_cached_references():
+    """
+    キャッシュ済みの参照ベクトルを読み込む（MiniLM 不要）
+    """
+    import pickle
+    from text_analyzer import CACHE_FILE
+
+    with open(CACHE_FILE, "rb") as f:
+        return pickle.load(f)
+
+
+def synthetic_document(refs, n_sentences, seed=0, noise=0.05):
+    """
+    参照ベクトルの近傍から疑似的な文ベクトルを作成する
+    （モデルなしでスコアリング処理を計測するため）
+
+    :return: (sentences, sentence_embeddings)
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    vectors = np.asarray([
+        vec
+        for category in refs.values()
+        for item in category.values()
+        for vec in item.values()
+    ], dtype=np.float32)
+
+    picks = rng.integers(0, len(vectors), n_sentences)
+    embeddings = vectors[picks] + rng.normal(0, noise, (n_sentences, vectors.shape[1]))
+    sentences = [f"Synthetic sentence number {i}." for i in range(n_sentences)]
+
+    return sentences, embeddings.astype(np.float32)
+
+
+def measure_allocations(fn):
+    """
+    tracemalloc で fn 実行時のメモリを計測する
+
+    :return: (fn の戻り値, {"peak_bytes", "retained_bytes", "retained_blocks"})
+    """
+    import gc
+    import tracemalloc
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+
+    result = fn()
+
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    diff = after.compare_to(before, "filename")
+    return result, {
+        "peak_bytes": peak,
+        # 戻り値として保持されているメモリ・オブジェクト数
+        "retained_bytes": sum(d.size_diff for d in diff),
+        "retained_blocks": sum(d.count_diff for d in diff)
+    }
+
+
+def benchmark_evidence(n_sentences=5000):
+    """
+    配列形式の根拠（EvidenceStore）のメモリ・確保数を計測する
+    (expand_payload 形式の表示用リストを作成する場合としない場合)
+
+    :return: 計測結果
+    """
+    from evidence_store import EvidenceStore
+    from text_analyzer import (
+        get_reference_matrix,
+        rank_category_scores,
+        pack_payload
+    )
+
+    refs = load_cached_references()
+    sentences, embeddings = synthetic_document(refs, n_sentences)
+
+    # スコア計算は共通のため事前に済ませておく
+    matrix, layout = get_reference_matrix(refs)
+    sims = embeddings @ matrix.T
+    categories = {}
+    for category, spec in layout.items():
+        scores = sims[:, spec["pos"]]
+        if spec["neg"] is not None:
+            scores = scores - sims[:, spec["neg"]]
+        ranked, mask = rank_category_scores(scores, spec["labels"])
+        categories[category] = (spec["labels"], scores, mask, ranked)
+
+    def compact():
+        store = EvidenceStore(sentences)
+        for category, (labels, scores, mask, _) in categories.items():
+            store.add_category(category, labels, mask, scores)
+        payload = pack_payload({c: v[3] for c, v in categories.items()}, store)
+        return store, payload
+
+    def compact_with_views():
+        store, payload = compact()
+        return store, payload, store.expand_payload()
+
+    results = {"sentences": n_sentences}
+    for name, fn in [
+        ("compact", compact),
+        ("compact_with_views", compact_with_views)
+    ]:
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+
+        _, stats = measure_allocations(fn)
+        stats["seconds"] = elapsed
+        results[name] = stats
+
+    hits = sum(int(v[2].sum()) for v in categories.values())
+    results["evidence_hits"] = hits
+    return results
+
+
+def benchmark_evidence_index(sizes=(100000, 200000), n_queries=20, k=50, doc_size=500):
+    """
+    全文検索インデックスの検索時間を文数ごとに計測する
+    （ラベル検索・ベクトル検索の全件走査 / クラスタ検索）
+
+    :param sizes: 計測する文数（昇順）
+    :return: 計測結果
+    """
+    import tempfile
+    import numpy as np
+    from evidence_index import EvidenceIndex
+
+    refs = load_cached_references()
+    rng = np.random.default_rng(1)
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index = EvidenceIndex(tmp, train_size=float("inf"))
+        label = None
+        _, queries = synthetic_document(refs, n_queries, seed=2, noise=0.3)
+
+        for size in sorted(sizes):
+            start = time.perf_counter()
+            while index.rows < size:
+                n = min(doc_size, size - index.rows)
+                sentences, embeddings = synthetic_document(refs, n, seed=int(rng.integers(1 << 30)), noise=0.3)
+                index.add_document(f"doc-{index.rows}", {
+                    "sentences": sentences,
+                    "sentence_embeddings": embeddings,
+                    "ref_embeddings": refs
+                })
+            add_seconds = time.perf_counter() - start
+            label = label or index.labels[0]
+
+            def timed(fn):
+                samples = []
+                for q in queries:
+                    t = time.perf_counter()
+                    fn(q)
+                    samples.append(time.perf_counter() - t)
+                return float(np.median(samples)) * 1000
+
+            row = {
+                "sentences": index.rows,
+                "add_seconds": add_seconds,
+                "label_query_ms": timed(lambda q: index.query_label(label, k)),
+                "label_query_filtered_ms": timed(lambda q: index.query_label(label, k, {index.labels[1]: 0.0}))
+            }
+
+            index.centroids = None
+            row["vector_flat_ms"] = timed(lambda q: index.query_vector(q, k))
+            flat = [[r["row_id"] for r in index.query_vector(q, k)] for q in queries]
+
+            start = time.perf_counter()
+            row["nlist"] = index.rebuild()
+            row["rebuild_seconds"] = time.perf_counter() - start
+            row["vector_ivf_ms"] = timed(lambda q: index.query_vector(q, k))
+
+            # クラスタ検索の再現率（全件走査の上位 k 件に対する割合）
+            ivf = [[r["row_id"] for r in index.query_vector(q, k)] for q in queries]
+            row["ivf_recall"] = float(np.mean([len(set(a) & set(b)) / k for a, b in zip(flat, ivf)]))
+            results.append(row)
+
+        index.close()
+
+    return {"k": k, "queries": n_queries, "results": results}
+
+
+def benchmark_token_pooling(n_docs=20, window=2, standin=False):
+    """
+    文ごとのエンコードとトークンのプーリング（token_pooling）を比較する
+    （処理時間・文ベクトルの一致度・ラベルスコアの一致度・上位ラベルの一致率）
+
+    :param standin: True の場合は MiniLM の代わりに HashingEncoder を使用
+    :return: 計測結果
+    """
+    import numpy as np
+    from loadtest import synthetic_corpus
+    from text_analyzer import segment_text, label_vectors, normalize_embeddings, analyze_psychological_features_fused
+    from token_pooling import get_token_encoder, encode_transcript
+
+    if standin:
+        from standin_models import get_standin_encoder
+        model, refs = get_standin_encoder()
+    else:
+        from text_analyzer import load_minilm, get_reference_embeddings
+        model = load_minilm()
+        refs = get_reference_embeddings(model, "en")
+
+    encoder = get_token_encoder(model)
+    _, vectors = label_vectors(refs)
+
+    def unit(x):
+        return normalize_embeddings(x, vectors.shape[1])
+
+    def top_labels(ranked):
+        return {category: {r[0] for r in items} for category, items in ranked.items()}
+
+    timings = {"sentence": 0.0, "sentence_windows": 0.0, "pooled": 0.0}
+    sentence_cos, window_cos, score_diff, overlap, overlap_windows = [], [], [], [], []
+    n_sentences = 0
+
+    for _, text in synthetic_corpus(n_docs):
+        sentences = segment_text(text, "en")
+        windows = [" ".join(sentences[i:i + window]) for i in range(len(sentences) - window + 1)]
+        n_sentences += len(sentences)
+
+        start = time.perf_counter()
+        per_sentence = model.encode(sentences)
+        timings["sentence"] += time.perf_counter() - start
+
+        # 窓を再エンコードする場合（比較用）
+        start = time.perf_counter()
+        per_window = model.encode(windows)
+        timings["sentence_windows"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        pooled = encode_transcript(encoder, text, sentences, window)
+        timings["pooled"] += time.perf_counter() - start
+
+        a, b = unit(per_sentence), unit(pooled["sentence_embeddings"])
+        sentence_cos.extend((a * b).sum(axis=1).tolist())
+        if pooled["window_embeddings"] is not None:
+            window_cos.extend((unit(per_window) * unit(pooled["window_embeddings"])).sum(axis=1).tolist())
+        score_diff.append(float(np.abs(a @ vectors.T - b @ vectors.T).mean()))
+
+        # 上位ラベルの一致率（文ごとのエンコードを基準）
+        base = top_labels(analyze_psychological_features_fused(sentences, per_sentence, refs)[0])
+        plain = top_labels(analyze_psychological_features_fused(sentences, pooled["sentence_embeddings"], refs)[0])
+        with_windows = top_labels(analyze_psychological_features_fused(
+            sentences, pooled["sentence_embeddings"], refs, window_embeddings=pooled["window_embeddings"]
+        )[0])
+        for category, labels in base.items():
+            if labels:
+                overlap.append(len(labels & plain[category]) / len(labels))
+                overlap_windows.append(len(labels & with_windows[category]) / len(labels))
+
+    return {
+        "docs": n_docs,
+        "sentences": n_sentences,
+        "window": window,
+        "encoder": type(model).__name__,
+        "sentence_seconds": timings["sentence"],
+        "sentence_plus_windows_seconds": timings["sentence"] + timings["sentence_windows"],
+        "pooled_seconds": timings["pooled"],
+        "speedup_vs_sentence": timings["sentence"] / timings["pooled"],
+        "speedup_vs_sentence_plus_windows": (timings["sentence"] + timings["sentence_windows"]) / timings["pooled"],
+        "sentence_cosine_mean": float(np.mean(sentence_cos)),
+        "sentence_cosine_p5": float(np.percentile(sentence_cos, 5)),
+        "window_cosine_mean": float(np.mean(window_cos)) if window_cos else None,
+        "label_score_abs_diff_mean": float(np.mean(score_diff)),
+        "top_label_overlap": float(np.mean(overlap)),
+        "top_label_overlap_with_windows": float(np.mean(overlap_windows))
+    }
+
+
+def check_token_pooling_fallback(standin=False, window=2):
+    """
+    トークンが取れなかった文のフォールバック（文単位のエンコード）を実際のラッパーで確認する
+    （チャンクをエンコーダの上限より長くして切り捨てを起こす）
+
+    :param standin: True の場合は HashingEncoder（切り捨てがないため fallback は 0 になりうる）
+    :return: 確認結果（ok: フォールバックが起きて文ごとのエンコードと一致した）
+    """
+    import numpy as np
+    from loadtest import synthetic_corpus
+    from text_analyzer import segment_text, normalize_embeddings
+    from token_pooling import get_token_encoder, encode_transcript
+
+    if standin:
+        from standin_models import get_standin_encoder
+        model, _ = get_standin_encoder()
+    else:
+        from text_analyzer import load_minilm
+        model = load_minilm()
+
+    encoder = get_token_encoder(model)
+    limit = getattr(encoder, "max_tokens", 0) or 128
+
+    # エンコーダの上限の数倍のトークンを持つ会話
+    text, sentences = "", []
+    for _, doc in synthetic_corpus(200):
+        text = (text + " " + doc).strip()
+        sentences = segment_text(text, "en")
+        if sum(encoder.count_tokens(sentences)) > limit * 4:
+            break
+
+    # 上限の4倍のチャンク → 各チャンクの後半の文はトークンが切り捨てられる
+    pooled = encode_transcript(encoder, text, sentences, window, max_tokens=limit * 4)
+    embeddings = pooled["sentence_embeddings"]
+
+    per_sentence = np.asarray(model.encode(sentences), dtype=np.float32)
+    dim = per_sentence.shape[1]
+    a, b = normalize_embeddings(per_sentence, dim), normalize_embeddings(embeddings, dim)
+    cosine = (a * b).sum(axis=1)
+
+    # フォールバックした文は文ごとのエンコードと一致する（cos ≈ 1）
+    fallback_rows = np.flatnonzero(cosine > 0.999)
+    return {
+        "encoder": type(encoder).__name__,
+        "max_tokens": limit,
+        "sentences": len(sentences),
+        "chunks": pooled["chunks"],
+        "tokens": pooled["tokens"],
+        "fallback": pooled["fallback"],
+        "shape_ok": embeddings.shape == per_sentence.shape,
+        "fallback_matches_encode": int(len(fallback_rows)) >= pooled["fallback"],
+        "ok": bool(
+            pooled["fallback"] > 0
+            and embeddings.shape == per_sentence.shape
+            and len(fallback_rows) >= pooled["fallback"]
+        )
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MILD-7 benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    imports = sub.add_parser("imports", help="import-time profile of the startup path")
+    imports.add_argument("--top", type=int, default=10)
+    imports.add_argument("--json", action="store_true")
+
+    evidence = sub.add_parser("evidence", help="array-backed evidence memory, with and without views")
+    evidence.add_argument("--sentences", type=int, default=5000)
+
+    evidence_index = sub.add_parser("evidence-index", help="corpus-wide search latency vs corpus size")
+    evidence_index.add_argument("--sentences", type=int, nargs="+", default=[100000, 200000])
+    evidence_index.add_argument("--queries", type=int, default=20)
+    evidence_index.add_argument("-k", type=int, default=50)
+
+    token_pooling = sub.add_parser("token-pooling", help="per-sentence encoding vs pooled token embeddings")
+    token_pooling.add_argument("--docs", type=int, default=20)
+    token_pooling.add_argument("--window", type=int, default=2)
+    token_pooling.add_argument("--standin", action="store_true", help="use the hashing stand-in encoder")
+
+    token_pooling_check = sub.add_parser(
+        "token-pooling-check", help="force the per-sentence fallback of token pooling with the real encoder"
+    )
+    token_pooling_check.add_argument("--standin", action="store_true", help="use the hashing stand-in encoder")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "imports":
+        profile = profile_imports(top=args.top)
+        if args.json:
+            print(json.dumps(profile, ensure_ascii=False, indent=2))
+        else:
+            print_import_profile(profile)
+
+    elif args.command == "evidence":
+        result = benchmark_evidence(args.sentences)
+        print(json.dumps(result, indent=2))
+
+    elif args.command == "evidence-index":
+        result = benchmark_evidence_index(args.sentences, args.queries, args.k)
+        print(json.dumps(result, indent=2))
+
+    elif args.command == "token-pooling":
+        result = benchmark_token_pooling(args.docs, args.window, args.standin)
+        print(json.dumps(result, indent=2))
+
+    elif args.command == "token-pooling-check":
+        result = check_token_pooling_fallback(args.standin)
+        print(json.dumps(result, indent=2))
+        if not result["ok"]:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,363 @@
+"""
+dedup_index
+類似（ほぼ重複）した会話テキストの LLM 結果を再利用するための指紋インデックス
+
+文書の指紋は2種類：
+- MiniLM 文ベクトルの平均（text_analyzer で計算済みのものを使用、追加のエンコードなし）
+- 文単位の MinHash（再出力・一部黒塗り・定型フォームなど、文の大半が共通する文書を検出）
+
+MinHash は LSH（バンド分割）で候補を絞り込み、候補のみコサイン類似度と推定 Jaccard 係数を計算する。
+照合は同じ client_id の文書に限る（他のクライアントの LLM 結果を再利用・表示しない）。
+
+Usage:
+    python dedup_index.py report
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime, timezone
+import numpy as np
+from settings import dedup_db_path, dedup_embedding_threshold, dedup_jaccard_threshold
+
+# MinHash の次元（= LSH バンド数 × バンド内の行数）
+NUM_PERM = 64
+LSH_BANDS = 16
+LSH_ROWS = NUM_PERM // LSH_BANDS
+
+# 2^31 - 1（32bit ハッシュとの積が uint64 に収まる）
+_PRIME = np.uint64((1 << 31) - 1)
+_rng = np.random.default_rng(20240601)
+_PERM_A = _rng.integers(1, (1 << 31) - 1, NUM_PERM, dtype=np.uint64)
+_PERM_B = _rng.integers(0, (1 << 31) - 1, NUM_PERM, dtype=np.uint64)
+
+_WS_RE = re.compile(r"\s+")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fingerprints (
+    doc_id          TEXT PRIMARY KEY,
+    created_at      TEXT NOT NULL,
+    n_sentences     INTEGER NOT NULL,
+    embedding       BLOB NOT NULL,
+    minhash         BLOB NOT NULL,
+    gemma_result    TEXT,
+    medgemma_result TEXT,
+    text_hash       TEXT,
+    client_id       TEXT
+);
+CREATE TABLE IF NOT EXISTS lsh_buckets (
+    band   INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    doc_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_lsh_buckets ON lsh_buckets (band, bucket);
+CREATE TABLE IF NOT EXISTS lookups (
+    at        TEXT NOT NULL,
+    doc_id    TEXT,
+    match_id  TEXT,
+    cosine    REAL,
+    jaccard   REAL,
+    hit       INTEGER NOT NULL,
+    reused    INTEGER NOT NULL
+);
+"""
+
+
+# =====
+# 指紋
+# =====
+def normalize_sentence(sent):
+    """
+    MinHash 用の文の正規化（大文字小文字・空白の差を無視）
+    """
+    return _WS_RE.sub(" ", sent.strip().lower())
+
+
+def _hash32(text):
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=4).digest(), "little")
+
+
+def minhash_signature(sentences):
+    """
+    文の集合の MinHash 署名
+
+    :param sentences: 文リスト
+    :return: uint64 配列 [NUM_PERM]（空の場合はすべて最大値）
+    """
+    shingles = {normalize_sentence(s) for s in sentences}
+    shingles.discard("")
+    if not shingles:
+        return np.full(NUM_PERM, _PRIME, dtype=np.uint64)
+
+    hashes = np.array([_hash32(s) % int(_PRIME) for s in shingles], dtype=np.uint64)
+    # [文数, NUM_PERM] の (a * h + b) mod p の列ごとの最小値
+    values = (hashes[:, None] * _PERM_A[None, :] + _PERM_B[None, :]) % _PRIME
+    return values.min(axis=0)
+
+
+def mean_embedding(sentence_embeddings):
+    """
+    文ベクトルを正規化してから平均し、再度正規化した文書ベクトル
+    """
+    emb = np.asarray(sentence_embeddings, dtype=np.float32)
+    if emb.size == 0:
+        return np.zeros(0, dtype=np.float32)
+
+    norms = np.linalg.norm(emb, axis=1, keepdims=True)
+    mean = (emb / np.where(norms == 0, 1.0, norms)).mean(axis=0)
+    norm = np.linalg.norm(mean)
+    return (mean / norm if norm > 0 else mean).astype(np.float32)
+
+
+def text_hash(sentences):
+    """
+    文リストのハッシュ（同じ文書の再送信の判定用）
+    """
+    joined = "\n".join(normalize_sentence(s) for s in sentences)
+    return hashlib.sha1(joined.encode("utf-8")).hexdigest()
+
+
+def fingerprint(analysis):
+    """
+    text_analyzer.analyze_text() の結果から文書の指紋を作成する
+
+    :return: {"embedding", "minhash", "n_sentences", "text_hash"}
+    """
+    return {
+        "embedding": mean_embedding(analysis["sentence_embeddings"]),
+        "minhash": minhash_signature(analysis["sentences"]),
+        "n_sentences": len(analysis["sentences"]),
+        "text_hash": text_hash(analysis["sentences"])
+    }
+
+
+def lsh_buckets(signature):
+    """
+    MinHash 署名をバンドに分割し、バンドごとのバケット値を返す
+    """
+    out = []
+    for band in range(LSH_BANDS):
+        rows = signature[band * LSH_ROWS:(band + 1) * LSH_ROWS]
+        digest = hashlib.blake2b(rows.tobytes(), digest_size=8).digest()
+        out.append((band, int.from_bytes(digest, "little", signed=True)))
+    return out
+
+
+def estimate_jaccard(sig_a, sig_b):
+    return float(np.mean(sig_a == sig_b))
+
+
+def cosine(a, b):
+    if a.size == 0 or b.size == 0 or a.shape != b.shape:
+        return 0.0
+    return float(np.dot(a, b))
+
+
+# =====
+# インデックス
+# =====
+class DedupIndex:
+    """
+    SQLite-backed fingerprint index of analysed documents and their LLM output.
+    """
+
+    def __init__(self, path=dedup_db_path,
+                 embedding_threshold=dedup_embedding_threshold,
+                 jaccard_threshold=dedup_jaccard_threshold):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self.embedding_threshold = embedding_threshold
+        self.jaccard_threshold = jaccard_threshold
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        if path != ":memory:":
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+
+        # 旧版のデータベースには本文ハッシュ・クライアント列を追加する
+        # （クライアント列のない既存の指紋は client_id なしの実行とだけ照合される）
+        columns = {r["name"] for r in self._conn.execute("PRAGMA table_info(fingerprints)")}
+        if "text_hash" not in columns:
+            self._conn.execute("ALTER TABLE fingerprints ADD COLUMN text_hash TEXT")
+        if "client_id" not in columns:
+            self._conn.execute("ALTER TABLE fingerprints ADD COLUMN client_id TEXT")
+
+    def close(self):
+        self._conn.close()
+
+    def add(self, doc_id, fp, gemma_result=None, medgemma_result=None, client_id=None):
+        """
+        文書の指紋と LLM 結果を登録する（同じ doc_id は上書き）
+
+        :param client_id: 文書のクライアント（lookup は同じクライアントの文書のみ照合する）
+        """
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM lsh_buckets WHERE doc_id = ?", (doc_id,))
+            self._conn.execute(
+                """
+                INSERT OR REPLACE INTO fingerprints
+                    (doc_id, created_at, n_sentences, embedding, minhash, gemma_result, medgemma_result,
+                     text_hash, client_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    doc_id,
+                    datetime.now(timezone.utc).isoformat(),
+                    fp["n_sentences"],
+                    fp["embedding"].astype(np.float32).tobytes(),
+                    fp["minhash"].astype(np.uint64).tobytes(),
+                    gemma_result,
+                    medgemma_result,
+                    fp.get("text_hash"),
+                    client_id
+                )
+            )
+            self._conn.executemany(
+                "INSERT INTO lsh_buckets VALUES (?, ?, ?)",
+                [(band, bucket, doc_id) for band, bucket in lsh_buckets(fp["minhash"])]
+            )
+
+    def candidates(self, fp, client_id=None):
+        """
+        LSH バケットが1つ以上一致する、同じクライアントの登録済み文書
+        """
+        buckets = lsh_buckets(fp["minhash"])
+        clause = " OR ".join(["(b.band = ? AND b.bucket = ?)"] * len(buckets))
+        params = [v for pair in buckets for v in pair]
+        rows = self._conn.execute(
+            f"""
+            SELECT DISTINCT b.doc_id FROM lsh_buckets b JOIN fingerprints f USING (doc_id)
+            WHERE ({clause}) AND f.client_id IS ?
+            """,
+            params + [client_id]
+        ).fetchall()
+        return [r["doc_id"] for r in rows]
+
+    def lookup(self, fp, doc_id=None, record=True, client_id=None):
+        """
+        最も類似した登録済み文書を探す（同じ client_id の文書のみ）
+
+        :param fp: fingerprint() の結果
+        :param doc_id: 問い合わせ文書のID（同じIDで本文が変わった場合は自身として除外、統計用）
+        :param record: 問い合わせを統計に記録するか
+        :param client_id: 問い合わせ文書のクライアント（None は client_id なしの文書どうしで照合）
+        :return: {"doc_id", "cosine", "jaccard", "hit", "gemma_result", "medgemma_result"}
+            （候補がなければ None）
+        """
+        best = None
+        for cand_id in self.candidates(fp, client_id):
+            row = self._conn.execute(
+                "SELECT * FROM fingerprints WHERE doc_id = ?", (cand_id,)
+            ).fetchone()
+            if row is None:
+                continue
+
+            # 同じIDの編集前の版は除外（同じ本文の再送信は LLM 結果をそのまま使える）
+            if cand_id == doc_id and row["text_hash"] != fp.get("text_hash"):
+                continue
+
+            sim = {
+                "doc_id": cand_id,
+                "cosine": cosine(fp["embedding"], np.frombuffer(row["embedding"], dtype=np.float32)),
+                "jaccard": estimate_jaccard(fp["minhash"], np.frombuffer(row["minhash"], dtype=np.uint64)),
+                "gemma_result": row["gemma_result"],
+                "medgemma_result": row["medgemma_result"]
+            }
+            if best is None or (sim["jaccard"], sim["cosine"]) > (best["jaccard"], best["cosine"]):
+                best = sim
+
+        if best is not None:
+            best["hit"] = (
+                best["cosine"] >= self.embedding_threshold
+                and best["jaccard"] >= self.jaccard_threshold
+                and best["gemma_result"] is not None
+                and best["medgemma_result"] is not None
+            )
+
+        if record:
+            self.record_lookup(doc_id, best, reused=False)
+        return best
+
+    def record_lookup(self, doc_id, match, reused):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO lookups VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    datetime.now(timezone.utc).isoformat(),
+                    doc_id,
+                    match["doc_id"] if match else None,
+                    match["cosine"] if match else None,
+                    match["jaccard"] if match else None,
+                    int(bool(match and match["hit"])),
+                    int(reused)
+                )
+            )
+
+    def mark_reused(self, doc_id):
+        """
+        直近の問い合わせを「再利用した」として記録し直す
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                UPDATE lookups SET reused = 1 WHERE rowid = (
+                    SELECT MAX(rowid) FROM lookups WHERE doc_id IS ?
+                )
+                """,
+                (doc_id,)
+            )
+
+    def report(self):
+        """
+        しきい値・ヒット率・類似度の分布を報告する
+        """
+        row = self._conn.execute(
+            """
+            SELECT COUNT(*) AS lookups,
+                   SUM(match_id IS NOT NULL) AS with_candidate,
+                   SUM(hit) AS hits,
+                   SUM(reused) AS reused
+            FROM lookups
+            """
+        ).fetchone()
+        lookups = row["lookups"] or 0
+
+        # 候補があった問い合わせの類似度分布（0.05 刻み）
+        histogram = {"cosine": {}, "jaccard": {}}
+        for r in self._conn.execute("SELECT cosine, jaccard FROM lookups WHERE match_id IS NOT NULL"):
+            for key in histogram:
+                bucket = f"{min(int(r[key] * 20), 19) / 20:.2f}"
+                histogram[key][bucket] = histogram[key].get(bucket, 0) + 1
+
+        return {
+            "embedding_threshold": self.embedding_threshold,
+            "jaccard_threshold": self.jaccard_threshold,
+            "documents": self._conn.execute("SELECT COUNT(*) FROM fingerprints").fetchone()[0],
+            "lookups": lookups,
+            "with_candidate": row["with_candidate"] or 0,
+            "hits": row["hits"] or 0,
+            "reused": row["reused"] or 0,
+            "hit_rate": (row["hits"] or 0) / lookups if lookups else 0.0,
+            "similarity_histogram": {k: dict(sorted(v.items())) for k, v in histogram.items()}
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MILD-7 near-duplicate index")
+    parser.add_argument("--db", default=dedup_db_path)
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("report", help="thresholds, hit rate and similarity distribution")
+
+    args = parser.parse_args(argv)
+    index = DedupIndex(args.db)
+    print(json.dumps(index.report(), indent=2))
+    index.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,740 @@
+"""
+evidence_index
+全セッションの解析済みの文を横断検索するためのインデックス
+
+解析のたびに文が追記され、transcript を再解析せずに
+「全セッションで "Don't belong" に最も近い50文」のような問い合わせに答える。
+
+保存形式（evidence_index_dir 以下）：
+- meta.sqlite3        文のメタデータ（文書ID・文番号・本文）
+- embeddings.f16      正規化済みの文ベクトル [文数, 次元]（float16、追記のみ、メモリマップで参照）
+- scores/{j}.f16      ラベル j のスコア列 [文数]（float16、text_analyzer の判定と同じ値）
+- centroids.npy       クラスタ中心（IVF、evidence_index_train_size 文に達した時点で作成）
+- lists/{c}.ids/.emb  クラスタごとの文番号と文ベクトル（連続読み出し用の複製）
+
+検索：
+- ラベル検索: スコア列（1文あたり2バイト）を分割走査する。モデル・参照ベクトル不要で厳密
+- 自由文検索: MiniLM でエンコードし、近いクラスタ（nprobe 個）のみを走査する。
+  rebuild でクラスタ数を文数に合わせて増やし、1回の検索で読む量を一定に保つ
+  （クラスタの作成・作り直しは needs_rebuild() になった時点でバックグラウンドで行う）
+- どちらもラベルスコアの下限で絞り込みできる
+
+書き込みは1プロセスからのみ行う前提（バッチ実行のワーカーからは登録しない）。
+taxonomy が更新された場合は、新しいバージョンの文書が届いた時点でスコア列をバックグラウンドで作り直す
+（作り直しが終わるまで、旧バージョンの文書も含めインデックス側のバージョンのスコアで登録する）。
+
+Usage:
+    python evidence_index.py query --label "injunctions/Don't belong" -k 50
+    python evidence_index.py query --text "Nobody wants me around" --min "emotions/loneliness=0.2"
+    python evidence_index.py stats
+    python evidence_index.py rebuild
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import ExitStack
+from datetime import datetime, timezone
+import numpy as np
+from text_analyzer import label_vectors, normalize_embeddings
+from settings import (
+    evidence_index_dir,
+    evidence_index_train_size,
+    evidence_index_list_size,
+    evidence_index_nprobe
+)
+
+# 分割走査の1回あたりの文数
+SCAN_CHUNK = 1 << 18
+
+# k-means の反復回数・1クラスタあたりの学習サンプル数
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLES_PER_LIST = 64
+
+DTYPE = np.float16
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS info (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS documents (
+    doc_id      TEXT PRIMARY KEY,
+    added_at    TEXT NOT NULL,
+    lang        TEXT,
+    text_hash   TEXT NOT NULL,
+    row_start   INTEGER NOT NULL,
+    n_sentences INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sentences (
+    row_id         INTEGER PRIMARY KEY,
+    doc_id         TEXT NOT NULL,
+    sentence_index INTEGER NOT NULL,
+    text           TEXT NOT NULL,
+    deleted        INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_sentences_doc ON sentences (doc_id);
+"""
+
+
+# =====
+# クラスタリング
+# =====
+def _normalize_rows(x):
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    return x / np.where(norms == 0, 1.0, norms)
+
+
+def spherical_kmeans(data, k, iterations=KMEANS_ITERATIONS, seed=0):
+    """
+    コサイン類似度の k-means（中心は正規化した平均）
+
+    :param data: 正規化済みベクトル [件数, 次元]
+    :param k: クラスタ数
+    :return: クラスタ中心 [k, 次元]（float32）
+    """
+    rng = np.random.default_rng(seed)
+    data = np.asarray(data, dtype=np.float32)
+    k = max(1, min(k, len(data)))
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+
+    for _ in range(iterations):
+        assign = np.argmax(data @ centroids.T, axis=1)
+
+        # クラスタごとの合計（並べ替えて区間ごとに足し合わせる）
+        order = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(centroids)
+        filled = np.flatnonzero(counts)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[filled]
+        sums[filled] = np.add.reduceat(data[order], starts, axis=0)
+
+        # 空になったクラスタはランダムな点で作り直す
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            sums[empty] = data[rng.choice(len(data), len(empty))]
+
+        centroids = _normalize_rows(sums).astype(np.float32)
+
+    return centroids
+
+
+def assign_lists(embeddings, centroids):
+    """
+    各ベクトルの最も近いクラスタ番号
+    """
+    out = np.empty(len(embeddings), dtype=np.int32)
+    for start in range(0, len(embeddings), SCAN_CHUNK):
+        chunk = np.asarray(embeddings[start:start + SCAN_CHUNK], dtype=np.float32)
+        out[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return out
+
+
+def parse_filters(items):
+    """
+    "category/label=0.3" 形式の指定を {ラベル名: 下限} に変換する
+    """
+    filters = {}
+    for item in items or []:
+        name, _, value = item.rpartition("=")
+        if not name:
+            raise ValueError(f"filter must look like 'category/label=0.3': {item!r}")
+        filters[name] = float(value)
+    return filters
+
+
+def is_current_taxonomy(version):
+    """
+    解析結果の taxonomy バージョンが現在のスナップショットのものか
+    """
+    import taxonomy
+
+    return version is not None and version == taxonomy.current().version
+
+
+# =====
+# インデックス
+# =====
+class EvidenceIndex:
+    """
+    Append-only, memory-mapped index of every analysed sentence.
+
+    Sentences are added per document from text_analyzer.analyze_text()
+    results; queries return the top-k sentences by label score or by
+    similarity to a free-text query, optionally filtered by label scores.
+    """
+
+    def __init__(self, path=evidence_index_dir,
+                 train_size=evidence_index_train_size,
+                 list_size=evidence_index_list_size,
+                 nprobe=evidence_index_nprobe):
+        os.makedirs(os.path.join(path, "scores"), exist_ok=True)
+        os.makedirs(os.path.join(path, "lists"), exist_ok=True)
+
+        self.path = path
+        self.train_size = train_size
+        self.list_size = list_size
+        self.nprobe = nprobe
+        self._lock = threading.RLock()
+
+        self._conn = sqlite3.connect(os.path.join(path, "meta.sqlite3"), check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+
+        info = {r["key"]: r["value"] for r in self._conn.execute("SELECT key, value FROM info")}
+        self.rows = int(info.get("rows", 0))
+        self.dim = int(info["dim"]) if "dim" in info else None
+        self.labels = json.loads(info["labels"]) if "labels" in info else []
+        self.taxonomy_version = info.get("taxonomy_version")
+        self._deleted = np.array(
+            [r[0] for r in self._conn.execute("SELECT row_id FROM sentences WHERE deleted = 1")],
+            dtype=np.int64
+        )
+
+        centroids_file = os.path.join(path, "centroids.npy")
+        self.centroids = np.load(centroids_file) if os.path.exists(centroids_file) else None
+        self._maps = {}
+
+        # クラスタに登録済みの行数（rebuild の要否判定用）
+        self._listed_rows = 0
+        if self.centroids is not None:
+            for c in range(len(self.centroids)):
+                ids_file = self._file("lists", f"{c}.ids")
+                if os.path.exists(ids_file):
+                    self._listed_rows += os.path.getsize(ids_file) // 8
+        self._rebuild_thread = None
+        self._rebuild_lock = threading.Lock()
+
+        # スコア列の taxonomy のラベルベクトル（同じバージョンの文書が登録されるまでは不明）
+        self._label_vectors = None
+        self._relabel_thread = None
+
+    def close(self):
+        if self._relabel_thread is not None:
+            self._relabel_thread.join()
+        if self._rebuild_thread is not None:
+            self._rebuild_thread.join()
+        self._conn.close()
+
+    # === ファイル ===
+    def _file(self, *parts):
+        return os.path.join(self.path, *parts)
+
+    def _append(self, path, array, offset):
+        """
+        追記（未確定の末尾が残っていれば上書きして切り詰める）
+        """
+        with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+            f.seek(offset)
+            f.write(np.ascontiguousarray(array, dtype=DTYPE).tobytes())
+            f.truncate()
+
+    def _memmap(self, key, path, shape):
+        """
+        確定済みの行数分だけメモリマップする（追記のたびに作り直す）
+        """
+        cached = self._maps.get(key)
+        if cached is None or cached.shape != shape:
+            if shape[0] == 0:
+                cached = np.zeros(shape, dtype=DTYPE)
+            else:
+                cached = np.memmap(path, dtype=DTYPE, mode="r", shape=shape)
+            self._maps[key] = cached
+        return cached
+
+    def embeddings(self):
+        return self._memmap("embeddings", self._file("embeddings.f16"), (self.rows, self.dim or 0))
+
+    def score_column(self, name):
+        if name not in self.labels:
+            raise KeyError(f"unknown label {name!r}; expected 'category/label' from {self.labels}")
+        j = self.labels.index(name)
+        return self._memmap(("score", j), self._file("scores", f"{j}.f16"), (self.rows,))
+
+    def _list_arrays(self, c):
+        ids_file = self._file("lists", f"{c}.ids")
+        if not os.path.exists(ids_file) or os.path.getsize(ids_file) == 0:
+            return None, None
+        ids = np.memmap(ids_file, dtype=np.int64, mode="r")
+        emb = np.memmap(self._file("lists", f"{c}.emb"), dtype=DTYPE, mode="r", shape=(len(ids), self.dim))
+        return ids, emb
+
+    def _write_info(self, **values):
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO info VALUES (?, ?)",
+            [(k, v if isinstance(v, str) else json.dumps(v)) for k, v in values.items()]
+        )
+
+    # === 登録 ===
+    def add_document(self, doc_id, analysis):
+        """
+        解析結果の全文をインデックスに登録する。
+        同じ doc_id で本文が同じなら何もせず、異なれば以前の文を置き換える。
+
+        :param doc_id: 文書ID（セッションIDなど）
+        :param analysis: text_analyzer.analyze_text() の結果
+        :return: 追加した文数
+        """
+        sentences = list(analysis["sentences"])
+        names, vectors = label_vectors(analysis["ref_embeddings"])
+        emb = normalize_embeddings(analysis["sentence_embeddings"], vectors.shape[1])
+        scores = emb @ vectors.T
+        text_hash = hashlib.sha1("\n".join(sentences).encode("utf-8")).hexdigest()
+        version = analysis.get("taxonomy_version")
+
+        with self._lock:
+            if self.dim is None:
+                self.dim, self.labels, self.taxonomy_version = vectors.shape[1], names, version
+                self._label_vectors = vectors
+                with self._conn:
+                    self._write_info(dim=self.dim, labels=self.labels, rows=0, taxonomy_version=version or "")
+            elif self.dim != vectors.shape[1]:
+                raise ValueError("embedding dimension differs from the existing index")
+            elif self.labels != names or (version and self.taxonomy_version and version != self.taxonomy_version):
+                # 現在の taxonomy の文書のみ付け替えを始める（旧バージョンの文書では戻さない）
+                if is_current_taxonomy(version):
+                    self.start_relabel(names, vectors, version)
+                # 付け替えが終わるまではインデックス側の taxonomy のスコアで登録する
+                scores = self._index_scores(emb, names, scores)
+            else:
+                self._label_vectors = vectors
+                if version and not self.taxonomy_version:
+                    self.taxonomy_version = version
+                    with self._conn:
+                        self._write_info(taxonomy_version=version)
+
+            existing = self._conn.execute(
+                "SELECT text_hash FROM documents WHERE doc_id = ?", (doc_id,)
+            ).fetchone()
+            if existing is not None and existing["text_hash"] == text_hash:
+                return 0
+
+            # 文ベクトル・スコア列を先に書き、行数の確定は SQLite 側で行う
+            row_start = self.rows
+            self._append(self._file("embeddings.f16"), emb, row_start * self.dim * 2)
+            for j in range(len(self.labels)):
+                self._append(self._file("scores", f"{j}.f16"), scores[:, j], row_start * 2)
+
+            with self._conn:
+                if existing is not None:
+                    old = [r[0] for r in self._conn.execute(
+                        "SELECT row_id FROM sentences WHERE doc_id = ? AND deleted = 0", (doc_id,)
+                    )]
+                    self._conn.execute("UPDATE sentences SET deleted = 1 WHERE doc_id = ?", (doc_id,))
+                    self._deleted = np.union1d(self._deleted, np.asarray(old, dtype=np.int64))
+
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        doc_id,
+                        datetime.now(timezone.utc).isoformat(),
+                        analysis.get("lang"),
+                        text_hash,
+                        row_start,
+                        len(sentences)
+                    )
+                )
+                self._conn.executemany(
+                    "INSERT INTO sentences (row_id, doc_id, sentence_index, text) VALUES (?, ?, ?, ?)",
+                    [(row_start + i, doc_id, i, sent) for i, sent in enumerate(sentences)]
+                )
+                self._write_info(rows=row_start + len(sentences))
+            self.rows = row_start + len(sentences)
+
+            # クラスタ作成済みなら該当クラスタに追記
+            if self.centroids is not None and len(sentences):
+                list_ids = assign_lists(emb, self.centroids)
+                self._append_lists(list_ids, np.arange(row_start, self.rows, dtype=np.int64), emb)
+
+            # クラスタ作成・作り直しはバックグラウンドで行う（リクエストを待たせない）
+            if self.needs_rebuild():
+                self.start_rebuild()
+
+        return len(sentences)
+
+    def _append_lists(self, list_ids, row_ids, emb, lists_dir="lists"):
+        """
+        行をクラスタのファイルに追記する
+
+        :param list_ids: 行ごとのクラスタ番号
+        :param row_ids: 行番号
+        :param emb: 行の文ベクトル
+        """
+        for c in np.unique(list_ids):
+            members = np.flatnonzero(list_ids == c)
+            with open(self._file(lists_dir, f"{c}.ids"), "ab") as f:
+                f.write(row_ids[members].astype(np.int64).tobytes())
+            with open(self._file(lists_dir, f"{c}.emb"), "ab") as f:
+                f.write(np.asarray(emb[members]).astype(DTYPE).tobytes())
+        if lists_dir == "lists":
+            self._listed_rows += len(row_ids)
+
+    def needs_rebuild(self):
+        """
+        クラスタ未作成で学習件数に達した、または1クラスタあたりの平均が目標の2倍を超えた
+        """
+        with self._lock:
+            if self.centroids is None:
+                return self.rows - len(self._deleted) >= self.train_size
+            return self._listed_rows / len(self.centroids) > 2 * self.list_size
+
+    def _index_scores(self, emb, names, scores):
+        """
+        別の taxonomy で解析された文書のスコアを、インデックスのスコア列に合わせる
+
+        :param scores: 文書の taxonomy でのスコア [文数, len(names)]
+        :return: [文数, len(self.labels)]
+        """
+        if self._label_vectors is not None:
+            return emb @ self._label_vectors.T
+
+        # 再起動直後などでベクトルがない場合はラベル名で対応付け（ないラベルは 0）
+        out = np.zeros((len(emb), len(self.labels)), dtype=np.float32)
+        columns = {name: j for j, name in enumerate(names)}
+        for j, name in enumerate(self.labels):
+            if name in columns:
+                out[:, j] = scores[:, columns[name]]
+        return out
+
+    def start_relabel(self, names, vectors, version):
+        """
+        スコア列の付け替えをバックグラウンドで始める（実行中なら何もしない）
+
+        :return: 付け替えのスレッド
+        """
+        with self._lock:
+            if self._relabel_thread is None or not self._relabel_thread.is_alive():
+                self._relabel_thread = threading.Thread(
+                    target=self.relabel, args=(names, vectors, version), name="evidence-relabel", daemon=True
+                )
+                self._relabel_thread.start()
+            return self._relabel_thread
+
+    def relabel(self, names, vectors, version=None):
+        """
+        ラベルのスコア列を、保存済みの文ベクトルから新しい taxonomy で作り直す
+        (書き込み後にディレクトリごと差し替える。文ベクトル・クラスタはそのまま)。
+        大部分はロックの外で計算し、その間に追加された行のみロック中に計算する。
+
+        :param names: label_vectors() のラベル名
+        :param vectors: label_vectors() のベクトル
+        :param version: taxonomy バージョン
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        tmp_dir = self._file("scores.tmp")
+
+        with self._lock:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+            rows = self.rows
+            embeddings = self.embeddings()
+
+        def write_rows(embeddings, start, stop):
+            with ExitStack() as stack:
+                files = [stack.enter_context(open(os.path.join(tmp_dir, f"{j}.f16"), "ab")) for j in range(len(names))]
+                for lo in range(start, stop, SCAN_CHUNK):
+                    hi = min(lo + SCAN_CHUNK, stop)
+                    scores = np.asarray(embeddings[lo:hi], dtype=np.float32) @ vectors.T
+                    for j, f in enumerate(files):
+                        f.write(np.ascontiguousarray(scores[:, j], dtype=DTYPE).tobytes())
+
+        # 確定済みの行（追記のみのため、計算中に変わらない）
+        write_rows(embeddings, 0, rows)
+
+        with self._lock:
+            # 計算中に追加された行
+            write_rows(self.embeddings(), rows, self.rows)
+
+            # 旧スコア列と差し替え（メモリマップも作り直す）
+            self._maps = {k: v for k, v in self._maps.items() if not (isinstance(k, tuple) and k[0] == "score")}
+            old_dir = self._file("scores.old")
+            shutil.rmtree(old_dir, ignore_errors=True)
+            os.replace(self._file("scores"), old_dir)
+            os.replace(tmp_dir, self._file("scores"))
+            shutil.rmtree(old_dir, ignore_errors=True)
+
+            self.labels, self.taxonomy_version = list(names), version
+            self._label_vectors = vectors
+            with self._conn:
+                self._write_info(labels=self.labels, taxonomy_version=version or "")
+
+    def start_rebuild(self, nlist=None):
+        """
+        クラスタの作り直しをバックグラウンドで始める（実行中なら何もしない）
+
+        :return: 作り直しのスレッド
+        """
+        with self._lock:
+            if self._rebuild_thread is None or not self._rebuild_thread.is_alive():
+                self._rebuild_thread = threading.Thread(
+                    target=self.rebuild, args=(nlist,), name="evidence-rebuild", daemon=True
+                )
+                self._rebuild_thread.start()
+            return self._rebuild_thread
+
+    def rebuild(self, nlist=None):
+        """
+        クラスタ（IVF）を作り直す（クラスタ数 = 有効な文数 / list_size）。
+        文数が大きく増えたら実行し、1クラスタあたりの文数を一定に保つ。
+        k-means と書き出しはロックの外で行い、その間に追加された行のみロック中に割り当てる。
+
+        :param nlist: クラスタ数（None の場合は自動）
+        :return: クラスタ数
+        """
+        with self._rebuild_lock:
+            with self._lock:
+                rows = self.rows
+                alive = np.setdiff1d(np.arange(rows, dtype=np.int64), self._deleted)
+                embeddings = self.embeddings()
+            if len(alive) == 0:
+                return 0
+
+            nlist = nlist or max(1, len(alive) // self.list_size)
+            rng = np.random.default_rng(0)
+            sample = np.sort(rng.choice(alive, min(len(alive), nlist * KMEANS_SAMPLES_PER_LIST), replace=False))
+            centroids = spherical_kmeans(np.asarray(embeddings[sample], dtype=np.float32), nlist)
+
+            # 新しいクラスタを別ディレクトリに書いてから差し替える（確定済みの行は計算中に変わらない）
+            list_ids = assign_lists(embeddings, centroids)[alive]
+            tmp_dir = self._file("lists.tmp")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+
+            order = np.argsort(list_ids, kind="stable")
+            bounds = np.searchsorted(list_ids[order], np.arange(len(centroids) + 1))
+            for c in range(len(centroids)):
+                members = alive[order[bounds[c]:bounds[c + 1]]]
+                members.astype(np.int64).tofile(os.path.join(tmp_dir, f"{c}.ids"))
+                np.asarray(embeddings[members], dtype=DTYPE).tofile(os.path.join(tmp_dir, f"{c}.emb"))
+            np.save(self._file("centroids.tmp.npy"), centroids)
+
+            with self._lock:
+                # 計算中に追加された行
+                added = np.arange(rows, self.rows, dtype=np.int64)
+                if len(added):
+                    emb = np.asarray(self.embeddings()[rows:self.rows], dtype=np.float32)
+                    self._append_lists(assign_lists(emb, centroids), added, emb, "lists.tmp")
+
+                shutil.rmtree(self._file("lists"), ignore_errors=True)
+                os.replace(tmp_dir, self._file("lists"))
+                os.replace(self._file("centroids.tmp.npy"), self._file("centroids.npy"))
+
+                self.centroids = centroids
+                self._listed_rows = len(alive) + len(added)
+                with self._conn:
+                    self._write_info(nlist=len(centroids), trained_rows=len(alive))
+                return len(centroids)
+
+    # === 検索 ===
+    def _keep_mask(self, ids, filters):
+        keep = np.ones(len(ids), dtype=bool)
+        if len(self._deleted):
+            keep &= ~np.isin(ids, self._deleted)
+        for name, minimum in (filters or {}).items():
+            keep &= self.score_column(name)[ids] >= minimum
+        return keep
+
+    def _top_k(self, chunks, k, filters):
+        """
+        (文番号, 値) の分割結果から絞り込み後の上位 k 件を選ぶ
+        """
+        best_ids = np.empty(0, dtype=np.int64)
+        best_vals = np.empty(0, dtype=np.float32)
+
+        for ids, values in chunks:
+            keep = self._keep_mask(ids, filters)
+            best_ids = np.concatenate([best_ids, ids[keep]])
+            best_vals = np.concatenate([best_vals, np.asarray(values, dtype=np.float32)[keep]])
+            if len(best_vals) > k:
+                part = np.argpartition(-best_vals, k)[:k]
+                best_ids, best_vals = best_ids[part], best_vals[part]
+
+        order = np.argsort(-best_vals, kind="stable")
+        return best_ids[order], best_vals[order]
+
+    def _results(self, ids, values):
+        if len(ids) == 0:
+            return []
+
+        placeholders = ",".join("?" * len(ids))
+        meta = {
+            r["row_id"]: r
+            for r in self._conn.execute(
+                f"SELECT row_id, doc_id, sentence_index, text FROM sentences WHERE row_id IN ({placeholders})",
+                [int(i) for i in ids]
+            )
+        }
+        columns = {name: self.score_column(name)[ids] for name in self.labels}
+
+        return [
+            {
+                "row_id": int(row_id),
+                "doc_id": meta[int(row_id)]["doc_id"],
+                "sentence_index": meta[int(row_id)]["sentence_index"],
+                "text": meta[int(row_id)]["text"],
+                "score": float(value),
+                "label_scores": {name: float(col[i]) for name, col in columns.items()}
+            }
+            for i, (row_id, value) in enumerate(zip(ids, values))
+        ]
+
+    def query_label(self, label, k=50, filters=None):
+        """
+        ラベルのスコア（参照ベクトルとの類似度）の上位 k 文
+
+        :param label: "category/label"（例: "injunctions/Don't belong"）
+        :param k: 件数
+        :param filters: {"category/label": 下限スコア}
+        :return: 結果辞書のリスト（スコア降順）
+        """
+        with self._lock:
+            column = self.score_column(label)
+            chunks = (
+                (np.arange(start, min(start + SCAN_CHUNK, self.rows), dtype=np.int64),
+                 column[start:start + SCAN_CHUNK])
+                for start in range(0, self.rows, SCAN_CHUNK)
+            )
+            return self._results(*self._top_k(chunks, k, filters))
+
+    def query_vector(self, vector, k=50, filters=None, nprobe=None):
+        """
+        ベクトルとのコサイン類似度の上位 k 文
+        （クラスタ作成前は全件、作成後は近いクラスタのみを走査）
+
+        :param vector: 問い合わせベクトル [次元]
+        :param nprobe: 走査するクラスタ数（None の場合は設定値）
+        """
+        query = np.asarray(vector, dtype=np.float32).reshape(-1)
+        query = query / (np.linalg.norm(query) or 1.0)
+
+        with self._lock:
+            if self.rows == 0:
+                return []
+
+            if self.centroids is None:
+                embeddings = self.embeddings()
+                chunks = (
+                    (np.arange(start, min(start + SCAN_CHUNK, self.rows), dtype=np.int64),
+                     np.asarray(embeddings[start:start + SCAN_CHUNK], dtype=np.float32) @ query)
+                    for start in range(0, self.rows, SCAN_CHUNK)
+                )
+            else:
+                nprobe = min(nprobe or self.nprobe, len(self.centroids))
+                probe = np.argsort(-(self.centroids @ query))[:nprobe]
+                chunks = (
+                    (np.asarray(ids), np.asarray(emb, dtype=np.float32) @ query)
+                    for ids, emb in map(self._list_arrays, probe)
+                    if ids is not None
+                )
+
+            return self._results(*self._top_k(chunks, k, filters))
+
+    def query_text(self, text, k=50, filters=None, nprobe=None, model=None):
+        """
+        自由文を MiniLM でエンコードして検索する
+
+        :param model: エンコーダ（None の場合は load_minilm()）
+        """
+        from text_analyzer import load_minilm, release_minilm
+
+        encoder = model or load_minilm()
+        vector = encoder.encode([text])[0]
+        if model is None:
+            release_minilm(encoder)
+
+        if hasattr(vector, "cpu"):
+            vector = vector.cpu().numpy()
+        return self.query_vector(vector, k, filters, nprobe)
+
+    def stats(self):
+        """
+        件数・クラスタの偏り・ディスク使用量
+        """
+        with self._lock:
+            documents = self._conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+            live = self.rows - len(self._deleted)
+
+            sizes = []
+            if self.centroids is not None:
+                for c in range(len(self.centroids)):
+                    ids_file = self._file("lists", f"{c}.ids")
+                    sizes.append(os.path.getsize(ids_file) // 8 if os.path.exists(ids_file) else 0)
+
+            disk = sum(
+                os.path.getsize(os.path.join(root, name))
+                for root, _, files in os.walk(self.path)
+                for name in files
+            )
+
+            return {
+                "documents": documents,
+                "rows": self.rows,
+                "live_rows": live,
+                "dim": self.dim,
+                "labels": len(self.labels),
+                "taxonomy_version": self.taxonomy_version,
+                "relabeling": self._relabel_thread is not None and self._relabel_thread.is_alive(),
+                "rebuilding": self._rebuild_thread is not None and self._rebuild_thread.is_alive(),
+                "nlist": len(sizes),
+                "list_size": {
+                    "min": min(sizes),
+                    "mean": sum(sizes) / len(sizes),
+                    "max": max(sizes)
+                } if sizes else None,
+                "needs_rebuild": self.needs_rebuild(),
+                "disk_bytes": disk
+            }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MILD-7 corpus-wide evidence search")
+    parser.add_argument("--dir", default=evidence_index_dir)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    query = sub.add_parser("query", help="top-k sentences by label or free text")
+    target = query.add_mutually_exclusive_group(required=True)
+    target.add_argument("--label", help="category/label, e.g. \"injunctions/Don't belong\"")
+    target.add_argument("--text", help="free-text query (encoded with MiniLM)")
+    query.add_argument("-k", type=int, default=50)
+    query.add_argument("--min", action="append", metavar="LABEL=SCORE", help="minimum label score filter")
+    query.add_argument("--nprobe", type=int, default=None)
+
+    sub.add_parser("stats", help="index size and cluster balance")
+    rebuild = sub.add_parser("rebuild", help="re-cluster for the current corpus size")
+    rebuild.add_argument("--nlist", type=int, default=None)
+
+    args = parser.parse_args(argv)
+    index = EvidenceIndex(args.dir)
+
+    if args.command == "query":
+        start = time.perf_counter()
+        try:
+            filters = parse_filters(args.min)
+            if args.label:
+                results = index.query_label(args.label, args.k, filters)
+            else:
+                results = index.query_text(args.text, args.k, filters, args.nprobe)
+        except (KeyError, ValueError) as e:
+            parser.error(e.args[0])
+        elapsed = time.perf_counter() - start
+
+        for r in results:
+            print(f"{r['score']:.3f}\t{r['doc_id']}#{r['sentence_index']}\t{r['text']}")
+        print(f"# {len(results)} results in {elapsed * 1000:.1f} ms")
+
+    elif args.command == "stats":
+        print(json.dumps(index.stats(), indent=2))
+
+    elif args.command == "rebuild":
+        print(json.dumps({"nlist": index.rebuild(args.nlist), **index.stats()}, indent=2))
+
+    index.close()
+
+
+if __name__ == "__main__":
+    main()
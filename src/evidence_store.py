@@ -0,0 +1,167 @@
+"""
+evidence_store
+根拠文（evidence）をコンパクトな配列で保持する
+
+文字列は sentences に1回だけ保持し、ラベルごとの根拠は
+(ラベルID, 文インデックス, スコア) の並列配列で表す。
+payload / expand_payload 形式の辞書は UI・プロンプトに渡す直前にだけ作成する。
+"""
+import numpy as np
+
+
+class EvidenceStore:
+    """
+    Compact evidence for one document.
+
+    Per category, hits are stored as parallel arrays sorted by label then
+    sentence (CSR layout):
+        label_ids   int16   label index of each hit
+        sent_idx    int32   sentence index of each hit
+        scores      float32 score of each hit
+        label_ptr   int64   hits of label j are [label_ptr[j], label_ptr[j + 1])
+        max_values  float32 per-label maximum over all sentences (floored at 0)
+    """
+
+    def __init__(self, sentences):
+        # 文は1回だけ保持する
+        self.sentences = list(sentences)
+        self.categories = {}
+
+    def add_category(self, category, labels, mask, scores):
+        """
+        判定結果（ヒットマスク）から根拠配列を作成して登録する
+
+        :param category: カテゴリ名（injunctions / emotions / drivers）
+        :param labels: ラベル名リスト（列順）
+        :param mask: ヒット判定 [文数, ラベル数] の bool 配列
+        :param scores: スコア [文数, ラベル数]
+        """
+        scores = np.asarray(scores)
+
+        # 転置して nonzero を取るとラベル順 → 文順に並ぶ
+        label_ids, sent_idx = np.nonzero(np.asarray(mask).T)
+        hit_scores = scores[sent_idx, label_ids]
+
+        # ラベルごとの最大値（しきい値に関係なく全文が対象、0.0 を下限とする）
+        if scores.shape[0] > 0:
+            max_values = np.maximum(scores.max(axis=0), 0.0)
+        else:
+            max_values = np.zeros(len(labels))
+
+        self.categories[category] = {
+            "labels": list(labels),
+            "label_index": {k: j for j, k in enumerate(labels)},
+            "label_ids": label_ids.astype(np.int16),
+            "sent_idx": sent_idx.astype(np.int32),
+            "scores": hit_scores.astype(np.float32),
+            "label_ptr": np.searchsorted(label_ids, np.arange(len(labels) + 1)),
+            "max_values": max_values.astype(np.float32),
+        }
+
+    # === 参照 ===
+    def labels(self, category):
+        return self.categories[category]["labels"]
+
+    def hits(self, category, label):
+        """
+        ラベルの根拠（文インデックス配列, スコア配列）を返す（コピーなし）
+        """
+        cat = self.categories[category]
+        j = cat["label_index"][label]
+        start, end = cat["label_ptr"][j], cat["label_ptr"][j + 1]
+        return cat["sent_idx"][start:end], cat["scores"][start:end]
+
+    def count(self, category, label):
+        sent_idx, _ = self.hits(category, label)
+        return len(sent_idx)
+
+    def top_sentences(self, category, label, n=3):
+        """
+        先頭 n 件の根拠文を返す（文の出現順）
+        """
+        sent_idx, _ = self.hits(category, label)
+        return [self.sentences[i] for i in sent_idx[:n]]
+
+    def peak(self, category, label):
+        """
+        最もスコアが高い根拠（スコア, 文）を返す。根拠がなければ None
+        """
+        sent_idx, scores = self.hits(category, label)
+        if len(scores) == 0:
+            return None
+        i = int(np.argmax(scores))
+        return float(scores[i]), self.sentences[sent_idx[i]]
+
+    def aggregates(self, category):
+        """
+        ラベルごとの集計値（合計・件数・平均・最大）を返す
+
+        :return: {label: {"total", "count", "avg", "max"}}
+        """
+        cat = self.categories[category]
+        out = {}
+        for j, label in enumerate(cat["labels"]):
+            _, scores = self.hits(category, label)
+            total = float(scores.sum(dtype=np.float64))
+            count = len(scores)
+            out[label] = {
+                "total": total,
+                "count": count,
+                "avg": total / count if count > 0 else 0.0,
+                "max": float(cat["max_values"][j])
+            }
+        return out
+
+    def nbytes(self):
+        """
+        根拠配列のバイト数（文字列は含まない）
+        """
+        return sum(
+            cat[key].nbytes
+            for cat in self.categories.values()
+            for key in ["label_ids", "sent_idx", "scores", "label_ptr", "max_values"]
+        )
+
+    # === 既存形式の辞書を作成（UI・プロンプト境界でのみ使用） ===
+    def evidence(self, category):
+        """
+        {label: [[sentence, score], ...]} 形式を作成する
+        """
+        out = {}
+        for label in self.labels(category):
+            sent_idx, scores = self.hits(category, label)
+            out[label] = [
+                [self.sentences[i], float(v)]
+                for i, v in zip(sent_idx.tolist(), scores.tolist())
+            ]
+        return out
+
+    def context(self, i, w=1):
+        """
+        文 i の前後 w 文を含めた文脈文字列
+        """
+        start = max(0, i - w)
+        end = min(len(self.sentences), i + w + 1)
+        return " ".join(self.sentences[start:end])
+
+    def expand_payload(self, categories=None, w=1):
+        """
+        {category: {label: [[sentence, score, context], ...]}} 形式を作成する
+        (文脈文字列は文ごとに1回だけ作成)
+
+        :param categories: 対象カテゴリ（省略時は登録順すべて）
+        :param w: 前後何文を含めるか
+        """
+        contexts = {}
+        out = {}
+        for category in categories or self.categories:
+            out[category] = {}
+            for label in self.labels(category):
+                sent_idx, scores = self.hits(category, label)
+                items = []
+                for i, v in zip(sent_idx.tolist(), scores.tolist()):
+                    if i not in contexts:
+                        contexts[i] = self.context(i, w)
+                    items.append([self.sentences[i], float(v), contexts[i]])
+                out[category][label] = items
+        return out
@@ -1,10 +1,51 @@
-from transformers import AutoTokenizer, AutoModelForCausalLM
 import gc
-import torch
+import threading
 import time
-from settings import medgemma_url, gemma_url
+from contextlib import contextmanager, nullcontext
+from settings import medgemma_url, gemma_url, gemma_cleanup_sleep, use_weight_snapshots, shared_base_mode
+from settings import structured_output, kv_cache_mode
+from structured_output import GEMMA_SCHEMA, MEDGEMMA_SCHEMA, schema_instruction, build_logits_processor
 
-def madgemma_engine(prompt):
+# transformers / torch は重いため make_model 内で import する（初回使用時のみ読み込み）
+
+# 生成ごとの実測値の記録先（スレッドごと、track_generation で有効化）
+_usage = threading.local()
+
+
+@contextmanager
+def track_generation():
+    """
+    このスレッドで実行した生成の実測値を集める（入れ子にした場合は外側にも記録される）
+
+    :return: {"engine", "max_new_tokens", "new_tokens", "load_seconds", "generate_seconds"} のリスト
+    """
+    records = []
+    stack = getattr(_usage, "stack", None)
+    if stack is None:
+        stack = _usage.stack = []
+    stack.append(records)
+    try:
+        yield records
+    finally:
+        stack.pop()
+
+
+def record_generation(engine, max_new_tokens, new_tokens, load_seconds, generate_seconds):
+    """
+    1回の生成の実測値を記録する（モデル読み込み時間と生成時間は分けて記録）
+    """
+    record = {
+        "engine": engine,
+        "max_new_tokens": max_new_tokens,
+        "new_tokens": new_tokens,
+        "load_seconds": load_seconds,
+        "generate_seconds": generate_seconds
+    }
+    for records in getattr(_usage, "stack", ()):
+        records.append(record)
+
+
+def madgemma_engine(prompt, max_new_tokens=1000):
     url = medgemma_url
     
     # プロンプト指示作成
@@ -12,13 +53,18 @@ def madgemma_engine(prompt):
         {"role" : "user", "content" : prompt},
     ]
     
-    max_new_tokens = 1000 # 長文説明
+    # max_new_tokens: 長文説明（スケジューラにより短縮される場合あり）
     
+    # 構造化出力: 項目ごとのリスクレベルを JSON で返す
+    if structured_output:
+        messages[0]["content"] += schema_instruction(MEDGEMMA_SCHEMA)
+        return make_model(url, messages, max_new_tokens, schema=MEDGEMMA_SCHEMA)
+
     result = make_model(url, messages, max_new_tokens)
     return result
 
 
-def gemma_engine(prompt):
+def gemma_engine(prompt, max_new_tokens=1000):
     
     # content = "あなたは交流分析の専門家です。"
     content = "You are an expert in Transactional Analysis."
@@ -30,15 +76,20 @@ def gemma_engine(prompt):
         {"role" : "system", "content" : content}, 
         {"role" : "user", "content" : prompt},
     ]
-    max_new_tokens = 1000 # マックストークン
+    # max_new_tokens: マックストークン（スケジューラにより短縮される場合あり）
     
+    # 構造化出力: 0〜2 の3項目と要約を JSON で返す
+    if structured_output:
+        messages[1]["content"] += schema_instruction(GEMMA_SCHEMA)
+        return make_model(url, messages, max_new_tokens, schema=GEMMA_SCHEMA)
+
     # モデル定義と推論
     result = make_model(url, messages, max_new_tokens)
     
     return result
 
 
-def make_model(url, messages, max_new_tokens):
+def make_model(url, messages, max_new_tokens, schema=None, kv_cache=kv_cache_mode):
     """
     Core LLM inference function.
 
@@ -46,21 +97,53 @@ def make_model(url, messages, max_new_tokens):
         url (str): Local path to the pretrained model.
         messages (list): Chat-formatted messages for generation.
         max_new_tokens (int): Maximum number of generated tokens.
+        schema (dict): Optional JSON schema the output is constrained to
+            (see structured_output); the result is then a JSON string.
+        kv_cache (str): KV cache mode (see kv_cache): "default", "quantized"
+            or "offloaded".
 
     Returns:
         str: Generated text response.
     """
+    import torch
+    from transformers import AutoTokenizer, AutoModelForCausalLM, LogitsProcessorList
+    from autotune import gemma_load_config, gemma_model_kwargs, apply_thread_config
+    from kv_cache import cache_generate_kwargs
+
     # === Model Loading ===
-    # モデルロード設定
-    model = AutoModelForCausalLM.from_pretrained(
-        url,
-        device_map="auto",
-        max_memory={0 : "5.5GiB", "cpu" : "16GiB"},
-        torch_dtype=torch.bfloat16,
-        low_cpu_mem_usage=True,
-        attn_implementation="sdpa",
-        local_files_only=True
-    )
+    load_started = time.perf_counter()
+    requested_tokens = max_new_tokens
+    # モデルロード設定（配置・dtype・量子化はマシンプロファイル、なければ既定値）
+    # スレッド数はプロセス全体の設定のため、起動時に設定済みでなければ1回だけ設定する
+    config = gemma_load_config()
+    apply_thread_config()
+
+    # 共有ベースモード: 常駐する Gemma を使い、MedGemma は差分を適用して切り替える（weight_delta.py build）
+    shared = None
+    if shared_base_mode and url in (gemma_url, medgemma_url) and not config["quantization"]:
+        from weight_delta import delta_available, get_shared_models
+        if delta_available():
+            shared = get_shared_models(config)
+
+    # 変換済みスナップショットがあれば mmap で読み込む（weight_snapshot.py convert）
+    snapshot = None
+    if use_weight_snapshots and shared is None:
+        from weight_snapshot import find_snapshot
+        snapshot = find_snapshot(url, config)
+
+    if shared is not None:
+        model = shared.model
+    elif snapshot:
+        from weight_snapshot import load_snapshot
+        model = load_snapshot(snapshot, config["device_map"], config["max_memory"])
+    else:
+        model = AutoModelForCausalLM.from_pretrained(
+            url,
+            **gemma_model_kwargs(config),
+            low_cpu_mem_usage=True,
+            attn_implementation="sdpa",
+            local_files_only=True
+        )
     # MedGemma 推奨の chat template を使ってトークン化
     tokenizer = AutoTokenizer.from_pretrained(
             url,
@@ -78,16 +161,32 @@ def make_model(url, messages, max_new_tokens):
         return_dict=True
     ).to(model.device) # AIが読める形に変換
     
+    # 構造化出力: スキーマに沿わないトークンをマスクする（完結した JSON になる長さまで延長）
+    logits_processor = None
+    if schema is not None:
+        processor = build_logits_processor(tokenizer, schema, max_new_tokens, model.generation_config.eos_token_id)
+        max_new_tokens = processor.max_new_tokens
+        logits_processor = LogitsProcessorList([processor])
+
+    # KV キャッシュの方式（長い会話ではキャッシュがモデル本体並みになるため量子化・退避・窓で抑える）
+    cache_kwargs = cache_generate_kwargs(model, kv_cache)
+
     # === Text Generation ===
-    # AIに文章を生成させる
-    with torch.no_grad():
+    # AIに文章を生成させる（共有ベースの場合は生成中のみ対象モデルに切り替える）
+    engine = "medgemma" if url == medgemma_url else "gemma"
+    variant = shared.use(engine) if shared else nullcontext()
+    generate_started = time.perf_counter()
+    with variant, torch.no_grad():
         outputs = model.generate(
             **input_ids,
             max_new_tokens=max_new_tokens,
             do_sample=False,
             repetition_penalty=1.2,
-            pad_token_id=tokenizer.eos_token_id # 確実に終了判定させる
+            logits_processor=logits_processor,
+            pad_token_id=tokenizer.eos_token_id, # 確実に終了判定させる
+            **cache_kwargs
         )
+    generate_seconds = time.perf_counter() - generate_started
     
     # === Decode output ===
     # 人間が読める文章に戻す
@@ -96,6 +195,11 @@ def make_model(url, messages, max_new_tokens):
         outputs[0][input_len:], 
         skip_special_tokens=True
     )
+    # 実測のトークン数・時間を記録（読み込み時間は生成時間に含めない）
+    record_generation(
+        engine, requested_tokens, int(outputs.shape[-1] - input_len),
+        generate_started - load_started, generate_seconds
+    )
     
     # === Memory cleanup ===
     # テンソル削除
@@ -103,14 +207,21 @@ def make_model(url, messages, max_new_tokens):
     del input_ids
     del model
     
+    # 共有ベースのモデルは常駐させるため、解放・待機は不要
+    if shared is not None:
+        return result
+
     # 解放
     gc.collect()
-    torch.cuda.empty_cache()
-    torch.cuda.synchronize()
-    torch.cuda.ipc_collect()
+    # GPU のない CPU ノードでは synchronize が失敗するため確認する
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+        torch.cuda.synchronize()
+        torch.cuda.ipc_collect()
     
     # Small delay to stabilize GPU memory between consecutive inferences
-    # 数秒スリープを入れる（次のメモリ管理安定のため）
-    time.sleep(2)
+    # 数秒スリープを入れる（次のメモリ管理安定のため、settings.gemma_cleanup_sleep で変更可）
+    if gemma_cleanup_sleep:
+        time.sleep(gemma_cleanup_sleep)
     
     return result
\ No newline at end of file
@@ -0,0 +1,363 @@
+"""
+kv_cache
+Gemma / MedGemma 生成時の KV キャッシュの方式切り替えと、その計測
+
+プロンプトには会話全文と JSON ペイロードが入るため、長いセッションでは
+KV キャッシュ（層数 × 2 × ヘッド数 × トークン数 × 次元）がモデル本体と並ぶ大きさになり、
+同時に動かせる生成の数を制限する。ここでは generate に渡すキャッシュの種類を切り替える。
+- default    モデル既定のキャッシュ（Gemma 3 はローカル層のみ窓で保持するハイブリッド）
+- quantized  KV を int8 / int4 に量子化して保持（直近 kv_cache_residual_length トークンは元の精度）
+             int4 は optimum-quanto、int8 は hqq が必要
+- offloaded  使用中の層以外の KV を CPU メモリに退避（GPU がある場合のみ、CPU のみの環境では default）
+
+全層を窓で保持する方式は置いていない。cache_implementation="sliding_window" は現在の transformers では
+層の種類（layer_types）に従う旧名で、Gemma 3 の default と同じキャッシュになる。
+全層を窓にすると全体注意の層が窓より前を参照できず出力が変わるため、対応しない。
+
+使えない方式は default に戻し、理由を1回だけ表示する。
+出力が default と変わりうるため、bench で最大メモリ・トークン/秒・出力の一致度を確認してから使うこと。
+
+Usage:
+    python kv_cache.py check --model gemma
+    python kv_cache.py bench --model gemma --modes default quantized --max-new-tokens 200
+    python kv_cache.py bench --model medgemma --transcript session.txt
+"""
+import argparse
+import importlib.util
+import json
+import threading
+import time
+from settings import kv_cache_mode, kv_cache_nbits, kv_cache_residual_length
+
+KV_CACHE_MODES = ["default", "quantized", "offloaded"]
+
+# 表示済みのフォールバック理由
+_warned = set()
+
+
+# =====
+# 方式の選択
+# =====
+def text_config(model):
+    """
+    言語モデル部分の config（Gemma 3 のマルチモーダル構成では text_config）
+    """
+    config = model.config
+    return getattr(config, "text_config", None) or config
+
+
+def quant_backend(nbits=kv_cache_nbits):
+    """
+    量子化キャッシュのバックエンド（quanto は 2/4 ビットのみ、8 ビットは HQQ）
+
+    :return: "quanto" / "HQQ" / None（インストールされていない場合）
+    """
+    has_quanto = importlib.util.find_spec("optimum") is not None and \
+        importlib.util.find_spec("optimum.quanto") is not None
+    has_hqq = importlib.util.find_spec("hqq") is not None
+
+    if nbits in (2, 4) and has_quanto:
+        return "quanto"
+    if has_hqq:
+        return "HQQ"
+    return None
+
+
+def resolve_cache_mode(model, mode=kv_cache_mode, nbits=kv_cache_nbits):
+    """
+    このモデル・環境で使えるキャッシュ方式を決める
+
+    :return: (実際に使う方式, default に戻した理由 or None)
+    """
+    import torch
+
+    if mode not in KV_CACHE_MODES:
+        raise ValueError(f"unknown kv cache mode: {mode} (choose from {', '.join(KV_CACHE_MODES)})")
+
+    if mode == "quantized" and quant_backend(nbits) is None:
+        return "default", f"int{nbits} KV cache needs optimum-quanto (2/4 bit) or hqq"
+
+    if mode == "offloaded" and (not torch.cuda.is_available() or model.device.type != "cuda"):
+        return "default", "model is on CPU, the KV cache already lives in host memory"
+
+    return mode, None
+
+
+def cache_generate_kwargs(model, mode=kv_cache_mode, nbits=kv_cache_nbits, residual_length=kv_cache_residual_length):
+    """
+    generate に渡すキャッシュ設定
+
+    :return: {"cache_implementation", "cache_config"}（default の場合は空）
+    """
+    resolved, reason = resolve_cache_mode(model, mode, nbits)
+    if reason and (mode, reason) not in _warned:
+        _warned.add((mode, reason))
+        print(f"KV cache mode '{mode}' unavailable ({reason}); using default")
+
+    if resolved == "quantized":
+        return {
+            "cache_implementation": "quantized",
+            "cache_config": {
+                "backend": quant_backend(nbits),
+                "nbits": nbits,
+                "residual_length": residual_length
+            }
+        }
+    if resolved == "offloaded":
+        return {"cache_implementation": "offloaded"}
+    return {}
+
+
+def kv_bytes_per_token(model):
+    """
+    default キャッシュ1トークンあたりの KV のバイト数（全層を保持した場合の目安）
+    """
+    config = text_config(model)
+    heads = getattr(config, "num_key_value_heads", None) or config.num_attention_heads
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+    return 2 * config.num_hidden_layers * heads * head_dim * model.dtype.itemsize
+
+
+# =====
+# 計測
+# =====
+class PeakMemory:
+    """
+    with ブロック内の最大メモリ増加量（GPU は allocator の最大値、CPU は RSS を標本化）
+    CPU では前の生成で確保済みの領域が再利用されるため、2回目以降は小さめに出ることがある
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak_bytes = 0
+
+    def __enter__(self):
+        import psutil
+        import torch
+
+        self._cuda = torch.cuda.is_available()
+        if self._cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            self._base = torch.cuda.memory_allocated()
+            return self
+
+        self._process = psutil.Process()
+        self._base = self._process.memory_info().rss
+        self._peak = self._base
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self._peak = max(self._peak, self._process.memory_info().rss)
+            time.sleep(self.interval)
+
+    def __exit__(self, *exc):
+        import torch
+
+        if self._cuda:
+            torch.cuda.synchronize()
+            self.peak_bytes = torch.cuda.max_memory_allocated() - self._base
+        else:
+            self._stop.set()
+            self._thread.join()
+            self._peak = max(self._peak, self._process.memory_info().rss)
+            self.peak_bytes = self._peak - self._base
+        return False
+
+
+def generate_with_cache(model, tokenizer, messages, max_new_tokens, mode):
+    """
+    make_model と同じ生成設定で1回生成し、最大メモリと速度を計測する
+
+    :return: {"mode", "token_ids", "text", "prompt_tokens", "new_tokens", "seconds", "tokens_per_second", "peak_bytes"}
+    """
+    import gc
+    import torch
+
+    inputs = tokenizer.apply_chat_template(
+        messages,
+        add_generation_prompt=True,
+        return_tensors="pt",
+        return_dict=True
+    ).to(model.device)
+    input_len = inputs["input_ids"].shape[-1]
+    cache_kwargs = cache_generate_kwargs(model, mode)
+
+    gc.collect()
+    with PeakMemory() as memory, torch.no_grad():
+        start = time.perf_counter()
+        outputs = model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            repetition_penalty=1.2,
+            pad_token_id=tokenizer.eos_token_id,
+            **cache_kwargs
+        )
+        seconds = time.perf_counter() - start
+
+    token_ids = outputs[0][input_len:].tolist()
+    del outputs
+    return {
+        "mode": mode,
+        "cache_implementation": cache_kwargs.get("cache_implementation", "default"),
+        "token_ids": token_ids,
+        "text": tokenizer.decode(token_ids, skip_special_tokens=True),
+        "prompt_tokens": int(input_len),
+        "new_tokens": len(token_ids),
+        "seconds": seconds,
+        "tokens_per_second": len(token_ids) / seconds if seconds else None,
+        "peak_bytes": int(memory.peak_bytes)
+    }
+
+
+def output_divergence(reference, candidate):
+    """
+    default キャッシュの出力との一致度（貪欲法なので一致するのが理想）
+
+    :return: {"first_divergence", "token_agreement", "text_equal"}
+        first_divergence は最初に異なるトークンの位置（一致する場合は None）
+    """
+    first = None
+    for i, (a, b) in enumerate(zip(reference, candidate)):
+        if a != b:
+            first = i
+            break
+    if first is None and len(reference) != len(candidate):
+        first = min(len(reference), len(candidate))
+
+    longest = max(len(reference), len(candidate), 1)
+    matched = sum(a == b for a, b in zip(reference, candidate))
+    return {
+        "first_divergence": first,
+        "token_agreement": matched / longest,
+        "text_equal": first is None
+    }
+
+
+def load_prompt(url, transcript=None):
+    """
+    実運用と同じ形のプロンプト（会話全文 + MiniLM のペイロード）を作る
+
+    :param transcript: 会話テキストのファイル（省略時は疑似的な長い会話）
+    :return: チャット形式のメッセージ
+    """
+    from settings import medgemma_url
+    from backend import run_minilm_stage
+    from text_analyzer import build_medgemma_payload
+
+    if transcript:
+        with open(transcript, encoding="utf-8") as f:
+            text = f.read()
+    else:
+        from loadtest import synthetic_corpus
+        text = synthetic_corpus(1, min_sentences=80, max_sentences=80)[0][1]
+
+    gemma_prompt, _, expand_payload, _ = run_minilm_stage(text)
+    if url == medgemma_url:
+        return [{"role": "user", "content": build_medgemma_payload(text, expand_payload)}]
+    return [
+        {"role": "system", "content": "You are an expert in Transactional Analysis."},
+        {"role": "user", "content": gemma_prompt}
+    ]
+
+
+def benchmark_kv_cache(url, modes=KV_CACHE_MODES, transcript=None, max_new_tokens=200):
+    """
+    キャッシュ方式ごとに同じプロンプトで生成し、最大メモリ・トークン/秒・出力の一致度を比較する
+    （モデルは1回だけ読み込む、一致度は default との比較）
+
+    :return: 計測結果
+    """
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+    from autotune import gemma_load_config, gemma_model_kwargs, apply_threads
+
+    config = gemma_load_config()
+    apply_threads(config["threads"])
+    model = AutoModelForCausalLM.from_pretrained(
+        url,
+        **gemma_model_kwargs(config),
+        low_cpu_mem_usage=True,
+        attn_implementation="sdpa",
+        local_files_only=True
+    )
+    tokenizer = AutoTokenizer.from_pretrained(url, local_files_only=True)
+    messages = load_prompt(url, transcript)
+
+    # default を最初に実行して基準にする（初回のウォームアップも兼ねて1回捨てる）
+    modes = ["default"] + [m for m in modes if m != "default"]
+    generate_with_cache(model, tokenizer, messages, 8, "default")
+
+    runs = {}
+    for mode in modes:
+        resolved, reason = resolve_cache_mode(model, mode)
+        if reason:
+            runs[mode] = {"mode": mode, "skipped": reason}
+            continue
+        runs[mode] = generate_with_cache(model, tokenizer, messages, max_new_tokens, mode)
+
+    reference = runs["default"]
+    results = []
+    for mode, run in runs.items():
+        if "skipped" in run:
+            results.append(run)
+            continue
+        results.append({
+            **{k: v for k, v in run.items() if k not in ("token_ids", "text")},
+            "peak_mb": run["peak_bytes"] / 2**20,
+            "peak_vs_default": run["peak_bytes"] / reference["peak_bytes"] if reference["peak_bytes"] else None,
+            **output_divergence(reference["token_ids"], run["token_ids"])
+        })
+
+    return {
+        "model": url,
+        "prompt_tokens": reference["prompt_tokens"],
+        "max_new_tokens": max_new_tokens,
+        "kv_mb_per_1k_tokens": kv_bytes_per_token(model) * 1000 / 2**20,
+        "nbits": kv_cache_nbits,
+        "results": results
+    }
+
+
+def main(argv=None):
+    from weight_snapshot import resolve_model
+
+    parser = argparse.ArgumentParser(description="MILD-7 KV cache modes")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    check = sub.add_parser("check", help="which KV cache modes this model / machine supports")
+    check.add_argument("--model", required=True, help="gemma / medgemma / model path")
+
+    bench = sub.add_parser("bench", help="peak memory, tokens/sec and output divergence per mode")
+    bench.add_argument("--model", required=True, help="gemma / medgemma / model path")
+    bench.add_argument("--modes", nargs="+", choices=KV_CACHE_MODES, default=KV_CACHE_MODES)
+    bench.add_argument("--transcript", default=None, help="transcript text file (default: synthetic)")
+    bench.add_argument("--max-new-tokens", type=int, default=200)
+
+    args = parser.parse_args(argv)
+    url = resolve_model(args.model)
+
+    if args.command == "check":
+        import torch
+        from transformers import AutoConfig, AutoModelForCausalLM
+
+        # 重みを読み込まずに meta 上で構築して判定する
+        with torch.device("meta"):
+            model = AutoModelForCausalLM.from_config(AutoConfig.from_pretrained(url, local_files_only=True))
+        result = {}
+        for mode in KV_CACHE_MODES:
+            resolved, reason = resolve_cache_mode(model, mode)
+            result[mode] = {"available": reason is None, "reason": reason}
+        print(json.dumps({"model": url, "kv_mb_per_1k_tokens": kv_bytes_per_token(model) * 1000 / 2**20,
+                          "modes": result}, indent=2))
+
+    elif args.command == "bench":
+        print(json.dumps(benchmark_kv_cache(url, args.modes, args.transcript, args.max_new_tokens), indent=2))
+
+
+if __name__ == "__main__":
+    main()
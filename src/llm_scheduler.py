@@ -0,0 +1,353 @@
+"""
+llm_scheduler
+MiniLM 層の結果をもとに Gemma / MedGemma の実行順・長さ・優先度を決める
+
+- 高リスク（"Don't exist" の強い反応、孤独・否定感情など）は MedGemma を先に実行し、キューの先頭に入れる
+- 反応がほとんどない文書は生成トークン数を短縮し、キューでは後回しにする
+- 判定内容はすべて監査ログ（JSON Lines）に記録する
+"""
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from front_score_totalling import get_peak, strength_max_score
+from gemmas_engine import track_generation
+from settings import scheduler_policy, scheduler_audit_path
+
+# 優先度（小さいほど先に実行）
+TIER_PRIORITY = {"high": 0, "normal": 1, "low": 2}
+
+
+def policy_version(policy):
+    """
+    ポリシー内容のハッシュ（監査ログで判定基準を特定するため）
+    """
+    raw = json.dumps(policy, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:12]
+
+
+def assess_signals(payload, expand_payload, policy=scheduler_policy):
+    """
+    MiniLM 層の結果からリスク・シグナル強度を評価する
+
+    :param payload: text_analyzer の payload
+    :param expand_payload: text_analyzer の expand_payload
+    :param policy: スケジューラポリシー
+    :return: {"risk_score", "signal_peak", "reasons"}
+    """
+    level_points = policy["level_points"]
+
+    risk_score = 0.0
+    signal_peak = 0.0
+    reasons = []
+
+    for category, items in payload.items():
+        if category not in expand_payload:
+            continue
+
+        weights = policy["risk_labels"].get(category, {})
+        for item in items:
+            entries = expand_payload[category][item["label"]]
+            if not entries:
+                continue
+
+            # ラベルごとの最大スコアとそのレベル（front_score_totalling と同じ基準）
+            peak_score, _ = get_peak(entries)
+            signal_peak = max(signal_peak, peak_score)
+
+            weight = weights.get(item["label"], 0.0)
+            if weight <= 0:
+                continue
+
+            level = strength_max_score(peak_score)
+            points = weight * level_points.get(level, 0)
+            if points > 0:
+                risk_score += points
+                reasons.append(
+                    f"{category}/{item['label']}: {level} ({peak_score:.2f}) x {weight} = {points:.2f}"
+                )
+
+    return {
+        "risk_score": risk_score,
+        "signal_peak": signal_peak,
+        "reasons": reasons
+    }
+
+
+def plan_llm_run(assessment, policy=scheduler_policy):
+    """
+    評価結果から LLM の実行計画を作成する
+
+    :param assessment: assess_signals() の結果
+    :param policy: スケジューラポリシー
+    :return: {"tier", "priority", "order", "max_new_tokens", "defer"}
+    """
+    if assessment["risk_score"] >= policy["high_risk_score"]:
+        tier = "high"
+    elif assessment["signal_peak"] < policy["low_signal_peak"]:
+        tier = "low"
+    else:
+        tier = "normal"
+
+    # 高リスクは臨床リスク評価（MedGemma）を先に実行
+    order = ["medgemma", "gemma"] if tier == "high" else ["gemma", "medgemma"]
+
+    return {
+        "tier": tier,
+        "priority": TIER_PRIORITY[tier],
+        "order": order,
+        "max_new_tokens": dict(policy["max_new_tokens"][tier]),
+        "defer": tier == "low" and policy["defer_low_signal"]
+    }
+
+
+def write_audit(record, path=scheduler_audit_path):
+    """
+    判定内容を監査ログに追記する
+
+    :param record: 記録内容（辞書）
+    :param path: 監査ログのパス（None の場合は記録しない）
+    """
+    if not path:
+        return
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def schedule(job_id, payload, expand_payload, policy=scheduler_policy, audit_path=scheduler_audit_path):
+    """
+    1文書分の評価・計画作成・監査ログ記録をまとめて行う
+
+    :return: 実行計画（assessment を含む）
+    """
+    assessment = assess_signals(payload, expand_payload, policy)
+    plan = plan_llm_run(assessment, policy)
+    plan["assessment"] = assessment
+
+    write_audit({
+        "at": datetime.now(timezone.utc).isoformat(),
+        "job_id": job_id,
+        "policy_version": policy_version(policy),
+        "tier": plan["tier"],
+        "order": plan["order"],
+        "max_new_tokens": plan["max_new_tokens"],
+        "defer": plan["defer"],
+        **assessment
+    }, audit_path)
+
+    return plan
+
+
+def summarize_usage(records, policy=scheduler_policy):
+    """
+    生成の実測値から LLM 時間・短縮量を集計する
+
+    1トークンあたりの時間は実測の生成時間 / 生成トークン数（モデル読み込み時間は含めない）。
+    短縮量は短縮実行（max_new_tokens が全長未満）ごとに、全長実行で実際に生成された
+    平均トークン数（エンジン別）との差を合計する。全長実行の実測がないエンジンは推定しない。
+    後回しのまま未実行のジョブは実行していないだけのため、短縮量には含めない。
+
+    :param records: {"engine", "max_new_tokens", "new_tokens", "load_seconds", "generate_seconds"} のリスト
+        （gemmas_engine.track_generation の記録）
+    :param policy: スケジューラポリシー（全長の max_new_tokens）
+    :return: 集計結果
+    """
+    full_budget = policy["max_new_tokens"]["normal"]
+
+    full_tokens = {}
+    shortened = []
+    for r in records:
+        if r["max_new_tokens"] >= full_budget.get(r["engine"], 0):
+            full_tokens.setdefault(r["engine"], []).append(r["new_tokens"])
+        else:
+            shortened.append(r)
+    full_mean = {engine: sum(v) / len(v) for engine, v in full_tokens.items()}
+
+    new_tokens = sum(r["new_tokens"] for r in records)
+    generate_seconds = sum(r["generate_seconds"] for r in records)
+    per_token = generate_seconds / new_tokens if new_tokens else None
+
+    tokens_saved = None
+    if shortened and all(r["engine"] in full_mean for r in shortened):
+        tokens_saved = sum(max(0.0, full_mean[r["engine"]] - r["new_tokens"]) for r in shortened)
+    elif not shortened:
+        tokens_saved = 0.0
+
+    return {
+        "generations": len(records),
+        "shortened_generations": len(shortened),
+        "new_tokens": new_tokens,
+        "generate_seconds": generate_seconds,
+        "load_seconds": sum(r["load_seconds"] for r in records),
+        "seconds_per_token": per_token,
+        "full_length_mean_tokens": full_mean,
+        "tokens_saved": tokens_saved,
+        "estimated_seconds_saved": (
+            tokens_saved * per_token if tokens_saved is not None and per_token is not None else None
+        )
+    }
+
+
+class LLMScheduler:
+    """
+    Priority queue for the LLM stage.
+
+    submit() runs the cheap MiniLM stage immediately and queues the LLM
+    stage by risk tier; run_next() executes the most urgent job. Low-signal
+    jobs are deferred until run_deferred() (or drain(include_deferred=True)).
+    enqueue() queues a job whose plan was made elsewhere (batch_runner).
+
+    The stage functions are injectable so stand-in models can be used.
+    report() is based on the measured generations of the executed jobs.
+    """
+
+    def __init__(self, minilm_stage=None, llm_stage=None, policy=scheduler_policy, audit_path=scheduler_audit_path):
+        self.minilm_stage = minilm_stage
+        self.llm_stage = llm_stage
+        self.policy = policy
+        self.audit_path = audit_path
+
+        self._queue = []
+        self._deferred = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+        # LLM 時間の集計（usage は実行した生成ごとの実測値）
+        self.stats = {
+            "jobs": 0,
+            "executed": 0,
+            "llm_seconds": 0.0, # 実行したジョブの経過時間（モデル読み込みを含む）
+            "by_tier": {tier: 0 for tier in TIER_PRIORITY}
+        }
+        self._usage = []
+
+    def submit(self, job_id, text):
+        """
+        MiniLM 層を実行し、LLM 層をキューに入れる
+
+        :return: 実行計画
+        """
+        if self.minilm_stage is None or self.llm_stage is None:
+            from backend import run_minilm_stage, run_llm_stage
+            self.minilm_stage = self.minilm_stage or run_minilm_stage
+            self.llm_stage = self.llm_stage or run_llm_stage
+
+        gemma_prompt, payload, expand_payload, analysis = self.minilm_stage(text)
+        plan = schedule(job_id, payload, expand_payload, self.policy, self.audit_path)
+
+        def run():
+            medgemma_result, gemma_result = self.llm_stage(text, gemma_prompt, expand_payload, plan)
+            return {"medgemma_result": medgemma_result, "gemma_result": gemma_result, "payload": payload}
+
+        self.enqueue(job_id, plan, run)
+        return plan
+
+    def enqueue(self, job_id, plan, run):
+        """
+        実行計画の決まったジョブをキューに入れる
+
+        :param plan: 実行計画（None の場合は normal 扱いで後回しにしない）
+        :param run: LLM 層を実行する引数なしの関数（戻り値は結果辞書）
+        """
+        tier = plan["tier"] if plan else "normal"
+        job = {
+            "job_id": job_id,
+            "tier": tier,
+            "run": run,
+            "submitted_at": time.perf_counter()
+        }
+
+        with self._lock:
+            self.stats["jobs"] += 1
+            self.stats["by_tier"][tier] += 1
+            if plan and plan["defer"]:
+                self._deferred.append(job)
+            else:
+                priority = plan["priority"] if plan else TIER_PRIORITY["normal"]
+                heapq.heappush(self._queue, (priority, next(self._seq), job))
+
+    def pending(self):
+        with self._lock:
+            return len(self._queue), len(self._deferred)
+
+    def deferred_ids(self):
+        """
+        後回しのまま未実行のジョブID
+        """
+        with self._lock:
+            return [job["job_id"] for job in self._deferred]
+
+    def run_next(self):
+        """
+        最も優先度の高いジョブの LLM 層を実行する
+
+        :return: 結果辞書（キューが空なら None）
+        """
+        with self._lock:
+            if not self._queue:
+                return None
+            _, _, job = heapq.heappop(self._queue)
+
+        return self._run(job)
+
+    def run_deferred(self):
+        """
+        後回しにしたジョブをすべて実行する
+        """
+        with self._lock:
+            jobs, self._deferred = self._deferred, []
+
+        return [self._run(job) for job in jobs]
+
+    def drain(self, include_deferred=False):
+        """
+        キューが空になるまで実行する
+        """
+        results = []
+        while True:
+            result = self.run_next()
+            if result is None:
+                break
+            results.append(result)
+
+        if include_deferred:
+            results.extend(self.run_deferred())
+        return results
+
+    def _run(self, job):
+        started = time.perf_counter()
+        with track_generation() as usage:
+            output = job["run"]()
+        elapsed = time.perf_counter() - started
+
+        with self._lock:
+            self.stats["executed"] += 1
+            self.stats["llm_seconds"] += elapsed
+            self._usage.extend(dict(r, tier=job["tier"]) for r in usage)
+
+        return {
+            "job_id": job["job_id"],
+            "tier": job["tier"],
+            "queue_seconds": started - job["submitted_at"],
+            "llm_seconds": elapsed,
+            "usage": usage,
+            **(output or {})
+        }
+
+    def report(self):
+        """
+        LLM 時間の削減量を報告する（実測の生成時間・トークン数から集計、summarize_usage を参照）
+        """
+        with self._lock:
+            stats = dict(self.stats, by_tier=dict(self.stats["by_tier"]))
+            stats["deferred_pending"] = len(self._deferred)
+            usage = list(self._usage)
+
+        stats.update(summarize_usage(usage, self.policy))
+        return stats
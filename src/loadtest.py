@@ -0,0 +1,381 @@
+"""
+loadtest
+複数カウンセラーが同時に Analyze を実行した場合の負荷試験
+
+会話テキストのコーパスを backend.main（またはHTTPのフロントエンド）に同時実行数・到着率を指定して送り、
+スループット・段階ごとの p50 / p95 / p99・キュー待ち時間・ピークメモリを報告する。
+
+- 既定ではスタンドインモデル（standin_models）でオフライン実行する。
+  LLM の同時実行数は --devices（GPU 台数に相当）までに制限され、超えた分は待機する
+- --rate を指定するとポアソン到着（開放型）、指定しない場合は各ユーザーが連続して送る（閉鎖型）
+- ストア類（settings.DATA_DIR 以下）は --workdir（既定は一時ディレクトリ）に作成し、本番のデータを汚さない
+
+Usage:
+    python loadtest.py --concurrency 5 --requests 50
+    python loadtest.py --corpus transcripts/ --concurrency 5 --rate 0.5 --requests 100
+    python loadtest.py --url http://localhost:8000/analyze --concurrency 5
+"""
+import argparse
+import json
+import os
+import queue
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import psutil
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# メモリ使用量の計測間隔（秒）
+MEMORY_SAMPLE_SECONDS = 0.05
+
+PERCENTILES = [50, 95, 99]
+
+# 要求ごとの段階時間の記録先（スレッドごと）
+_current = threading.local()
+
+
+# =====
+# コーパス
+# =====
+def synthetic_corpus(n_docs=50, seed=0, min_sentences=20, max_sentences=80):
+    """
+    参照DBの英文を組み合わせた疑似的な会話テキスト
+
+    :return: [(doc_id, text)]
+    """
+    from taxonomy import definition_texts
+
+    pool = definition_texts("en")
+    rng = random.Random(seed)
+    return [
+        (f"synthetic-{i}", " ".join(rng.choice(pool) for _ in range(rng.randint(min_sentences, max_sentences))))
+        for i in range(n_docs)
+    ]
+
+
+def load_corpus(path):
+    """
+    .txt を含むディレクトリ、または {"id", "text"} の JSON Lines を読み込む（batch_runner と同じ形式）
+
+    :return: [(doc_id, text)]
+    """
+    from batch_runner import iter_input, load_text
+
+    return [
+        (doc_id, load_text({"source": source, "text": text}))
+        for doc_id, source, text in iter_input(path)
+    ]
+
+
+# =====
+# 送信先
+# =====
+def _record_stage(stage, seconds):
+    timings = getattr(_current, "timings", None)
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+def use_workdir(workdir=None, prefix="mild7-loadtest-"):
+    """
+    ストア類の保存先（settings.DATA_DIR）を作業ディレクトリに切り替える（settings の読み込み前に呼ぶ）
+
+    :param workdir: 作業ディレクトリ（省略時は一時ディレクトリ）
+    :return: 作業ディレクトリ
+    """
+    workdir = os.path.abspath(workdir or tempfile.mkdtemp(prefix=prefix))
+    data_dir = os.path.join(workdir, "data")
+    settings = sys.modules.get("settings")
+    if settings is not None and settings.DATA_DIR != data_dir:
+        raise RuntimeError("settings was imported before the work directory was set")
+
+    os.makedirs(workdir, exist_ok=True)
+    os.environ["MILD7_DATA_DIR"] = data_dir
+    sys.path.insert(0, BASE_DIR)
+    os.chdir(workdir)
+    return workdir
+
+
+def backend_target(standin=True):
+    """
+    backend.main を呼び出す送信先（段階ごとの時間は backend.stage_listeners から取得）
+
+    :return: target(doc_id, text, session_id) -> {stage: seconds}
+    """
+    import backend
+
+    if standin:
+        from standin_models import install_standin_models
+        install_standin_models()
+    else:
+        from autotune import apply_thread_config
+        apply_thread_config()
+
+    if _record_stage not in backend.stage_listeners:
+        backend.stage_listeners.append(_record_stage)
+
+    def target(doc_id, text, session_id):
+        _current.timings = {}
+        try:
+            backend.main(text, client_id="loadtest" if session_id else None, session_id=session_id)
+            return _current.timings
+        finally:
+            _current.timings = None
+
+    return target
+
+
+def http_target(url, timeout=600):
+    """
+    HTTP のフロントエンドに {"text", "session_id"} を POST する送信先。
+    応答の JSON に "stage_seconds" があれば段階ごとの時間として使用する
+
+    :return: target(doc_id, text, session_id) -> {stage: seconds}
+    """
+    import urllib.request
+
+    def target(doc_id, text, session_id):
+        body = json.dumps({"text": text, "session_id": session_id}).encode("utf-8")
+        request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            raw = response.read()
+
+        try:
+            return dict(json.loads(raw).get("stage_seconds", {}))
+        except (ValueError, AttributeError):
+            return {}
+
+    return target
+
+
+# =====
+# 計測
+# =====
+class MemorySampler:
+    """
+    Background thread that tracks the peak RSS of this process.
+    """
+
+    def __init__(self, interval=MEMORY_SAMPLE_SECONDS):
+        self.interval = interval
+        self._process = psutil.Process()
+        self._stop = threading.Event()
+        self.start_rss = self._process.memory_info().rss
+        self.peak_rss = self.start_rss
+        self._thread = threading.Thread(target=self._run, name="loadtest-memory", daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_rss = max(self.peak_rss, self._process.memory_info().rss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, self._process.memory_info().rss)
+
+
+def percentiles(values):
+    """
+    p50 / p95 / p99（最近傍順位法）と最大値
+    """
+    if not values:
+        return None
+
+    ordered = sorted(values)
+    out = {}
+    for p in PERCENTILES:
+        rank = max(1, -(-p * len(ordered) // 100))
+        out[f"p{p}"] = ordered[rank - 1]
+    out["max"] = ordered[-1]
+    out["mean"] = sum(ordered) / len(ordered)
+    return out
+
+
+def run_loadtest(target, corpus, n_requests=20, concurrency=5, rate=None, seed=0, session_ids=False):
+    """
+    負荷試験を実行する
+
+    :param target: backend_target() / http_target() の戻り値
+    :param corpus: [(doc_id, text)]（先頭から順に繰り返し送る）
+    :param n_requests: 送信する要求数
+    :param concurrency: 同時実行数（同時に操作するユーザー数）
+    :param rate: 平均到着率（件/秒、ポアソン到着）。None の場合は閉鎖型（各ユーザーが連続して送る）
+    :param session_ids: 要求ごとにセッションIDを付ける（セッション履歴の保存も含めて計測）
+    :return: 要求ごとの記録のリスト
+    """
+    rng = random.Random(seed)
+    arrivals = queue.Queue()
+    records = []
+    lock = threading.Lock()
+    t0 = time.perf_counter()
+
+    def execute(i, arrived):
+        doc_id, text = corpus[i % len(corpus)]
+        started = time.perf_counter()
+        record = {
+            "request": i,
+            "doc_id": doc_id,
+            "arrived": arrived - t0,
+            "queue_seconds": started - arrived
+        }
+        try:
+            record["stages"] = target(doc_id, text, f"loadtest-{i}" if session_ids else None)
+            record["ok"] = True
+        except Exception as e:
+            record["stages"] = {}
+            record["ok"] = False
+            record["error"] = repr(e)
+        record["latency_seconds"] = time.perf_counter() - started
+        record["total_seconds"] = time.perf_counter() - arrived
+
+        with lock:
+            records.append(record)
+
+    if rate:
+        # 開放型：到着時刻はユーザーの処理状況と無関係。空きがなければキューで待つ
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="loadtest") as pool:
+            next_at = t0
+            for i in range(n_requests):
+                next_at += rng.expovariate(rate)
+                time.sleep(max(0.0, next_at - time.perf_counter()))
+                pool.submit(execute, i, time.perf_counter())
+    else:
+        # 閉鎖型：各ユーザーが結果を受け取ったらすぐ次を送る
+        for i in range(n_requests):
+            arrivals.put(i)
+
+        def user():
+            while True:
+                try:
+                    i = arrivals.get_nowait()
+                except queue.Empty:
+                    return
+                execute(i, time.perf_counter())
+
+        users = [threading.Thread(target=user, name=f"loadtest-{u}") for u in range(concurrency)]
+        for u in users:
+            u.start()
+        for u in users:
+            u.join()
+
+    return sorted(records, key=lambda r: r["request"])
+
+
+def summarize(records, wall_seconds, memory=None):
+    """
+    スループット・段階ごとのパーセンタイル・キュー待ち時間・ピークメモリを集計する
+    """
+    ok = [r for r in records if r["ok"]]
+
+    stages = {}
+    for r in ok:
+        for stage, seconds in r["stages"].items():
+            stages.setdefault(stage, []).append(seconds)
+
+    summary = {
+        "requests": len(records),
+        "errors": len(records) - len(ok),
+        "wall_seconds": wall_seconds,
+        "throughput_per_sec": len(ok) / wall_seconds if wall_seconds else None,
+        "latency_seconds": percentiles([r["latency_seconds"] for r in ok]),
+        "queue_seconds": percentiles([r["queue_seconds"] for r in records]),
+        "total_seconds": percentiles([r["total_seconds"] for r in ok]),
+        "stages": {stage: percentiles(values) for stage, values in stages.items()}
+    }
+    if memory is not None:
+        summary["memory"] = {
+            "start_rss_mb": memory.start_rss / 2**20,
+            "peak_rss_mb": memory.peak_rss / 2**20,
+            "growth_mb": (memory.peak_rss - memory.start_rss) / 2**20
+        }
+
+    errors = sorted({r["error"] for r in records if not r["ok"]})
+    if errors:
+        summary["error_samples"] = errors[:5]
+    return summary
+
+
+def print_summary(summary):
+    print(f"requests {summary['requests']}  errors {summary['errors']}  "
+          f"wall {summary['wall_seconds']:.2f}s  throughput {summary['throughput_per_sec'] or 0:.2f}/s")
+    if "memory" in summary:
+        m = summary["memory"]
+        print(f"memory  start {m['start_rss_mb']:.0f} MB  peak {m['peak_rss_mb']:.0f} MB  (+{m['growth_mb']:.0f} MB)")
+
+    print(f"\n{'':<16}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    rows = [("latency", summary["latency_seconds"]), ("queue", summary["queue_seconds"])]
+    rows += [(f"  {stage}", values) for stage, values in summary["stages"].items()]
+    for name, values in rows:
+        if values:
+            print(f"{name:<16}" + "".join(f"{values[k]:>10.3f}" for k in ["p50", "p95", "p99", "max"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MILD-7 concurrent-user load test")
+    parser.add_argument("--corpus", help="directory of .txt files or JSON Lines (default: synthetic)")
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=5)
+    parser.add_argument("--rate", type=float, default=None, help="Poisson arrival rate (requests/sec)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--session-ids", action="store_true", help="attach session ids (exercises the longitudinal store)")
+    parser.add_argument("--url", help="POST to an HTTP front-end instead of calling backend.main")
+    parser.add_argument("--real", action="store_true", help="use the real models instead of stand-ins")
+    parser.add_argument("--devices", type=int, default=1, help="stand-in: concurrent LLM slots")
+    parser.add_argument("--load-seconds", type=float, default=0.0, help="stand-in: model load time per LLM call")
+    parser.add_argument("--seconds-per-token", type=float, default=None, help="stand-in: generation time per token")
+    parser.add_argument("--workdir", help="working directory for the data stores (default: temporary)")
+    parser.add_argument("--json", help="write summary and per-request records to this file")
+
+    args = parser.parse_args(argv)
+    json_path = os.path.abspath(args.json) if args.json else None
+    corpus_path = os.path.abspath(args.corpus) if args.corpus else None
+
+    # ストアを作業ディレクトリに分離（settings を読み込む前に切り替える）
+    if not args.url:
+        use_workdir(args.workdir)
+
+    corpus = load_corpus(corpus_path) if corpus_path else synthetic_corpus(seed=args.seed)
+    if not corpus:
+        parser.error("corpus is empty")
+
+    if args.url:
+        target = http_target(args.url)
+    else:
+        if not args.real:
+            from standin_models import configure_standins
+            configure_standins(args.seconds_per_token, args.load_seconds, args.devices)
+        target = backend_target(standin=not args.real)
+
+    with MemorySampler() as memory:
+        start = time.perf_counter()
+        records = run_loadtest(
+            target, corpus, args.requests, args.concurrency, args.rate, args.seed, args.session_ids
+        )
+        wall = time.perf_counter() - start
+
+    summary = summarize(records, wall, None if args.url else memory)
+    summary["config"] = {
+        "target": args.url or ("backend (real models)" if args.real else "backend (stand-ins)"),
+        "concurrency": args.concurrency,
+        "rate": args.rate,
+        "corpus_docs": len(corpus),
+        "devices": None if args.url or args.real else args.devices
+    }
+    print_summary(summary)
+
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump({"summary": summary, "records": records}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
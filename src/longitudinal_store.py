@@ -0,0 +1,341 @@
+"""
+longitudinal_store
+クライアントごとのセッション履歴（MiniLM 層の集計値）を SQLite に保存する
+
+各セッションのラベル別集計値（合計・件数・最大）と根拠文の位置だけを保存し、
+過去セッションを再エンコードせずに推移を参照できるようにする。
+推移（平均・傾き）は保存時に累積値を更新するため、問い合わせは集計値の読み出しのみ。
+
+Usage:
+    python longitudinal_store.py history CLIENT_ID --category injunctions --last 10
+    python longitudinal_store.py trends CLIENT_ID --category emotions
+"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from settings import longitudinal_db_path
+
+CATEGORIES = ["injunctions", "emotions", "drivers"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    client_id   TEXT NOT NULL,
+    session_id  TEXT NOT NULL,
+    seq         INTEGER NOT NULL,
+    session_at  TEXT NOT NULL,
+    text_sha1   TEXT,
+    n_sentences INTEGER NOT NULL,
+    taxonomy_version TEXT,
+    PRIMARY KEY (client_id, session_id)
+);
+CREATE TABLE IF NOT EXISTS label_aggregates (
+    client_id  TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    seq        INTEGER NOT NULL,
+    category   TEXT NOT NULL,
+    label      TEXT NOT NULL,
+    total      REAL NOT NULL,
+    count      INTEGER NOT NULL,
+    avg        REAL NOT NULL,
+    max        REAL NOT NULL,
+    rank       INTEGER,
+    PRIMARY KEY (client_id, session_id, category, label)
+);
+CREATE INDEX IF NOT EXISTS idx_label_aggregates_seq
+    ON label_aggregates (client_id, category, label, seq);
+CREATE TABLE IF NOT EXISTS evidence_pointers (
+    client_id      TEXT NOT NULL,
+    session_id     TEXT NOT NULL,
+    category       TEXT NOT NULL,
+    label          TEXT NOT NULL,
+    sentence_index INTEGER NOT NULL,
+    score          REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_evidence_pointers
+    ON evidence_pointers (client_id, session_id, category, label);
+CREATE TABLE IF NOT EXISTS label_trends (
+    client_id  TEXT NOT NULL,
+    category   TEXT NOT NULL,
+    label      TEXT NOT NULL,
+    n_sessions INTEGER NOT NULL,
+    sum_x      REAL NOT NULL,
+    sum_xx     REAL NOT NULL,
+    sum_total  REAL NOT NULL,
+    sum_xy     REAL NOT NULL,
+    sum_count  INTEGER NOT NULL,
+    peak_max   REAL NOT NULL,
+    PRIMARY KEY (client_id, category, label)
+);
+"""
+
+
+class LongitudinalStore:
+    """
+    Per-client session history of MiniLM-stage aggregates.
+
+    label_trends keeps running sums per (client, category, label) so the
+    least-squares slope of the session totals is available without
+    scanning earlier sessions.
+    """
+
+    def __init__(self, path=longitudinal_db_path):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        if path != ":memory:":
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+
+        # 旧版のデータベースには taxonomy バージョン列を追加する
+        columns = {r["name"] for r in self._conn.execute("PRAGMA table_info(sessions)")}
+        if "taxonomy_version" not in columns:
+            self._conn.execute("ALTER TABLE sessions ADD COLUMN taxonomy_version TEXT")
+
+    def close(self):
+        self._conn.close()
+
+    # === 保存 ===
+    def record_session(self, client_id, session_id, analysis, text=None, session_at=None):
+        """
+        1セッション分の分析結果を保存する。
+        同じ session_id を再保存した場合は上書きし、推移の累積値も差し替える。
+
+        :param client_id: クライアントID
+        :param session_id: セッションID
+        :param analysis: text_analyzer.analyze_text() の戻り値
+        :param text: 元の会話全文（ハッシュのみ保存）
+        :param session_at: セッション日時（ISO形式、省略時は現在時刻）
+        :return: セッションの通し番号
+        """
+        store = analysis["evidence"]
+        ranked = analysis["ranked"]
+        session_at = session_at or datetime.now(timezone.utc).isoformat()
+        text_sha1 = hashlib.sha1(text.encode("utf-8")).hexdigest() if text else None
+
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT seq FROM sessions WHERE client_id = ? AND session_id = ?",
+                (client_id, session_id)
+            ).fetchone()
+
+            if row is not None:
+                # 再保存：旧データを推移から取り除く
+                seq = row["seq"]
+                self._remove_session(client_id, session_id)
+            else:
+                seq = self._conn.execute(
+                    "SELECT COALESCE(MAX(seq), 0) + 1 FROM sessions WHERE client_id = ?",
+                    (client_id,)
+                ).fetchone()[0]
+
+            self._conn.execute(
+                """
+                INSERT INTO sessions
+                    (client_id, session_id, seq, session_at, text_sha1, n_sentences, taxonomy_version)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    client_id, session_id, seq, session_at, text_sha1, len(store.sentences),
+                    analysis.get("taxonomy_version")
+                )
+            )
+
+            for category in CATEGORIES:
+                ranks = {item[0]: i + 1 for i, item in enumerate(ranked[category])}
+
+                for label, agg in store.aggregates(category).items():
+                    self._conn.execute(
+                        "INSERT INTO label_aggregates VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (
+                            client_id, session_id, seq, category, label,
+                            agg["total"], agg["count"], agg["avg"], agg["max"],
+                            ranks.get(label)
+                        )
+                    )
+                    self._update_trend(client_id, category, label, seq, agg, sign=1)
+
+                    # 根拠文は位置とスコアのみ保存
+                    sent_idx, scores = store.hits(category, label)
+                    self._conn.executemany(
+                        "INSERT INTO evidence_pointers VALUES (?, ?, ?, ?, ?, ?)",
+                        [
+                            (client_id, session_id, category, label, i, v)
+                            for i, v in zip(sent_idx.tolist(), scores.tolist())
+                        ]
+                    )
+
+        return seq
+
+    def _remove_session(self, client_id, session_id):
+        """
+        セッションの保存内容と推移への寄与を取り除く（ロック・トランザクション内で呼ぶ）
+        """
+        rows = self._conn.execute(
+            "SELECT * FROM label_aggregates WHERE client_id = ? AND session_id = ?",
+            (client_id, session_id)
+        ).fetchall()
+        for row in rows:
+            self._update_trend(client_id, row["category"], row["label"], row["seq"], row, sign=-1)
+
+        for table in ["sessions", "label_aggregates", "evidence_pointers"]:
+            self._conn.execute(
+                f"DELETE FROM {table} WHERE client_id = ? AND session_id = ?",
+                (client_id, session_id)
+            )
+
+        # ピークは減算できないため、残っているセッションの集計値から求め直す
+        self._conn.executemany(
+            """
+            UPDATE label_trends SET peak_max = COALESCE((
+                SELECT MAX(a.max) FROM label_aggregates a
+                WHERE a.client_id = label_trends.client_id
+                  AND a.category = label_trends.category
+                  AND a.label = label_trends.label
+            ), 0.0)
+            WHERE client_id = ? AND category = ? AND label = ?
+            """,
+            [(client_id, row["category"], row["label"]) for row in rows]
+        )
+
+    def _update_trend(self, client_id, category, label, seq, agg, sign):
+        """
+        推移の累積値を加算（sign=1）または減算（sign=-1）する
+        """
+        x, y = float(seq), float(agg["total"])
+        self._conn.execute(
+            """
+            INSERT INTO label_trends VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (client_id, category, label) DO UPDATE SET
+                n_sessions = n_sessions + excluded.n_sessions,
+                sum_x = sum_x + excluded.sum_x,
+                sum_xx = sum_xx + excluded.sum_xx,
+                sum_total = sum_total + excluded.sum_total,
+                sum_xy = sum_xy + excluded.sum_xy,
+                sum_count = sum_count + excluded.sum_count,
+                peak_max = MAX(peak_max, excluded.peak_max)
+            """,
+            (
+                client_id, category, label,
+                sign, sign * x, sign * x * x, sign * y, sign * x * y,
+                sign * int(agg["count"]),
+                # 減算時はピークを更新しない（_remove_session で求め直す）
+                float(agg["max"]) if sign > 0 else 0.0
+            )
+        )
+
+    # === 参照 ===
+    def sessions(self, client_id, last_n=None):
+        """
+        クライアントのセッション一覧（古い順）
+        """
+        rows = self._conn.execute(
+            "SELECT * FROM sessions WHERE client_id = ? ORDER BY seq DESC LIMIT ?",
+            (client_id, last_n if last_n is not None else -1)
+        ).fetchall()
+        return [dict(r) for r in reversed(rows)]
+
+    def label_history(self, client_id, category, label=None, last_n=10):
+        """
+        直近 last_n セッションのラベル別集計値（古い順）
+        例：直近10セッションの禁止令スコア
+
+        :return: [{"session_id", "seq", "label", "total", "count", "avg", "max", "rank", "taxonomy_version"}]
+        """
+        query = """
+            SELECT a.session_id, a.seq, s.session_at, a.label,
+                   a.total, a.count, a.avg, a.max, a.rank, s.taxonomy_version
+            FROM label_aggregates a
+            JOIN sessions s USING (client_id, session_id)
+            WHERE a.client_id = ? AND a.category = ?
+              AND a.seq > (
+                SELECT COALESCE(MAX(seq), 0) - ? FROM sessions WHERE client_id = ?
+              )
+        """
+        params = [client_id, category, last_n, client_id]
+        if label is not None:
+            query += " AND a.label = ?"
+            params.append(label)
+        query += " ORDER BY a.seq, a.label"
+
+        return [dict(r) for r in self._conn.execute(query, params).fetchall()]
+
+    def evidence_pointers(self, client_id, session_id, category, label):
+        """
+        セッション内の根拠文の位置とスコア
+        """
+        rows = self._conn.execute(
+            """
+            SELECT sentence_index, score FROM evidence_pointers
+            WHERE client_id = ? AND session_id = ? AND category = ? AND label = ?
+            ORDER BY sentence_index
+            """,
+            (client_id, session_id, category, label)
+        ).fetchall()
+        return [(r["sentence_index"], r["score"]) for r in rows]
+
+    def trends(self, client_id, category):
+        """
+        全セッションを通したラベル別の推移（累積値から計算）
+
+        :return: [{"label", "n_sessions", "mean_total", "slope", "mean_count", "peak_max"}]
+            slope はセッションあたりの合計スコアの増減（最小二乗）
+        """
+        rows = self._conn.execute(
+            "SELECT * FROM label_trends WHERE client_id = ? AND category = ? AND n_sessions > 0",
+            (client_id, category)
+        ).fetchall()
+
+        out = []
+        for r in rows:
+            n = r["n_sessions"]
+            denom = n * r["sum_xx"] - r["sum_x"] ** 2
+            slope = (n * r["sum_xy"] - r["sum_x"] * r["sum_total"]) / denom if denom else 0.0
+            out.append({
+                "label": r["label"],
+                "n_sessions": n,
+                "mean_total": r["sum_total"] / n,
+                "slope": slope,
+                "mean_count": r["sum_count"] / n,
+                "peak_max": r["peak_max"]
+            })
+
+        return sorted(out, key=lambda x: x["mean_total"], reverse=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MILD-7 longitudinal history")
+    parser.add_argument("--db", default=longitudinal_db_path)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    history = sub.add_parser("history", help="per-label aggregates of the last N sessions")
+    history.add_argument("client_id")
+    history.add_argument("--category", choices=CATEGORIES, default="injunctions")
+    history.add_argument("--label")
+    history.add_argument("--last", type=int, default=10)
+
+    trends = sub.add_parser("trends", help="per-label trend over all sessions")
+    trends.add_argument("client_id")
+    trends.add_argument("--category", choices=CATEGORIES, default="injunctions")
+
+    args = parser.parse_args(argv)
+    store = LongitudinalStore(args.db)
+
+    if args.command == "history":
+        result = store.label_history(args.client_id, args.category, args.label, args.last)
+    else:
+        result = store.trends(args.client_id, args.category)
+
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
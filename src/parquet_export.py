@@ -0,0 +1,512 @@
+"""
+parquet_export
+解析結果を列指向（Parquet）で書き出す（分析チーム向け）
+
+backend.main の結果を3つの表に分け、日付でパーティション分割した Parquet に追記する。
+- documents  文書ごと（言語・文数・LLM 出力）
+- labels     文書 × ラベルごと（集計スコア・7段階評価・ピーク）
+- evidence   文書 × ラベル × 根拠文ごと（文・スコア・前後の文脈）
+
+書き込みはバッファにためてバックグラウンドでまとめて行う（パイプラインを待たせない）。
+ファイルは一時ファイルに書いてから置き換えるため、読み取り側が書きかけのファイルを見ることはない。
+スキーマは固定（SCHEMA_VERSION）で、pyarrow.dataset のフィルタでパーティション・行グループを絞り込める。
+
+Usage:
+    python parquet_export.py stats
+    python parquet_export.py query --table evidence --filter "label == Don't belong" --filter "score >= 0.4"
+    python parquet_export.py query --table labels --filter "date >= 2026-01-01" --columns doc_id,label,avg_score
+    python parquet_export.py compact --table evidence
+"""
+import argparse
+import atexit
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from settings import parquet_export_dir, parquet_export_batch_rows, parquet_export_flush_seconds
+
+# スキーマを変更したら上げる（ファイルのメタデータに記録）
+SCHEMA_VERSION = "2"
+
+TABLES = ["documents", "labels", "evidence"]
+
+CATEGORIES = ["injunctions", "emotions", "drivers"]
+
+# 書き込みに失敗したバッファを戻して再試行する回数（超えた行は破棄して記録する）
+MAX_WRITE_ATTEMPTS = 3
+
+_FILTER_RE = re.compile(r"^\s*(\w+)\s*(==|!=|>=|<=|>|<|=)\s*(.+?)\s*$")
+
+_schemas = None
+
+
+def table_schemas():
+    """
+    各表のスキーマ（パーティション列 date はファイルには含めない）
+    """
+    global _schemas
+
+    if _schemas is None:
+        import pyarrow as pa
+
+        timestamp = pa.timestamp("us", tz="UTC")
+        metadata = {"mild7.schema_version": SCHEMA_VERSION}
+        _schemas = {
+            "documents": pa.schema([
+                ("doc_id", pa.string()),
+                ("client_id", pa.string()),
+                ("session_id", pa.string()),
+                ("processed_at", timestamp),
+                ("lang", pa.string()),
+                ("ref_lang", pa.string()),
+                ("n_sentences", pa.int32()),
+                ("text_sha1", pa.string()),
+                ("taxonomy_version", pa.string()),
+                ("gemma_result", pa.string()),
+                ("medgemma_result", pa.string())
+            ], metadata=metadata),
+            "labels": pa.schema([
+                ("doc_id", pa.string()),
+                ("processed_at", timestamp),
+                ("taxonomy_version", pa.string()),
+                ("category", pa.string()),
+                ("label", pa.string()),
+                ("rank", pa.int16()),
+                ("total_score", pa.float32()),
+                ("avg_score", pa.float32()),
+                ("max_score", pa.float32()),
+                ("stars_score", pa.int8()),
+                ("max_score_status", pa.string()),
+                ("max_evidence", pa.string()),
+                ("n_evidence", pa.int32())
+            ], metadata=metadata),
+            "evidence": pa.schema([
+                ("doc_id", pa.string()),
+                ("processed_at", timestamp),
+                ("category", pa.string()),
+                ("label", pa.string()),
+                ("sentence_index", pa.int32()),
+                ("sentence", pa.string()),
+                ("score", pa.float32()),
+                ("context", pa.string())
+            ], metadata=metadata)
+        }
+    return _schemas
+
+
+# =====
+# 行の作成
+# =====
+def build_rows(doc_id, analysis, payload, front_score, gemma_result=None, medgemma_result=None,
+               client_id=None, session_id=None, processed_at=None):
+    """
+    1文書の結果を各表の行に変換する
+
+    :param analysis: text_analyzer.analyze_text() の結果
+    :param payload: pack_payload() の結果（ランキング・集計スコア）
+    :param front_score: front_score_totalling() の結果
+    :return: {table: [row]}
+    """
+    processed_at = processed_at or datetime.now(timezone.utc)
+    store = analysis["evidence"]
+    sentences = analysis["sentences"]
+
+    rows = {table: [] for table in TABLES}
+    rows["documents"].append({
+        "doc_id": doc_id,
+        "client_id": client_id,
+        "session_id": session_id,
+        "processed_at": processed_at,
+        "lang": analysis.get("lang"),
+        "ref_lang": analysis.get("ref_lang"),
+        "n_sentences": len(sentences),
+        "text_sha1": hashlib.sha1("\n".join(sentences).encode("utf-8")).hexdigest(),
+        "taxonomy_version": analysis.get("taxonomy_version"),
+        "gemma_result": gemma_result,
+        "medgemma_result": medgemma_result
+    })
+
+    contexts = {}
+    for category in CATEGORIES:
+        front = {item["label"]: item for item in front_score.get(category, [])}
+
+        for rank, item in enumerate(payload[category], 1):
+            label = item["label"]
+            sent_idx, scores = store.hits(category, label)
+            shown = front.get(label, {})
+
+            rows["labels"].append({
+                "doc_id": doc_id,
+                "processed_at": processed_at,
+                "taxonomy_version": analysis.get("taxonomy_version"),
+                "category": category,
+                "label": label,
+                "rank": rank,
+                "total_score": item["total_score"],
+                "avg_score": item["avg_score"],
+                "max_score": shown.get("max_score", item["max_score"]),
+                "stars_score": shown.get("stars_score"),
+                "max_score_status": shown.get("max_score_status"),
+                "max_evidence": shown.get("max_evidence"),
+                "n_evidence": len(sent_idx)
+            })
+
+            # 根拠文は上位数件ではなくヒットした全文を書き出す
+            for i, score in zip(sent_idx.tolist(), scores.tolist()):
+                if i not in contexts:
+                    contexts[i] = store.context(i)
+                rows["evidence"].append({
+                    "doc_id": doc_id,
+                    "processed_at": processed_at,
+                    "category": category,
+                    "label": label,
+                    "sentence_index": i,
+                    "sentence": sentences[i],
+                    "score": score,
+                    "context": contexts[i]
+                })
+
+    return rows
+
+
+# =====
+# 書き込み
+# =====
+class ParquetExporter:
+    """
+    Buffers result rows and writes them as date-partitioned Parquet files.
+
+    Layout: {root}/{table}/date=YYYY-MM-DD/part-*.parquet (hive style).
+    A background thread flushes when a table reaches batch_rows or the
+    oldest buffered row is older than flush_seconds; close() (also run
+    at exit) flushes the rest. A failed write puts its rows back and is
+    retried after flush_seconds, up to MAX_WRITE_ATTEMPTS times.
+    """
+
+    def __init__(self, root=parquet_export_dir, batch_rows=parquet_export_batch_rows,
+                 flush_seconds=parquet_export_flush_seconds):
+        self.root = root
+        self.batch_rows = batch_rows
+        self.flush_seconds = flush_seconds
+
+        self._buffers = {} # {(table, date): [row]}
+        self._oldest = None
+        self._attempts = {} # {(table, date): 連続して失敗した回数}
+        self._retry_at = 0.0
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._closed = False
+
+        self.stats = {
+            "documents": 0, "files": 0, "rows": {t: 0 for t in TABLES}, "write_seconds": 0.0,
+            "failed_writes": 0, "dropped_rows": 0
+        }
+
+        self._thread = threading.Thread(target=self._run, name="parquet-export", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def add(self, doc_id, analysis, payload, front_score, gemma_result=None, medgemma_result=None,
+            client_id=None, session_id=None):
+        """
+        1文書の結果をバッファに追加する（書き込みはバックグラウンド）
+        """
+        rows = build_rows(
+            doc_id, analysis, payload, front_score, gemma_result, medgemma_result, client_id, session_id
+        )
+        date = rows["documents"][0]["processed_at"].strftime("%Y-%m-%d")
+
+        with self._cond:
+            for table, table_rows in rows.items():
+                if table_rows:
+                    self._buffers.setdefault((table, date), []).extend(table_rows)
+            self._oldest = self._oldest or time.monotonic()
+            self.stats["documents"] += 1
+
+            if max(len(b) for b in self._buffers.values()) >= self.batch_rows:
+                self._cond.notify()
+
+    def _due(self):
+        if not self._buffers:
+            return False
+        # 失敗した直後はすぐに再試行しない
+        if time.monotonic() < self._retry_at:
+            return False
+        if max(len(b) for b in self._buffers.values()) >= self.batch_rows:
+            return True
+        return time.monotonic() - self._oldest >= self.flush_seconds
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._due():
+                    self._cond.wait(timeout=min(self.flush_seconds, 1.0))
+                if self._closed:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                # 書き込みスレッドは止めない（失敗した行は flush 内で戻している）
+                print(f"Parquet export flush failed: {e}")
+
+    def flush(self):
+        """
+        バッファの内容をすべて書き込む
+
+        :return: 書き込んだファイル数
+        """
+        with self._cond:
+            buffers, self._buffers = self._buffers, {}
+            self._oldest = None
+
+        written = 0
+        with self._write_lock:
+            for key, rows in buffers.items():
+                try:
+                    self._write(*key, rows)
+                except Exception as e:
+                    self._requeue(key, rows, e)
+                    continue
+                self._attempts.pop(key, None)
+                written += 1
+        return written
+
+    def _requeue(self, key, rows, error):
+        """
+        書き込めなかった行をバッファの先頭に戻す（MAX_WRITE_ATTEMPTS 回失敗したら破棄）
+        """
+        table, date = key
+        attempts = self._attempts.get(key, 0) + 1
+        self.stats["failed_writes"] += 1
+
+        if attempts >= MAX_WRITE_ATTEMPTS:
+            self._attempts.pop(key, None)
+            self.stats["dropped_rows"] += len(rows)
+            print(f"Parquet export dropped {len(rows)} {table} rows for {date} after {attempts} attempts: {error}")
+            return
+
+        self._attempts[key] = attempts
+        print(f"Parquet export write failed ({table}, {date}, attempt {attempts}), retrying: {error}")
+        with self._cond:
+            self._buffers[key] = rows + self._buffers.get(key, [])
+            self._oldest = self._oldest or time.monotonic()
+            self._retry_at = time.monotonic() + self.flush_seconds
+
+    def _write(self, table, date, rows):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        start = time.perf_counter()
+        schema = table_schemas()[table]
+        data = pa.Table.from_pylist(rows, schema=schema)
+
+        # 同じラベルの行をまとめると行グループの統計で絞り込みが効く
+        sort_keys = [("category", "ascending"), ("label", "ascending")] if table != "documents" else []
+        if sort_keys:
+            data = data.sort_by(sort_keys)
+
+        directory = os.path.join(self.root, table, f"date={date}")
+        os.makedirs(directory, exist_ok=True)
+        name = f"part-{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{os.getpid()}-{uuid.uuid4().hex[:8]}.parquet"
+        tmp_path = os.path.join(directory, "." + name + ".tmp")
+
+        try:
+            pq.write_table(data, tmp_path, compression="zstd")
+            os.replace(tmp_path, os.path.join(directory, name))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        self.stats["files"] += 1
+        self.stats["rows"][table] += len(rows)
+        self.stats["write_seconds"] += time.perf_counter() - start
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self.flush()
+
+
+# =====
+# 読み取り
+# =====
+def open_dataset(root, table):
+    """
+    表を pyarrow.dataset として開く（date はパーティション列）
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    path = os.path.join(root, table)
+    if not os.path.isdir(path):
+        raise FileNotFoundError(f"no exported {table} in {root}")
+
+    schema = table_schemas()[table].append(pa.field("date", pa.string()))
+    return ds.dataset(
+        path,
+        schema=schema,
+        format="parquet",
+        partitioning=ds.partitioning(pa.schema([("date", pa.string())]), flavor="hive"),
+        exclude_invalid_files=False,
+        ignore_prefixes=[".", "_"]
+    )
+
+
+def parse_filters(filters, schema):
+    """
+    "column op value" 形式の条件を pyarrow.dataset の式に変換する
+
+    :param filters: ["score >= 0.4", "label == Don't belong", ...]
+    :return: 式（条件がない場合は None）
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    expression = None
+    for text in filters or []:
+        match = _FILTER_RE.match(text)
+        if not match:
+            raise ValueError(f"invalid filter {text!r} (expected 'column op value')")
+        column, op, raw = match.groups()
+        if column not in schema.names:
+            raise ValueError(f"unknown column {column!r}")
+
+        field_type = schema.field(column).type
+        if pa.types.is_integer(field_type):
+            value = int(raw)
+        elif pa.types.is_floating(field_type):
+            value = float(raw)
+        elif pa.types.is_timestamp(field_type):
+            value = pa.scalar(datetime.fromisoformat(raw).astimezone(timezone.utc), type=field_type)
+        else:
+            value = raw
+
+        field = ds.field(column)
+        condition = {
+            "==": field == value, "=": field == value, "!=": field != value,
+            ">=": field >= value, "<=": field <= value, ">": field > value, "<": field < value
+        }[op]
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def query(root, table, filters=None, columns=None, limit=None):
+    """
+    条件に合う行を読み込む（パーティション・行グループ単位で絞り込み）
+
+    :return: pyarrow.Table
+    """
+    dataset = open_dataset(root, table)
+    expression = parse_filters(filters, dataset.schema)
+    if limit:
+        return dataset.head(limit, columns=columns, filter=expression)
+    return dataset.to_table(columns=columns, filter=expression)
+
+
+def dataset_stats(root):
+    """
+    表ごとのファイル数・行数・パーティション数（フッタのみ読む）
+    """
+    import pyarrow.parquet as pq
+
+    out = {}
+    for table in TABLES:
+        files, rows, partitions = 0, 0, set()
+        base = os.path.join(root, table)
+        for directory, _, names in os.walk(base):
+            for name in names:
+                if name.endswith(".parquet") and not name.startswith("."):
+                    files += 1
+                    rows += pq.ParquetFile(os.path.join(directory, name)).metadata.num_rows
+                    partitions.add(os.path.relpath(directory, base))
+        out[table] = {"files": files, "rows": rows, "partitions": len(partitions)}
+    return out
+
+
+def compact(root, table, date=None):
+    """
+    パーティション内の小さいファイルを1つにまとめる（書き込み中のファイルは対象外）
+
+    :param date: 対象日（省略時は全パーティション）
+    :return: {partition: まとめたファイル数}
+    """
+    import pyarrow.parquet as pq
+
+    base = os.path.join(root, table)
+    if not os.path.isdir(base):
+        return {}
+
+    schema = table_schemas()[table]
+    merged = {}
+    for partition in sorted(os.listdir(base)):
+        if date and partition != f"date={date}":
+            continue
+        directory = os.path.join(base, partition)
+        paths = sorted(
+            os.path.join(directory, n) for n in os.listdir(directory)
+            if n.endswith(".parquet") and not n.startswith(".")
+        )
+        if len(paths) < 2:
+            continue
+
+        data = pq.read_table(paths, schema=schema)
+        if table != "documents":
+            data = data.sort_by([("category", "ascending"), ("label", "ascending")])
+
+        name = f"part-{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-compact-{uuid.uuid4().hex[:8]}.parquet"
+        tmp_path = os.path.join(directory, "." + name + ".tmp")
+        pq.write_table(data, tmp_path, compression="zstd")
+        os.replace(tmp_path, os.path.join(directory, name))
+        for path in paths:
+            os.remove(path)
+        merged[partition] = len(paths)
+
+    return merged
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MILD-7 Parquet export of analysis results")
+    parser.add_argument("--dir", default=parquet_export_dir)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    sub.add_parser("stats", help="files, rows and partitions per table")
+
+    q = sub.add_parser("query", help="read rows with predicate pushdown")
+    q.add_argument("--table", choices=TABLES, required=True)
+    q.add_argument("--filter", action="append", default=[], help="'column op value' (repeatable, ANDed)")
+    q.add_argument("--columns", help="comma-separated column list")
+    q.add_argument("--limit", type=int, default=20)
+
+    c = sub.add_parser("compact", help="merge the small files of each partition")
+    c.add_argument("--table", choices=TABLES, required=True)
+    c.add_argument("--date", help="only this partition (YYYY-MM-DD)")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "stats":
+        print(json.dumps(dataset_stats(args.dir), indent=2))
+
+    elif args.command == "query":
+        columns = args.columns.split(",") if args.columns else None
+        try:
+            result = query(args.dir, args.table, args.filter, columns, args.limit)
+        except (ValueError, FileNotFoundError) as e:
+            parser.error(str(e))
+        for row in result.to_pylist():
+            print(json.dumps(row, ensure_ascii=False, default=str))
+
+    elif args.command == "compact":
+        print(json.dumps(compact(args.dir, args.table, args.date), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,407 @@
+"""
+prefilter
+文分割とエンコードの間で、情報量の少ない発話（相づち・つなぎ言葉・タイムスタンプのみの行など）を除く
+
+逐語録には "Mm-hmm." "Okay." "Yes." のような相づちが多く、すべて MiniLM でエンコードして全参照と比較すると
+計算が無駄になるうえ、しきい値（0.10・最大値の 90%）を越えてノイズの根拠文になることがある。
+文ごとに次の順で分類する（話者名・タイムスタンプは除いて判定）。
+- filler  文字がない・つなぎ言葉と定型句（STOP_PHRASES）だけでできている → エンコードしない
+- short   語数が prefilter_min_words 未満で、参照定義の語彙・否定語を含まない（"That's it." "My mother."）
+          日本語は漢字を含まない短い文（"そっか" "まあね"）
+- keep    それ以外（"I can't." のように短くても否定語・定義の語彙を含めば残す）
+
+prefilter_mode:
+- "off"    すべてエンコード（従来どおり）
+- "drop"   filler と short をエンコードしない
+- "merge"  filler はエンコードせず、short は同じ話者の直後（なければ直前）の文とまとめてエンコードし、
+           まとめた先の文のベクトルにする
+
+文リスト・文番号は変えない（除いた文はスコア 0 になり根拠文に選ばれないが、前後文脈には残る）。
+build_plan の units が「エンコードする単位 → 元の文番号」の対応を持つ。
+
+Usage:
+    python prefilter.py compare --standin --docs 50
+    python prefilter.py compare --corpus transcripts/ --modes drop merge
+    python prefilter.py classify session.txt
+"""
+import argparse
+import json
+import re
+import time
+from settings import prefilter_mode, prefilter_min_words
+
+PREFILTER_MODES = ["off", "drop", "merge"]
+
+# 話者名・タイムスタンプ（判定時のみ取り除く）
+_PREFIX = re.compile(
+    r"^\s*(?:[\[(]?\d{1,2}:\d{2}(?::\d{2})?(?:[.,]\d+)?[\])]?\s*)?(?:[^\s:：]{1,20}\s?[:：]\s*)?"
+)
+
+# 英単語（アポストロフィを含む）
+_WORD = re.compile(r"[a-z]+(?:['’][a-z]+)*")
+
+# 仮名・漢字
+_JA_CHAR = re.compile(r"[぀-ヿ一-鿿ｦ-ﾟ]")
+_KANJI = re.compile(r"[一-鿿]")
+
+# 単独では情報のない英単語（相づち・つなぎ言葉、"mm-hmm" は mm / hmm に分かれる）
+FILLER_WORDS = {
+    "mm", "mmm", "hmm", "hm", "mhm", "uh", "um", "umm", "uhm", "er", "erm", "ah", "oh", "ooh",
+    "huh", "yeah", "yes", "yep", "yup", "ya", "no", "nope", "ok", "okay", "right", "sure", "alright",
+    "well", "so", "like", "anyway", "anyways", "wow", "cool", "great", "good", "fine", "nice", "really",
+    "exactly", "totally", "absolutely", "definitely", "indeed", "true", "hi", "hello", "bye", "thanks"
+}
+
+# 定型句（英語は取り除いた残りがつなぎ言葉だけ、日本語は定型句だけでできていれば filler）
+STOP_PHRASES = {
+    "en": [
+        "mm hmm", "uh huh", "i see", "got it", "thank you", "go on", "you know", "i mean", "that's right",
+        "all right", "sounds good", "makes sense", "of course", "i guess", "let's see", "that's true"
+    ],
+    "ja": [
+        "そうなんですね", "なるほど", "そうですね", "そうですか", "はいはい", "うんうん", "えっと", "あのー",
+        "あの", "うーん", "へえ", "はい", "うん", "ええ", "そう", "ああ", "ね"
+    ]
+}
+
+# 英語の定型句
+_EN_STOP = re.compile(r"\b(?:" + "|".join(map(re.escape, STOP_PHRASES["en"])) + r")\b")
+
+# 日本語の定型句だけでできた文
+_JA_STOP = re.compile(
+    "(?:(?:" + "|".join(map(re.escape, STOP_PHRASES["ja"])) + r")[、。，．！？!?…ー〜～\s]*)+"
+)
+
+# 機能語（内容語の判定から除く）
+FUNCTION_WORDS = {
+    "i", "me", "my", "you", "your", "he", "she", "it", "its", "we", "they", "them", "this", "that", "these",
+    "those", "a", "an", "the", "and", "or", "but", "of", "to", "in", "on", "at", "for", "with", "is", "am",
+    "are", "was", "were", "be", "been", "do", "did", "does", "have", "has", "had", "it's", "that's", "i'm",
+    "what", "there", "here", "then", "just", "too", "very", "about", "up", "out"
+}
+
+# 短くても残す否定語
+NEGATIONS = {
+    "not", "never", "nothing", "nobody", "none", "nowhere", "can't", "cannot", "won't", "don't", "didn't",
+    "doesn't", "isn't", "wasn't", "aren't", "shouldn't", "couldn't", "wouldn't", "no-one"
+}
+
+# 参照定義の語彙 {taxonomy バージョン: set}
+_vocabulary = {}
+
+
+def strip_prefix(sentence):
+    """
+    話者名・タイムスタンプを除いた本文
+    """
+    return sentence[_PREFIX.match(sentence).end():].strip()
+
+
+def signal_vocabulary(snapshot=None):
+    """
+    参照定義（英語）に含まれる内容語（taxonomy のバージョンごとに作成）
+    """
+    import taxonomy
+
+    snapshot = snapshot or taxonomy.current()
+    if snapshot.version not in _vocabulary:
+        words = set()
+        for text in taxonomy.definition_texts("en", snapshot.dbs):
+            words.update(_WORD.findall(text.lower()))
+        _vocabulary.clear()
+        _vocabulary[snapshot.version] = (words - FUNCTION_WORDS - FILLER_WORDS) | NEGATIONS
+    return _vocabulary[snapshot.version]
+
+
+def classify_sentence(sentence, lang="en", vocabulary=frozenset(), min_words=prefilter_min_words):
+    """
+    1文を filler / short / keep に分類する（語彙と長さによる軽量な判定）
+
+    :param vocabulary: 短くても残す語（signal_vocabulary の結果）
+    :return: "filler" / "short" / "keep"
+    """
+    body = strip_prefix(sentence).lower()
+
+    if lang == "ja":
+        chars = _JA_CHAR.findall(body)
+        if (not chars and not re.search(r"[a-z0-9]", body)) or _JA_STOP.fullmatch(body):
+            return "filler"
+        # 漢字を含まない短い文（"そっか" "まあね"）のみ short（1語あたり2文字程度として判定）
+        return "short" if not _KANJI.search(body) and len(chars) < min_words * 2 else "keep"
+
+    body = body.replace("’", "'")
+    words = _WORD.findall(_EN_STOP.sub(" ", body))
+
+    if all(w in FILLER_WORDS for w in words):
+        return "filler"
+    if len(words) < min_words and not any(w in vocabulary for w in words):
+        return "short"
+    return "keep"
+
+
+def build_plan(sentences, lang="en", mode=prefilter_mode, min_words=prefilter_min_words, vocabulary=None):
+    """
+    エンコードする単位と元の文番号の対応を作る
+
+    :return: {
+        "mode", "classes": 文ごとの分類,
+        "units": [(代表の文番号, [まとめた文番号])]（エンコードする単位、代表の文にベクトルを入れる）,
+        "texts": 単位ごとのエンコードする文字列,
+        "dropped": エンコードしない文番号, "merged": 他の文とまとめた文番号
+    }
+    """
+    if mode not in PREFILTER_MODES:
+        raise ValueError(f"unknown prefilter mode: {mode} (choose from {', '.join(PREFILTER_MODES)})")
+
+    if mode == "off":
+        classes = ["keep"] * len(sentences)
+    else:
+        vocabulary = signal_vocabulary() if vocabulary is None and lang != "ja" else (vocabulary or frozenset())
+        classes = [classify_sentence(s, lang, vocabulary, min_words) for s in sentences]
+
+    units = []
+    dropped = []
+    merged = []
+    pending = [] # 次の文にまとめる short
+
+    for i, cls in enumerate(classes):
+        if cls == "filler" or (cls == "short" and mode == "drop"):
+            dropped.append(i)
+            continue
+        if cls == "short":
+            # 話者が変わる（行頭に話者名がある）場合は持ち越さない
+            if pending and _starts_turn(sentences[i]):
+                _attach_previous(units, pending, merged)
+                pending = []
+            pending.append(i)
+            continue
+
+        if pending and _starts_turn(sentences[i]):
+            _attach_previous(units, pending, merged)
+            pending = []
+        units.append((i, pending + [i]))
+        merged.extend(pending)
+        pending = []
+
+    if pending:
+        _attach_previous(units, pending, merged)
+
+    return {
+        "mode": mode,
+        "classes": classes,
+        "units": units,
+        "texts": [
+            sentences[members[0]] if len(members) == 1 else " ".join(sentences[j].strip() for j in members)
+            for _, members in units
+        ],
+        "dropped": sorted(dropped),
+        "merged": sorted(merged)
+    }
+
+
+def _starts_turn(sentence):
+    """
+    文が話者名・タイムスタンプで始まるか
+    """
+    return _PREFIX.match(sentence).end() > len(sentence) - len(sentence.lstrip())
+
+
+def _attach_previous(units, pending, merged):
+    """
+    持ち越した short を直前の単位にまとめる（直前がなければ short だけで1単位）
+    """
+    if units:
+        host, members = units[-1]
+        units[-1] = (host, members + pending)
+        merged.extend(pending)
+    else:
+        units.append((pending[-1], list(pending)))
+        merged.extend(pending[:-1])
+
+
+def scatter_embeddings(plan, unit_embeddings, n_sentences, dim):
+    """
+    単位ごとのベクトルを文ごとの行列に戻す（代表以外の文は 0 ベクトル = スコア 0）
+
+    :param dim: ベクトルの次元（単位が0件の場合の形状用）
+    :return: [文数, 次元]
+    """
+    import numpy as np
+
+    out = np.zeros((n_sentences, dim), dtype=np.float32)
+    if len(plan["units"]):
+        out[[host for host, _ in plan["units"]]] = np.asarray(unit_embeddings, dtype=np.float32).reshape(-1, dim)
+    return out
+
+
+def pool_embeddings(plan, sentence_embeddings):
+    """
+    文ごとのベクトル（token_pooled）に計画を適用する（まとめた文は平均、除いた文は 0 ベクトル）
+
+    :return: [文数, 次元]
+    """
+    import numpy as np
+
+    emb = np.asarray(sentence_embeddings, dtype=np.float32)
+    out = np.zeros_like(emb)
+    for host, members in plan["units"]:
+        out[host] = emb[members].mean(axis=0)
+    return out
+
+
+def plan_stats(plan, encode_seconds=None):
+    """
+    1文書分の集計（analysis["prefilter"]）
+
+    :return: {"mode", "sentences", "encoded", "dropped", "merged", "encode_seconds", "estimated_saved_seconds", "classes"}
+    """
+    n = len(plan["classes"])
+    encoded = len(plan["units"])
+    saved = None
+    if encode_seconds is not None and encoded:
+        # 1単位あたりの時間から、除いた分の時間を見積もる
+        saved = encode_seconds / encoded * (n - encoded)
+    return {
+        "mode": plan["mode"],
+        "sentences": n,
+        "encoded": encoded,
+        "dropped": len(plan["dropped"]),
+        "merged": len(plan["merged"]),
+        "encode_seconds": encode_seconds,
+        "estimated_saved_seconds": saved,
+        "classes": plan["classes"]
+    }
+
+
+# =====
+# 比較（エンコード時間・根拠文の差分）
+# =====
+def payload_diff(base, filtered, classes):
+    """
+    payload の根拠文・ラベルの差分（base はフィルタなし）
+
+    :param classes: 文 → 分類（除いた根拠文がノイズだったかの確認用）
+    :return: {"labels_removed", "labels_added", "evidence_removed", "evidence_added", "removed_by_class"}
+    """
+    out = {"labels_removed": [], "labels_added": [], "evidence_removed": [], "evidence_added": [],
+           "removed_by_class": {}}
+    for category in base:
+        before = {item["label"]: item["evidence"] for item in base[category]}
+        after = {item["label"]: item["evidence"] for item in filtered[category]}
+        out["labels_removed"] += [f"{category}/{k}" for k in before if k not in after]
+        out["labels_added"] += [f"{category}/{k}" for k in after if k not in before]
+
+        for label in set(before) | set(after):
+            old, new = before.get(label, []), after.get(label, [])
+            for sent in old:
+                if sent not in new:
+                    out["evidence_removed"].append({"label": f"{category}/{label}", "sentence": sent})
+                    cls = classes.get(sent, "keep")
+                    out["removed_by_class"][cls] = out["removed_by_class"].get(cls, 0) + 1
+            for sent in new:
+                if sent not in old:
+                    out["evidence_added"].append({"label": f"{category}/{label}", "sentence": sent})
+    return out
+
+
+def compare_prefilter(docs, modes=("drop", "merge"), standin=False, n_samples=10):
+    """
+    フィルタなしと各モードで MiniLM 層を実行し、エンコードした文の数・時間と payload の根拠文の差分を比較する
+
+    :param docs: [(doc_id, text)]
+    :param standin: True の場合は MiniLM の代わりに HashingEncoder を使用
+    :return: 比較結果
+    """
+    from text_analyzer import analyze_text, pack_payload
+
+    if standin:
+        from standin_models import get_standin_encoder
+        model, _ = get_standin_encoder()
+    else:
+        from text_analyzer import load_minilm
+        model = load_minilm()
+
+    results = {}
+    baseline = {}
+    for mode in ["off"] + [m for m in modes if m != "off"]:
+        row = {"sentences": 0, "encoded": 0, "dropped": 0, "merged": 0, "encode_seconds": 0.0, "seconds": 0.0,
+               "labels_removed": 0, "labels_added": 0, "evidence_removed": 0, "evidence_added": 0,
+               "removed_by_class": {}, "samples": []}
+        for doc_id, text in docs:
+            start = time.perf_counter()
+            analysis = analyze_text(text, model=model, prefilter=mode)
+            row["seconds"] += time.perf_counter() - start
+
+            stats = analysis["prefilter"]
+            for key in ["sentences", "encoded", "dropped", "merged"]:
+                row[key] += stats[key]
+            row["encode_seconds"] += stats["encode_seconds"] or 0.0
+
+            payload = pack_payload(analysis["ranked"], analysis["evidence"])
+            if mode == "off":
+                baseline[doc_id] = payload
+                continue
+
+            classes = dict(zip(analysis["sentences"], stats["classes"]))
+            diff = payload_diff(baseline[doc_id], payload, classes)
+            for key in ["labels_removed", "labels_added", "evidence_removed", "evidence_added"]:
+                row[key] += len(diff[key])
+            for cls, count in diff["removed_by_class"].items():
+                row["removed_by_class"][cls] = row["removed_by_class"].get(cls, 0) + count
+            for item in diff["evidence_removed"]:
+                if len(row["samples"]) < n_samples:
+                    row["samples"].append({"doc_id": doc_id, **item, "class": classes.get(item["sentence"])})
+        results[mode] = row
+
+    base = results["off"]
+    for mode, row in results.items():
+        row["encoded_ratio"] = row["encoded"] / base["encoded"] if base["encoded"] else None
+        row["encode_seconds_saved"] = base["encode_seconds"] - row["encode_seconds"]
+        if mode == "off":
+            for key in ["labels_removed", "labels_added", "evidence_removed", "evidence_added",
+                        "removed_by_class", "samples"]:
+                del row[key]
+
+    return {"docs": len(docs), "encoder": type(model).__name__, "results": results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MILD-7 low-information utterance pre-filter")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    compare = sub.add_parser("compare", help="sentences / encode time saved and payload evidence diff per mode")
+    compare.add_argument("--corpus", default=None, help="directory of .txt or JSON Lines (default: synthetic)")
+    compare.add_argument("--docs", type=int, default=50, help="synthetic transcripts")
+    compare.add_argument("--modes", nargs="+", choices=PREFILTER_MODES, default=["drop", "merge"])
+    compare.add_argument("--standin", action="store_true", help="use the hashing stand-in encoder")
+
+    classify = sub.add_parser("classify", help="print the class of each sentence of one file")
+    classify.add_argument("path")
+    classify.add_argument("--mode", choices=PREFILTER_MODES, default="merge")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        if args.corpus:
+            from loadtest import load_corpus
+            docs = load_corpus(args.corpus)
+        else:
+            from segmenter import synthetic_transcripts
+            docs = synthetic_transcripts(args.docs)
+        print(json.dumps(compare_prefilter(docs, args.modes, args.standin), ensure_ascii=False, indent=2))
+
+    elif args.command == "classify":
+        from text_analyzer import resolve_languages, segment_text
+        with open(args.path, encoding="utf-8") as f:
+            text = f.read()
+        lang, _ = resolve_languages(text)
+        sentences = segment_text(text, lang)
+        plan = build_plan(sentences, lang, args.mode)
+        hosts = {host: members for host, members in plan["units"]}
+        for i, (sent, cls) in enumerate(zip(sentences, plan["classes"])):
+            mark = "merged" if i in plan["merged"] else ("dropped" if i in plan["dropped"] else "")
+            print(f"{i:5d} {cls:6s} {mark:7s} {sent.strip()!r}" + (f" <- {hosts[i]}" if len(hosts.get(i, [])) > 1 else ""))
+
+
+if __name__ == "__main__":
+    main()
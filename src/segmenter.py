@@ -0,0 +1,512 @@
+"""
+segmenter
+文分割エンジン（差し替え可能な登録制、pysbd と正規表現の状態機械）
+
+pysbd は純 Python のルール照合のため、数時間分の会話やバッチのアーカイブでは文分割自体が目立つコストになる。
+RegexSegmenter は区切り候補（終止符・三点リーダー・改行）を1つのコンパイル済み正規表現で拾い、
+候補ごとに前後の数文字だけを見て区切るかを決める。カウンセリングの逐語録向けに以下を扱う。
+- 話者ターン・タイムスタンプ（"Client:" "[00:12:31]"）は改行で区切り、ターンの先頭に残す
+- 三点リーダー（"..." "…"）は次が大文字・記号のときのみ区切る（"I just... I don't know" は2文）
+- 小文字で始まる文（"ok. yeah i know."）は区切り、略語（e.g. p.m. etc.）の後は区切らない
+- 敬称（Mr. Dr.）・イニシャル・行頭の番号（"1."）・小数（10.30）では区切らない
+- 日本語の句点（。！？）は常に区切り、閉じ括弧の後に文が続く場合（「はい。」と言った）は区切らない
+
+どちらも clean=False の pysbd と同じく、文は本文の部分文字列（後続の空白を含む）で、連結すると本文に戻る。
+どちらを既定にするかは compare（pysbd との一致度と文字/秒）で決める（settings.segmentation_engine）。
+
+Usage:
+    python segmenter.py compare --docs 200
+    python segmenter.py compare --corpus transcripts/ --workers 4
+    python segmenter.py check-threads --engine pysbd
+    python segmenter.py segment session.txt --engine regex
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+from settings import segmentation_engine, segmentation_workers, segmentation_parallel_min_chars
+
+# 区切り候補（終止符の連続 + 閉じ括弧・引用符、または改行）
+_CANDIDATE = re.compile(r"(?:\.{2,}|…+|[.!?。！？．｡]+)[\"'”’」』）)\]]*|\n")
+
+# 日本語の終止符
+_JA_TERMINALS = set("。！？｡！？")
+
+# 区切りの後の空白（次の文の先頭までを前の文に含める）
+_TRAILING_SPACE = re.compile(r"\s*")
+
+# 終止符の直前の語
+_PREVIOUS_WORD = re.compile(r"[\w.'’-]*$")
+
+# 後ろに固有名詞・数字が続く敬称・略語（大文字・数字が続いても区切らない）
+TITLES = {
+    "mr", "mrs", "ms", "dr", "prof", "st", "jr", "sr", "mt", "rev", "gen", "col", "lt", "sgt", "capt",
+    "vs", "approx", "dept", "ca"
+}
+
+# 数字が続く場合のみ区切らない略語（"No. 5"、"I said no. He agreed." は2文）
+NUMBER_ABBREVIATIONS = {"no", "nos", "fig", "vol", "pp"}
+
+# 後ろに小文字が続いても区切らない略語（"e.g." "p.m." のように途中に . を含む語も同様）
+ABBREVIATIONS = {"etc", "cf", "al", "viz", "incl", "esp", "min", "hr", "hrs", "wk", "yr", "yrs"}
+
+# 文分割エンジンの登録先 {名前: factory(lang)}
+_registry = {}
+
+# 作成済みのエンジン {(名前, 言語): エンジン}
+_instances = {}
+_instances_lock = threading.Lock()
+
+
+# =====
+# 登録・取得
+# =====
+def register_segmenter(name, factory):
+    """
+    文分割エンジンを登録する
+
+    :param name: エンジン名（settings.segmentation_engine で指定する名前）
+    :param factory: factory(lang) → segment(text) を持つオブジェクト
+    """
+    _registry[name] = factory
+    with _instances_lock:
+        for key in [k for k in _instances if k[0] == name]:
+            del _instances[key]
+
+
+def available_segmenters():
+    return sorted(_registry)
+
+
+def get_segmenter(name=segmentation_engine, lang="en"):
+    """
+    登録済みのエンジンを返す（エンジン・言語ごとに1回だけ作成）
+    """
+    if name not in _registry:
+        raise ValueError(f"unknown segmentation engine: {name} (choose from {', '.join(available_segmenters())})")
+
+    key = (name, lang)
+    with _instances_lock:
+        if key not in _instances:
+            _instances[key] = _registry[name](lang)
+        return _instances[key]
+
+
+def segment(text, lang="en", name=segmentation_engine):
+    """
+    1文書の文分割
+
+    :return: 文リスト
+    """
+    return get_segmenter(name, lang).segment(text)
+
+
+# =====
+# エンジン
+# =====
+class PysbdSegmenter:
+    """
+    pysbd (rule-based, pure Python). Reference for the agreement report.
+
+    pysbd.Segmenter keeps the text being segmented on the instance, so one
+    instance is kept per thread (Streamlit sessions, warmup, load test
+    workers share this object).
+    """
+
+    def __init__(self, lang="en"):
+        import pysbd
+        self.lang = lang
+        self._local = threading.local()
+        self._segmenter() # 言語の確認・import を初回に行う
+
+    def _segmenter(self):
+        import pysbd
+
+        segmenter = getattr(self._local, "segmenter", None)
+        if segmenter is None:
+            segmenter = pysbd.Segmenter(language=self.lang, clean=False)
+            self._local.segmenter = segmenter
+        return segmenter
+
+    def segment(self, text):
+        return self._segmenter().segment(text)
+
+
+class RegexSegmenter:
+    """
+    Single-pass boundary scanner for counseling transcripts.
+
+    One compiled pattern finds every candidate (terminal punctuation runs
+    with trailing closers, and newlines); each candidate is accepted or
+    rejected from a few characters of context, so the cost is linear in
+    the text with no per-rule passes.
+    """
+
+    def __init__(self, lang="en"):
+        self.lang = lang
+
+    def segment(self, text):
+        sentences = []
+        start = 0
+        pos = 0
+        n = len(text)
+
+        while pos < n:
+            match = _CANDIDATE.search(text, pos)
+            if match is None:
+                break
+
+            pos = match.end()
+            if not self._is_boundary(text, match, start):
+                continue
+
+            # 区切りの後の空白は前の文に含める
+            end = _TRAILING_SPACE.match(text, pos).end()
+            sentences.append(text[start:end])
+            start = pos = end
+
+        if start < n:
+            sentences.append(text[start:])
+        return sentences
+
+    def _is_boundary(self, text, match, start):
+        """
+        区切り候補を区切るか判定する
+        """
+        token = match.group()
+        after = match.end()
+
+        # 改行は常に区切る（逐語録は1行1ターン）
+        if token == "\n":
+            return True
+
+        # 本文の末尾
+        nxt = _TRAILING_SPACE.match(text, after).end()
+        if nxt >= len(text):
+            return True
+
+        # 日本語の句点：閉じ括弧の後に文が続く場合のみ区切らない
+        terminal = token.rstrip("\"'”’」』）)]")
+        if terminal[-1] in _JA_TERMINALS:
+            return terminal == token or nxt > after
+
+        # 英文：終止符の後に空白がない（小数・URL・略語の途中）
+        if nxt == after:
+            return False
+
+        # ! ? は空白が続けば区切る（pysbd と同じ）
+        if terminal[-1] in "!?":
+            return True
+
+        # 三点リーダー：小文字が続く場合は文の途中
+        following = text[nxt]
+        if terminal != ".":
+            return not following.islower()
+
+        # 敬称・イニシャル・行頭の番号
+        word = _PREVIOUS_WORD.search(text, max(start, match.start() - 24), match.start()).group()
+        if word.lower() in TITLES:
+            return False
+        if word.lower() in NUMBER_ABBREVIATIONS and following.isdigit():
+            return False
+        if len(word) == 1 and word.isupper():
+            return False
+        if word.isdigit() and len(word) <= 2 and not text[start:match.start() - len(word)].strip():
+            return False
+
+        # 小文字で始まる文（"ok. yeah i know"）は区切り、略語（e.g. p.m. etc.）の後は区切らない
+        if following.islower():
+            return "." not in word and word.lower() not in ABBREVIATIONS
+        return True
+
+
+register_segmenter("pysbd", PysbdSegmenter)
+register_segmenter("regex", RegexSegmenter)
+
+
+# =====
+# 複数文書の並列分割
+# =====
+def _segment_batch(name, langs, texts):
+    return [get_segmenter(name, lang).segment(text) for lang, text in zip(langs, texts)]
+
+
+def segment_many(texts, lang="en", name=segmentation_engine, workers=segmentation_workers,
+                 min_chars=segmentation_parallel_min_chars):
+    """
+    複数文書をプロセスに分けて文分割する（文書の順序は保持）
+
+    :param texts: 文書リスト
+    :param lang: 言語（全文書共通）または文書ごとの言語リスト
+    :param workers: プロセス数（0 の場合は CPU 数）
+    :param min_chars: 合計文字数がこれ未満、または workers が 1 の場合は並列化しない
+    :return: 文書ごとの文リスト
+    """
+    texts = list(texts)
+    langs = [lang] * len(texts) if isinstance(lang, str) else list(lang)
+    workers = workers or os.cpu_count() or 1
+    total = sum(len(t) for t in texts)
+
+    if workers <= 1 or len(texts) < 2 or total < min_chars:
+        return _segment_batch(name, langs, texts)
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    # 文字数がほぼ均等になるようにまとめる（1プロセスあたり数バッチ）
+    target = max(total // (workers * 4), 1)
+    batches = []
+    current, size = [], 0
+    for i, text in enumerate(texts):
+        current.append(i)
+        size += len(text)
+        if size >= target:
+            batches.append(current)
+            current, size = [], 0
+    if current:
+        batches.append(current)
+
+    results = [None] * len(texts)
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=min(workers, len(batches)), mp_context=ctx) as pool:
+        futures = [
+            (batch, pool.submit(_segment_batch, name, [langs[i] for i in batch], [texts[i] for i in batch]))
+            for batch in batches
+        ]
+        for batch, future in futures:
+            for i, sentences in zip(batch, future.result()):
+                results[i] = sentences
+    return results
+
+
+# =====
+# 比較（pysbd との一致度・速度）
+# =====
+def boundary_offsets(text, sentences):
+    """
+    文の区切り位置（各文の末尾の空白を除いた終了位置）
+
+    :return: set
+    """
+    offsets = set()
+    pos = 0
+    for sent in sentences:
+        start = text.find(sent, pos)
+        if start < 0:
+            continue
+        pos = start + len(sent)
+        offsets.add(start + len(sent.rstrip()))
+    # 本文の末尾は常に区切りのため数えない
+    offsets.discard(len(text.rstrip()))
+    return offsets
+
+
+def synthetic_transcripts(n_docs=200, seed=0, ja_ratio=0.2):
+    """
+    参照DBの文を使った逐語録形式の疑似データ（話者・タイムスタンプ・三点リーダー・敬称を含む）
+
+    :return: [(doc_id, text)]
+    """
+    import random
+    from taxonomy import definition_texts
+
+    # 定義文（複数文を含む）をそのまま発話として使う
+    pools = {lang: definition_texts(lang) for lang in ["en", "ja"]}
+    speakers = {"en": ["Client", "Therapist"], "ja": ["クライアント", "カウンセラー"]}
+    fillers = {
+        "en": ["Mm-hm.", "I just... I don't know.", "Dr. Smith said it was fine.", "It was around 10.30 a.m.",
+               "Really?! Yes.", "\"Stop it.\" That's what she said.", "Okay...", "I said no. He agreed.",
+               "Well, no. I don't think so.", "It was No. 5 on the list."],
+        "ja": ["うーん…", "「大丈夫。」と言われました。", "そうですね。", "本当に？はい。"]
+    }
+
+    rng = random.Random(seed)
+    docs = []
+    for i in range(n_docs):
+        lang = "ja" if rng.random() < ja_ratio else "en"
+        lines = []
+        seconds = 0
+        for turn in range(rng.randint(10, 40)):
+            seconds += rng.randint(3, 40)
+            stamp = f"[{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}]"
+            body = [rng.choice(pools[lang] + fillers[lang]) for _ in range(rng.randint(1, 4))]
+            sep = "" if lang == "ja" else " "
+            lines.append(f"{stamp} {speakers[lang][turn % 2]}: {sep.join(body)}")
+        docs.append((f"synthetic-transcript-{i}", "\n".join(lines)))
+    return docs
+
+
+def chars_per_second(name, texts, langs, repeat=3):
+    """
+    1プロセスでの文分割速度（repeat 回の最速）
+    """
+    total = sum(len(t) for t in texts)
+    for lang in set(langs):
+        get_segmenter(name, lang)
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        _segment_batch(name, langs, texts)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return total / best if best else None
+
+
+def check_thread_safety(name=segmentation_engine, texts=None, lang="en", threads=8, repeat=5):
+    """
+    同じエンジンを複数スレッドから同時に呼び、1スレッドでの結果と一致するかを確認する
+    （Streamlit のセッション・ウォームアップ・負荷試験のワーカーは get_segmenter() の同じインスタンスを使う）
+
+    :param texts: 文書（省略時は疑似データ、スレッドごとに別の文書）
+    :return: {"engine", "threads", "runs", "mismatches", "ok"}
+    """
+    if texts is None:
+        texts = [text for _, text in synthetic_transcripts(threads, ja_ratio=0.0)]
+    segmenter = get_segmenter(name, lang)
+    expected = [segmenter.segment(text) for text in texts]
+
+    barrier = threading.Barrier(threads)
+    mismatches = []
+
+    def run(i):
+        text = texts[i % len(texts)]
+        barrier.wait()
+        for _ in range(repeat):
+            if segmenter.segment(text) != expected[i % len(texts)]:
+                mismatches.append(i)
+
+    workers = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+    return {
+        "engine": name,
+        "threads": threads,
+        "runs": threads * repeat,
+        "mismatches": len(mismatches),
+        "ok": not mismatches
+    }
+
+
+def compare_segmenters(docs, candidates=None, reference="pysbd", workers=segmentation_workers,
+                       min_agreement=0.95, n_samples=5):
+    """
+    各エンジンの pysbd との一致度（区切り位置の適合率・再現率・F1）と文字/秒を比較し、既定にするエンジンを推奨する
+    （一致度 F1 が min_agreement 以上で、複数スレッドから使っても結果が変わらないエンジンのうち最速のもの）
+
+    :param docs: [(doc_id, text)]
+    :return: 比較結果
+    """
+    from text_analyzer import detect_language
+
+    candidates = candidates or [n for n in available_segmenters() if n != reference]
+    texts = [text for _, text in docs]
+    langs = [detect_language(text) for text in texts]
+    reference_out = _segment_batch(reference, langs, texts)
+
+    engines = {reference: {"f1": 1.0}}
+    for name in candidates:
+        out = _segment_batch(name, langs, texts)
+        tp = fp = fn = exact = 0
+        samples = []
+        for (doc_id, text), ref, cand in zip(docs, reference_out, out):
+            a, b = boundary_offsets(text, ref), boundary_offsets(text, cand)
+            tp += len(a & b)
+            fp += len(b - a)
+            fn += len(a - b)
+            exact += a == b
+            for pos in sorted(a ^ b)[:max(n_samples - len(samples), 0)]:
+                samples.append({
+                    "doc_id": doc_id,
+                    "only_in": reference if pos in a else name,
+                    "context": text[max(pos - 40, 0):pos] + " ‖ " + text[pos:pos + 40]
+                })
+
+        precision = tp / (tp + fp) if tp + fp else 1.0
+        recall = tp / (tp + fn) if tp + fn else 1.0
+        engines[name] = {
+            "sentences": sum(len(s) for s in out),
+            "precision": precision,
+            "recall": recall,
+            "f1": 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+            "exact_documents": exact / len(docs) if docs else None,
+            "disagreements": samples
+        }
+    engines[reference]["sentences"] = sum(len(s) for s in reference_out)
+
+    # 速度（1プロセス・並列）
+    for name, row in engines.items():
+        row["chars_per_second"] = chars_per_second(name, texts, langs)
+        start = time.perf_counter()
+        segment_many(texts, langs, name=name, workers=workers, min_chars=0)
+        row["parallel_chars_per_second"] = sum(len(t) for t in texts) / (time.perf_counter() - start)
+
+        # 同じインスタンスを複数スレッドで使っても結果が変わらないか
+        row["thread_safe"] = check_thread_safety(name, texts[:8])["ok"]
+
+    eligible = [n for n, row in engines.items() if row["f1"] >= min_agreement and row["thread_safe"]]
+    return {
+        "docs": len(docs),
+        "chars": sum(len(t) for t in texts),
+        "languages": {lang: langs.count(lang) for lang in set(langs)},
+        "reference": reference,
+        "workers": workers or os.cpu_count(),
+        "engines": engines,
+        "min_agreement": min_agreement,
+        "recommended": max(eligible, key=lambda n: engines[n]["chars_per_second"])
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MILD-7 sentence segmentation")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    compare = sub.add_parser("compare", help="agreement with pysbd and chars/sec per engine")
+    compare.add_argument("--corpus", default=None, help="directory of .txt or JSON Lines (default: synthetic)")
+    compare.add_argument("--docs", type=int, default=200, help="synthetic transcripts")
+    compare.add_argument("--workers", type=int, default=segmentation_workers)
+    compare.add_argument("--min-agreement", type=float, default=0.95)
+
+    threads = sub.add_parser("check-threads", help="run one engine from several threads at once")
+    threads.add_argument("--engine", default=segmentation_engine)
+    threads.add_argument("--threads", type=int, default=8)
+    threads.add_argument("--repeat", type=int, default=5)
+
+    seg = sub.add_parser("segment", help="print the sentences of one file")
+    seg.add_argument("path")
+    seg.add_argument("--engine", default=segmentation_engine)
+    seg.add_argument("--lang", default=None, help="default: detected")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        if args.corpus:
+            from loadtest import load_corpus
+            docs = load_corpus(args.corpus)
+        else:
+            docs = synthetic_transcripts(args.docs)
+        result = compare_segmenters(docs, workers=args.workers, min_agreement=args.min_agreement)
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+
+    elif args.command == "check-threads":
+        result = check_thread_safety(args.engine, threads=args.threads, repeat=args.repeat)
+        print(json.dumps(result, indent=2))
+        if not result["ok"]:
+            sys.exit(1)
+
+    elif args.command == "segment":
+        from text_analyzer import detect_language
+        with open(args.path, encoding="utf-8") as f:
+            text = f.read()
+        for sent in segment(text, args.lang or detect_language(text), args.engine):
+            print(repr(sent))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,13 @@
 settings
 各種参照先を定義
 """
+import os
+
+# 保存先の基準（起動時のカレントディレクトリに依存しないよう、このファイルの場所から作る）
+# 負荷試験などでは環境変数 MILD7_DATA_DIR で別の場所に切り替える
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.environ.get("MILD7_DATA_DIR") or os.path.join(BASE_DIR, "data")
+
 # === models ===
 # MniLM のURL
 mnilm_url = r""
@@ -11,3 +18,183 @@ medgemma_url = r"" # モデル指定
 
 # Gemme のURL
 gemma_url = r""
+
+
+# === runtime ===
+# MiniLM をプロセス内に常駐させるか（False の場合は推論ごとにロード・解放）
+minilm_resident = True
+
+# UI 描画後にバックグラウンドでモデルを先読みするか
+warmup_on_start = True
+
+# === language ===
+# 文分割の言語（"auto" は文書ごとに判定、"en" / "ja" で固定）
+analysis_lang = "auto"
+
+# 参照ベクトルの言語（"auto" は文書の言語に合わせる、"multi" は英日統合版、"en" / "ja" で固定）
+reference_lang = "auto"
+
+# === storage ===
+# クライアント別セッション履歴（SQLite）の保存先
+longitudinal_db_path = os.path.join(DATA_DIR, "longitudinal.sqlite3")
+
+# === LLM scheduling ===
+# MiniLM 層の結果で Gemma / MedGemma の実行順・生成長を切り替えるか
+llm_gating = False
+
+# スケジューラの判定基準（変更時は監査ログの policy_version が変わる）
+scheduler_policy = {
+    # リスク評価に使うラベルと重み（レベル点数 × 重みを合計）
+    "risk_labels": {
+        "injunctions": {"Don't exist": 1.0, "Don't belong": 0.5, "Don't be close": 0.3},
+        "emotions": {"loneliness": 0.6, "negativity": 0.6, "sadness": 0.4},
+    },
+    # strength_max_score のレベルごとの点数
+    "level_points": {
+        "Very Strong Signal": 3,
+        "Strong Signal": 2,
+        "Moderate Signal": 1,
+        "Weak Signal": 0,
+    },
+    # この点数以上を高リスクとして MedGemma を先に実行
+    "high_risk_score": 3.0,
+    # 全ラベルの最大スコアがこの値未満なら低シグナル
+    "low_signal_peak": 0.45,
+    # 区分ごとの生成トークン数
+    "max_new_tokens": {
+        "high": {"gemma": 1000, "medgemma": 1000},
+        "normal": {"gemma": 1000, "medgemma": 1000},
+        "low": {"gemma": 300, "medgemma": 400},
+    },
+    # 低シグナルをキューで後回しにするか（バッチ実行時）
+    "defer_low_signal": True,
+}
+
+# スケジューラ判定の監査ログ（JSON Lines、空文字で記録しない）
+scheduler_audit_path = os.path.join(DATA_DIR, "scheduler_audit.jsonl")
+
+# === near-duplicate reuse ===
+# 類似文書の LLM 結果の扱い（"reuse": 再利用する / "flag": 画面に表示のみ / "off": 使用しない）
+# 照合は同じ client_id の文書どうしに限る（client_id なしの実行はそれらどうしで照合）
+# 有効にすると文書の指紋と LLM 結果が dedup_db_path に保存される
+dedup_mode = "off"
+
+# 類似判定のしきい値（文ベクトル平均のコサイン類似度・文単位 MinHash の推定 Jaccard 係数）
+dedup_embedding_threshold = 0.97
+dedup_jaccard_threshold = 0.8
+
+# 指紋インデックス（SQLite）の保存先
+dedup_db_path = os.path.join(DATA_DIR, "dedup_index.sqlite3")
+
+# === evidence search index ===
+# 解析した全文をコーパス横断の検索インデックスに登録するか
+# 有効にすると、すべての transcript の各文の本文が evidence_index_dir にディスク保存される
+# （削除・保持期間の管理は別途必要。文ベクトル・スコアも保存される）
+evidence_index_enabled = True
+
+# インデックスの保存先（SQLite のメタデータ + メモリマップの文ベクトル・スコア）
+evidence_index_dir = os.path.join(DATA_DIR, "evidence_index")
+
+# この文数に達したらクラスタ（IVF）を作成し、以降はクラスタ単位で検索
+evidence_index_train_size = 20000
+
+# 1クラスタあたりの目標文数（rebuild 時のクラスタ数 = 文数 / この値）
+evidence_index_list_size = 2000
+
+# 自由文検索で走査するクラスタ数
+evidence_index_nprobe = 8
+
+# === machine profile (autotune) ===
+# autotune.py が作成したマシンプロファイルを起動時に読み込むか
+use_machine_profile = True
+
+# マシンプロファイルの保存先（ハードウェアが一致しない場合は既定値を使用）
+# 共有ディレクトリを使う場合は "{hostname}" を含めるとノードごとに分けて保存する
+machine_profile_path = os.path.join(DATA_DIR, "machine_profile.json")
+
+# === Gemma memory cleanup ===
+# 推論後のメモリ解放を待つスリープ秒数（soak.py で安定性を確認できれば 0 にしてよい）
+gemma_cleanup_sleep = 2
+
+# === weight snapshots ===
+# 変換済みの重みスナップショット（weight_snapshot.py convert）があれば from_pretrained の代わりに使うか
+use_weight_snapshots = True
+
+# スナップショットの保存先（モデルごとにディレクトリを作成、別の場所に保存する場合はここを変更する）
+weight_snapshot_dir = os.path.join(DATA_DIR, "snapshots")
+
+# === shared base weights (Gemma + MedGemma) ===
+# Gemma を1回だけ読み込んで常駐させ、MedGemma は差分（weight_delta.py build）を適用して使うか
+shared_base_mode = False
+
+# MedGemma の差分の保存先
+medgemma_delta_dir = os.path.join(DATA_DIR, "medgemma_delta")
+
+# 差分の許容誤差（テンソルごとの相対誤差 ||近似 − 差分|| / ||差分||）
+delta_tolerance = 0.01
+
+# 低ランク近似で試す最大ランク
+delta_max_rank = 128
+
+# === structured output ===
+# Gemma / MedGemma の出力を JSON スキーマに制約するか（structured_output.py、app では項目ごとに表示）
+structured_output = False
+
+# === Parquet export ===
+# 解析結果を日付パーティションの Parquet（文書・ラベル・根拠文の3表）に書き出すか
+parquet_export_enabled = False
+
+# 書き出し先（表ごとに {表名}/date=YYYY-MM-DD/ を作成）
+parquet_export_dir = os.path.join(DATA_DIR, "parquet")
+
+# 1ファイルにまとめる行数の目安（この行数に達した表から書き込む）
+parquet_export_batch_rows = 5000
+
+# 行数に達しなくても、この秒数たったら書き込む
+parquet_export_flush_seconds = 30
+
+# === encoding mode ===
+# 文のエンコード方法（"sentence": 文ごと / "token_pooled": 長いチャンクを1回エンコードし、トークンから文・窓をプーリング）
+encoding_mode = "sentence"
+
+# token_pooled の窓の文数（連続する文にまたがるシグナルを拾う、1 で窓なし）
+token_pooling_window = 2
+
+# token_pooled の1チャンクのトークン数（モデルの位置埋め込みの上限まで）
+token_pooling_chunk_tokens = 256
+
+# === reference taxonomy ===
+# 参照タクソノミー（定義文）の JSON ファイル（空文字の場合は constants の組み込み定義、taxonomy.py export で作成）
+taxonomy_path = r""
+
+# 定義ファイルの更新を確認する間隔（秒、更新されていれば変更分のみ再エンコードして差し替え）
+taxonomy_reload_seconds = 5
+
+# === KV cache ===
+# Gemma / MedGemma 生成時の KV キャッシュの方式（kv_cache.py bench で出力の一致度を確認してから変更）
+# "default": モデル既定 / "quantized": int8・int4 で保持 / "offloaded": GPU から CPU へ退避
+kv_cache_mode = "default"
+
+# quantized のビット数（4: optimum-quanto、8: hqq が必要）
+kv_cache_nbits = 4
+
+# quantized で量子化せずに保持する直近のトークン数
+kv_cache_residual_length = 128
+
+# === sentence segmentation ===
+# 文分割エンジン（"pysbd" / "regex"、segmenter.py compare で pysbd との一致度と速度を確認して選ぶ）
+segmentation_engine = "pysbd"
+
+# segment_many のプロセス数（0 の場合は CPU 数）
+segmentation_workers = 0
+
+# 合計文字数がこれ未満の場合は segment_many を並列化しない（プロセス起動の方が高くつくため）
+segmentation_parallel_min_chars = 2000000
+
+# === pre-filter ===
+# 情報量の少ない発話（相づち・つなぎ言葉）をエンコード前に除くか（prefilter.py compare で根拠文の差分を確認して選ぶ）
+# "off": すべてエンコード / "drop": 相づちと短い文を除く / "merge": 相づちを除き、短い文は前後の文とまとめる
+prefilter_mode = "off"
+
+# この語数未満で参照定義の語彙・否定語を含まない文を「短い文」とする
+prefilter_min_words = 3
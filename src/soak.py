@@ -0,0 +1,295 @@
+"""
+soak
+backend.main を長時間繰り返し実行し、メモリリーク・断片化を検出する耐久試験
+
+毎回の実行後に RSS・Python ヒープ（tracemalloc）・GPU メモリを記録し、
+ウォームアップ後に単調に増え続けるものを、確保している呼び出し箇所とともに報告する。
+- RSS が増えるのに Python ヒープが増えない → ネイティブ側のリークまたは断片化
+- GPU の reserved − allocated が増える → キャッシュアロケータの断片化
+
+長時間稼働のワーカーが安定していること、make_model の待機（settings.gemma_cleanup_sleep）を
+外しても問題ないことの確認に使う。
+
+Usage:
+    python soak.py --iterations 2000
+    python soak.py --corpus transcripts/ --iterations 5000 --samples soak_samples.jsonl
+    python soak.py --real --iterations 200 --cleanup-sleep 0
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+import psutil
+from loadtest import synthetic_corpus, load_corpus, backend_target, percentiles, use_workdir
+
+# 傾向を判定する区間数（区間ごとの中央値が減らなければ単調増加とみなす）
+TREND_WINDOWS = 10
+
+# 呼び出し箇所として表示するフレーム数
+SITE_FRAMES = 4
+
+
+# =====
+# 計測
+# =====
+def device_memory():
+    """
+    GPU メモリ（torch を読み込み済みで CUDA がある場合のみ）
+
+    :return: {"allocated", "reserved"}（バイト）or None
+    """
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available():
+        return None
+
+    devices = range(torch.cuda.device_count())
+    return {
+        "allocated": sum(torch.cuda.memory_allocated(i) for i in devices),
+        "reserved": sum(torch.cuda.memory_reserved(i) for i in devices)
+    }
+
+
+def take_sample(process, iteration, seconds):
+    traced, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+
+    sample = {
+        "iteration": iteration,
+        "seconds": seconds,
+        "rss": process.memory_info().rss,
+        "traced": traced,
+        "traced_peak": traced_peak
+    }
+    device = device_memory()
+    if device is not None:
+        sample["device_allocated"] = device["allocated"]
+        sample["device_reserved"] = device["reserved"]
+    return sample
+
+
+def growth_trend(values, min_growth):
+    """
+    系列の増加傾向（最小二乗の傾き・区間中央値の単調性）
+
+    :param values: ウォームアップ後の値
+    :param min_growth: 増加とみなす最小の増加量（バイト）
+    :return: {"slope_per_iteration", "growth", "monotonic", "window_medians"}
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) < TREND_WINDOWS * 2:
+        return None
+
+    slope = float(np.polyfit(np.arange(len(values)), values, 1)[0])
+    medians = [float(np.median(w)) for w in np.array_split(values, TREND_WINDOWS)]
+    growth = medians[-1] - medians[0]
+
+    return {
+        "slope_per_iteration": slope,
+        "growth": growth,
+        "monotonic": bool(growth >= min_growth and all(b >= a for a, b in zip(medians, medians[1:]))),
+        "window_medians": medians
+    }
+
+
+def _snapshot():
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        tracemalloc.Filter(False, "<unknown>"),
+        # 計測側（このスクリプト・psutil）の確保は除外
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, os.path.join(os.path.dirname(psutil.__file__), "*"))
+    ])
+
+
+def _site(traceback):
+    # 呼び出し元に近いフレームから SITE_FRAMES 個
+    frames = list(traceback)[-SITE_FRAMES:]
+    return " <- ".join(f"{os.path.basename(f.filename)}:{f.lineno}" for f in reversed(frames))
+
+
+def growing_sites(checkpoints, min_bytes):
+    """
+    チェックポイントごとに増え続けた確保箇所
+
+    :param checkpoints: [{site: ウォームアップ時点からの増加量}]
+    :param min_bytes: 報告する最小の増加量
+    :return: 増加量の大きい順のリスト
+    """
+    if len(checkpoints) < 2:
+        return []
+
+    sites = []
+    for site, final in checkpoints[-1].items():
+        series = [cp.get(site, 0) for cp in checkpoints]
+        if final >= min_bytes and all(b >= a for a, b in zip(series, series[1:])):
+            sites.append({"site": site, "growth": final, "series": series})
+
+    return sorted(sites, key=lambda s: -s["growth"])
+
+
+# =====
+# 実行
+# =====
+def run_soak(target, corpus, iterations=1000, warmup=50, checkpoint_every=100,
+             trace_frames=SITE_FRAMES, collect=True, samples_path=None):
+    """
+    耐久試験を実行する
+
+    :param target: loadtest.backend_target() の戻り値
+    :param corpus: [(doc_id, text)]（繰り返し送る）
+    :param iterations: 実行回数
+    :param warmup: 判定から除外する最初の回数（キャッシュ・遅延 import の初期化分）
+    :param checkpoint_every: tracemalloc のスナップショットを取る間隔
+    :param collect: 毎回 gc.collect() してから計測するか
+    :param samples_path: 毎回の計測値を書き出す JSON Lines（None の場合は書き出さない）
+    :return: (計測値のリスト, チェックポイントのリスト)
+    """
+    process = psutil.Process()
+    tracemalloc.start(trace_frames)
+
+    samples = []
+    checkpoints = []
+    baseline = None
+    out = open(samples_path, "w", encoding="utf-8") if samples_path else None
+
+    try:
+        for i in range(iterations):
+            doc_id, text = corpus[i % len(corpus)]
+            start = time.perf_counter()
+            target(doc_id, text, None)
+            elapsed = time.perf_counter() - start
+
+            if collect:
+                gc.collect()
+
+            sample = take_sample(process, i, elapsed)
+            samples.append(sample)
+            if out:
+                out.write(json.dumps(sample) + "\n")
+
+            if i + 1 == warmup:
+                baseline = _snapshot()
+            elif baseline is not None and (i + 1 - warmup) % checkpoint_every == 0:
+                diff = _snapshot().compare_to(baseline, "traceback")
+                checkpoints.append({_site(d.traceback): d.size_diff for d in diff if d.size_diff > 0})
+    finally:
+        tracemalloc.stop()
+        if out:
+            out.close()
+
+    return samples, checkpoints
+
+
+def analyze_soak(samples, checkpoints, warmup, min_growth_mb=4.0, min_site_kb=64):
+    """
+    計測値からリーク・断片化を判定する
+
+    :return: レポート
+    """
+    steady = samples[warmup:]
+    min_growth = min_growth_mb * 2**20
+
+    series = {
+        "rss": [s["rss"] for s in steady],
+        "traced": [s["traced"] for s in steady],
+        # Python ヒープ外の増加（ネイティブのリーク・断片化）
+        "rss_untraced": [s["rss"] - s["traced"] for s in steady]
+    }
+    if steady and "device_allocated" in steady[0]:
+        series["device_allocated"] = [s["device_allocated"] for s in steady]
+        series["device_fragmentation"] = [s["device_reserved"] - s["device_allocated"] for s in steady]
+
+    trends = {name: growth_trend(values, min_growth) for name, values in series.items()}
+    flags = [name for name, trend in trends.items() if trend and trend["monotonic"]]
+
+    return {
+        "iterations": len(samples),
+        "warmup": warmup,
+        "latency_seconds": percentiles([s["seconds"] for s in steady]),
+        "start_rss_mb": samples[0]["rss"] / 2**20 if samples else None,
+        "end_rss_mb": samples[-1]["rss"] / 2**20 if samples else None,
+        "trends": trends,
+        "growing_sites": growing_sites(checkpoints, min_site_kb * 1024)[:20],
+        "stable": not flags,
+        "flags": flags
+    }
+
+
+def print_report(report):
+    print(f"iterations {report['iterations']} (warmup {report['warmup']})  "
+          f"RSS {report['start_rss_mb']:.0f} -> {report['end_rss_mb']:.0f} MB")
+
+    for name, trend in report["trends"].items():
+        if trend is None:
+            print(f"{name:<22} not enough samples")
+            continue
+        mark = "GROWING" if trend["monotonic"] else "ok"
+        print(f"{name:<22} {mark:<8} growth {trend['growth'] / 2**20:8.2f} MB  "
+              f"slope {trend['slope_per_iteration'] / 1024:8.2f} KB/iter")
+
+    if report["growing_sites"]:
+        print("\nallocation sites growing at every checkpoint:")
+        for site in report["growing_sites"][:10]:
+            print(f"  {site['growth'] / 1024:10.1f} KB  {site['site']}")
+
+    print("\nSTABLE" if report["stable"] else f"\nUNSTABLE: {', '.join(report['flags'])}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MILD-7 soak test (memory growth over repeated runs)")
+    parser.add_argument("--corpus", help="directory of .txt files or JSON Lines (default: synthetic)")
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--checkpoint-every", type=int, default=100)
+    parser.add_argument("--trace-frames", type=int, default=SITE_FRAMES)
+    parser.add_argument("--no-collect", action="store_true", help="do not gc.collect() before sampling")
+    parser.add_argument("--min-growth-mb", type=float, default=4.0)
+    parser.add_argument("--min-site-kb", type=float, default=64)
+    parser.add_argument("--real", action="store_true", help="use the real models instead of stand-ins")
+    parser.add_argument("--cleanup-sleep", type=float, default=None, help="override settings.gemma_cleanup_sleep")
+    parser.add_argument("--workdir", help="working directory for the data stores (default: temporary)")
+    parser.add_argument("--samples", help="write per-iteration samples (JSON Lines)")
+    parser.add_argument("--json", help="write the report to this file")
+
+    args = parser.parse_args(argv)
+    samples_path = os.path.abspath(args.samples) if args.samples else None
+    json_path = os.path.abspath(args.json) if args.json else None
+    corpus_path = os.path.abspath(args.corpus) if args.corpus else None
+
+    # ストアを作業ディレクトリに分離（settings を読み込む前に切り替える）
+    use_workdir(args.workdir, prefix="mild7-soak-")
+
+    corpus = load_corpus(corpus_path) if corpus_path else synthetic_corpus()
+    if not corpus:
+        parser.error("corpus is empty")
+    if args.iterations <= args.warmup:
+        parser.error("--iterations must be larger than --warmup")
+
+    if args.cleanup_sleep is not None:
+        import gemmas_engine
+        gemmas_engine.gemma_cleanup_sleep = args.cleanup_sleep
+
+    target = backend_target(standin=not args.real)
+
+    samples, checkpoints = run_soak(
+        target, corpus, args.iterations, args.warmup, args.checkpoint_every,
+        args.trace_frames, not args.no_collect, samples_path
+    )
+    report = analyze_soak(samples, checkpoints, args.warmup, args.min_growth_mb, args.min_site_kb)
+    print_report(report)
+
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    sys.exit(0 if report["stable"] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+standin_models
+モデルなしでパイプラインを動かすためのスタンドイン（代替）モデル
+
+バッチ実行・負荷試験・耐久試験をオフラインで行うために使用する。
+- HashingEncoder: MiniLM の代わりに単語ハッシュで文ベクトルを作成
+- standin_gemma_engine / standin_madgemma_engine: 生成トークン数に比例して待機し、決まった文字列を返す
+  （同時実行数は STANDIN_DEVICES までに制限し、GPU の取り合いを再現する）
+
+install_standin_models() で backend の各段階をスタンドインに差し替える。
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import numpy as np
+
+# MiniLM と同じ次元数
+EMBEDDING_DIM = 384
+
+# 1トークンあたりの疑似生成時間（秒）
+SECONDS_PER_TOKEN = float(os.environ.get("MILD7_STANDIN_SECONDS_PER_TOKEN", "0.0005"))
+
+# 疑似生成で出力するトークン数の上限
+STANDIN_OUTPUT_TOKENS = 200
+
+# 呼び出しごとのモデル読み込み時間（秒、make_model は推論のたびにモデルを読み込む）
+STANDIN_LOAD_SECONDS = float(os.environ.get("MILD7_STANDIN_LOAD_SECONDS", "0"))
+
+# 同時に LLM を実行できる数（GPU 台数に相当、超えた呼び出しは待機する）
+STANDIN_DEVICES = int(os.environ.get("MILD7_STANDIN_DEVICES", "1"))
+_device_slots = threading.BoundedSemaphore(STANDIN_DEVICES)
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+class HashingEncoder:
+    """
+    Deterministic stand-in for SentenceTransformer.encode().
+
+    Each word is mapped to a fixed pseudo-random vector (seeded by its hash)
+    and a sentence embedding is the sum of its word vectors.
+    """
+
+    # taxonomy の定義文ベクトルは MiniLM と分けて保持する（ファイルには保存しない）
+    taxonomy_cache_key = "standin-hashing"
+
+    def __init__(self, dim=EMBEDDING_DIM):
+        self.dim = dim
+        self._word_vectors = {}
+
+    def _word_vector(self, word):
+        vec = self._word_vectors.get(word)
+        if vec is None:
+            seed = int.from_bytes(hashlib.md5(word.encode("utf-8")).digest()[:8], "little")
+            vec = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+            self._word_vectors[word] = vec
+        return vec
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def encode(self, sentences, **kwargs):
+        if isinstance(sentences, str):
+            return self.encode([sentences])[0]
+
+        out = np.zeros((len(sentences), self.dim), dtype=np.float32)
+        for i, sent in enumerate(sentences):
+            # 日本語は単語区切りがないため文字単位
+            words = _TOKEN_RE.findall(sent.lower()) or list(sent)
+            for word in words:
+                out[i] += self._word_vector(word)
+        return out
+
+    # === token_pooling 用（単語をトークンとみなす） ===
+    def count_tokens(self, sentences):
+        return [len(_TOKEN_RE.findall(sent.lower())) or len(sent) for sent in sentences]
+
+    def token_embeddings(self, chunks):
+        out = []
+        for chunk in chunks:
+            matches = list(_TOKEN_RE.finditer(chunk.lower()))
+            vectors = np.asarray([self._word_vector(m.group()) for m in matches], dtype=np.float32)
+            offsets = np.asarray([m.span() for m in matches], dtype=np.int64).reshape(-1, 2)
+            out.append((vectors.reshape(-1, self.dim), offsets))
+        return out
+
+
+_encoder = None
+
+
+def standin_reference_embeddings(encoder, lang="en"):
+    """
+    スタンドイン用の参照ベクトル（現在の taxonomy から作成、キャッシュファイルには保存しない）
+    """
+    import taxonomy
+
+    return taxonomy.current().reference_embeddings(encoder, lang)
+
+
+def get_standin_encoder():
+    """
+    スタンドインのエンコーダ（プロセス内で1回だけ作成）と現在の参照ベクトルを取得する
+
+    :return: (encoder, ref_embeddings)
+    """
+    global _encoder
+
+    if _encoder is None:
+        _encoder = HashingEncoder()
+    return _encoder, standin_reference_embeddings(_encoder)
+
+
+def standin_text_analyzer(text, return_analysis=False):
+    """
+    text_analyzer のスタンドイン版（文分割・判定・プロンプト作成は本物を使用）
+    """
+    import taxonomy
+    from text_analyzer import text_analyzer
+
+    encoder, _ = get_standin_encoder()
+    taxonomy.maybe_reload(encoder)
+    refs = standin_reference_embeddings(encoder)
+    return text_analyzer(text, return_analysis=return_analysis, model=encoder, ref_embeddings=refs)
+
+
+def configure_standins(seconds_per_token=None, load_seconds=None, devices=None):
+    """
+    スタンドインの疑似生成時間・読み込み時間・同時実行数を変更する（負荷試験用）
+    """
+    global SECONDS_PER_TOKEN, STANDIN_LOAD_SECONDS, STANDIN_DEVICES, _device_slots
+
+    if seconds_per_token is not None:
+        SECONDS_PER_TOKEN = seconds_per_token
+    if load_seconds is not None:
+        STANDIN_LOAD_SECONDS = load_seconds
+    if devices is not None:
+        STANDIN_DEVICES = devices
+        _device_slots = threading.BoundedSemaphore(devices)
+
+
+def _standin_generate(prompt, max_new_tokens, name):
+    from settings import structured_output
+
+    from gemmas_engine import record_generation
+
+    n_tokens = min(max_new_tokens, STANDIN_OUTPUT_TOKENS)
+    # 読み込み・生成中はデバイスを占有する
+    with _device_slots:
+        load_started = time.perf_counter()
+        time.sleep(STANDIN_LOAD_SECONDS)
+        generate_started = time.perf_counter()
+        time.sleep(n_tokens * SECONDS_PER_TOKEN)
+        generate_seconds = time.perf_counter() - generate_started
+    record_generation(name, max_new_tokens, n_tokens, generate_started - load_started, generate_seconds)
+    digest = hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:12]
+    text = f"[{name} stand-in] {n_tokens} tokens for prompt {digest}"
+
+    # 構造化出力の場合はスキーマに沿った JSON を返す
+    if structured_output:
+        from structured_output import SCHEMAS, example_output
+        return json.dumps(example_output(SCHEMAS[name], text), ensure_ascii=False, separators=(",", ":"))
+    return text
+
+
+def standin_gemma_engine(prompt, max_new_tokens=1000):
+    return _standin_generate(prompt, max_new_tokens, "gemma")
+
+
+def standin_madgemma_engine(prompt, max_new_tokens=1000):
+    return _standin_generate(prompt, max_new_tokens, "medgemma")
+
+
+def install_standin_models():
+    """
+    backend が使うモデル呼び出しをスタンドインに差し替える
+    (backend.main / run_minilm_stage / run_llm_stage がそのままオフラインで動く)
+    """
+    import backend
+
+    backend.text_analyzer = standin_text_analyzer
+    backend.gemma_engine = standin_gemma_engine
+    backend.madgemma_engine = standin_madgemma_engine
@@ -0,0 +1,409 @@
+"""
+structured_output
+Gemma / MedGemma の出力を JSON スキーマに合わせて制約する（文法制約付き生成）
+
+スキーマ（JSON Schema のサブセット）を「固定文字列・選択肢・自由文字列」の並びに変換し、
+生成の各ステップで、その並びに沿って続けられるトークン以外のロジットを -inf にする。
+- 固定文字列（キー名・記号）と選択肢（Low / Moderate / High など）は語彙の接頭辞照合で候補を絞る
+- 自由文字列は引用符・バックスラッシュ・制御文字を含まないトークンのみ許可し、maxLength で打ち切る
+- 残りの生成長が足りなくなる前に文字列を閉じるため、max_new_tokens 以内で必ず完結した JSON になる
+
+対応するスキーマ:
+    object（properties の順に全項目を出力）/ enum（文字列・整数）/ string（maxLength 必須）
+
+トークン文字列は SentencePiece 形式（"▁" = 空白、<0xNN> = バイト）を前提とする（Gemma 3）。
+"""
+import json
+import re
+import threading
+
+# === スキーマ ===
+# Gemma: 心理学的な洞察（プロンプト末尾で求めている 0〜2 の3項目 + 要約）
+SCORE_0_2 = {"type": "integer", "enum": [0, 1, 2]}
+
+GEMMA_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "interpersonal_dependency": dict(SCORE_0_2, title="Interpersonal Dependency"),
+        "approval_dependency": dict(SCORE_0_2, title="Approval Dependency"),
+        "contradiction_strength": dict(SCORE_0_2, title="Strength of Contradictions"),
+        "summary": {"type": "string", "maxLength": 500, "title": "Summary"}
+    }
+}
+
+# MedGemma: 臨床リスク評価（項目ごとのリスクレベル・レッドフラグ + 根拠）
+RISK_LEVEL = {"type": "string", "enum": ["Low", "Moderate", "High"]}
+RED_FLAG = {"type": "string", "enum": ["Explicit", "Indirect", "None"]}
+
+MEDGEMMA_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "isolation_risk": dict(RISK_LEVEL, title="Isolation Risk"),
+        "depressive_signs": dict(RISK_LEVEL, title="Depressive Signs"),
+        "interpersonal_function_decline": dict(RISK_LEVEL, title="Interpersonal Function Decline"),
+        "social_function_risk": dict(RISK_LEVEL, title="Social Function Risk"),
+        "support_need": dict(RISK_LEVEL, title="Need for Support Intervention"),
+        "red_flags": {
+            "type": "object",
+            "title": "Red Flags",
+            "properties": {
+                "self_harm": dict(RED_FLAG, title="Self-harm indication"),
+                "suicidal_ideation": dict(RED_FLAG, title="Suicidal ideation expression"),
+                "functional_shutdown": dict(RED_FLAG, title="Functional shutdown"),
+                "extreme_hopelessness": dict(RED_FLAG, title="Extreme hopeless language")
+            }
+        },
+        "evidence": {"type": "string", "maxLength": 400, "title": "Supporting Patterns"}
+    }
+}
+
+SCHEMAS = {"gemma": GEMMA_SCHEMA, "medgemma": MEDGEMMA_SCHEMA}
+
+# 語彙の解析結果（tokenizer の名前ごと、make_model は毎回 tokenizer を読み込むため）
+_vocab_cache = {}
+_vocab_lock = threading.Lock()
+
+_BYTE_TOKEN_RE = re.compile(r"<0x([0-9A-Fa-f]{2})>")
+
+
+# =====
+# スキーマ → テンプレート
+# =====
+def compile_schema(schema):
+    """
+    スキーマを出力テンプレート（セグメントの並び）に変換する
+
+    :return: [("literal", 文字列) | ("choice", [文字列]) | ("string", 最大文字数)]
+    """
+    segments = []
+
+    def literal(text):
+        if segments and segments[-1][0] == "literal":
+            segments[-1] = ("literal", segments[-1][1] + text)
+        else:
+            segments.append(("literal", text))
+
+    def walk(node):
+        if "enum" in node:
+            segments.append(("choice", [json.dumps(v, ensure_ascii=False) for v in node["enum"]]))
+        elif node.get("type") == "object":
+            literal("{")
+            for i, (key, child) in enumerate(node["properties"].items()):
+                literal(("," if i else "") + json.dumps(key) + ":")
+                walk(child)
+            literal("}")
+        elif node.get("type") == "string":
+            if "maxLength" not in node:
+                raise ValueError("string fields need maxLength")
+            literal('"')
+            segments.append(("string", node["maxLength"]))
+            literal('"')
+        else:
+            raise ValueError(f"unsupported schema node: {node}")
+
+    walk(schema)
+    return segments
+
+
+class JsonTemplate:
+    """
+    Character-level state machine over compiled segments.
+
+    A state is (segment index, progress): the text typed so far for
+    literal / choice segments, the number of characters for strings.
+    """
+
+    def __init__(self, schema):
+        self.segments = compile_schema(schema)
+
+        # 各セグメント以降に必要な固定文字数（文字列は 0 文字で閉じる前提）
+        fixed = [
+            len(value) if kind == "literal" else max(map(len, value)) if kind == "choice" else 0
+            for kind, value in self.segments
+        ]
+        self.reserve = [sum(fixed[i + 1:]) for i in range(len(fixed))]
+        self.fixed_chars = sum(fixed)
+
+    def _start(self, seg):
+        if seg < len(self.segments) and self.segments[seg][0] == "string":
+            return seg, 0
+        return seg, ""
+
+    def initial(self):
+        return self._start(0)
+
+    def done(self, state):
+        return state[0] >= len(self.segments)
+
+    def feed(self, state, text):
+        """
+        文字列を入力した後の状態（テンプレートに沿わない場合は None）
+        """
+        seg, progress = state
+        for ch in text:
+            while True:
+                if seg >= len(self.segments):
+                    return None
+                kind, value = self.segments[seg]
+
+                if kind == "string":
+                    # 閉じ引用符は次の固定文字列の先頭として入力し直す
+                    if ch == '"':
+                        seg, progress = self._start(seg + 1)
+                        continue
+                    if ch == "\\" or ord(ch) < 0x20 or progress >= value:
+                        return None
+                    progress += 1
+                    break
+
+                typed = progress + ch
+                if kind == "literal":
+                    if not value.startswith(typed):
+                        return None
+                    complete = typed == value
+                else:
+                    if not any(option.startswith(typed) for option in value):
+                        return None
+                    complete = typed in value
+
+                seg, progress = self._start(seg + 1) if complete else (seg, typed)
+                break
+
+        return seg, progress
+
+    def continuations(self, state, limit):
+        """
+        次の自由文字列（または終端）までの続き方（limit 文字で打ち切り）
+        """
+        seg, progress = state
+        if seg >= len(self.segments) or self.segments[seg][0] == "string":
+            return [""]
+
+        kind, value = self.segments[seg]
+        rests = [value[len(progress):]] if kind == "literal" else [
+            option[len(progress):] for option in value if option.startswith(progress)
+        ]
+
+        out = []
+        for rest in rests:
+            if len(rest) >= limit:
+                out.append(rest)
+            else:
+                out.extend(rest + tail for tail in self.continuations(self._start(seg + 1), limit - len(rest)))
+        return out
+
+
+# =====
+# 語彙
+# =====
+class TokenVocab:
+    """
+    Decoded token strings of a tokenizer, indexed for the logits processor.
+    """
+
+    def __init__(self, tokenizer):
+        import torch
+
+        excluded = set(tokenizer.all_special_ids) | set(tokenizer.get_added_vocab().values())
+        tokens = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+
+        self.texts = []
+        for token_id, token in enumerate(tokens):
+            text = None
+            if token is not None and token_id not in excluded:
+                match = _BYTE_TOKEN_RE.fullmatch(token)
+                if match:
+                    # UTF-8 の途中のバイトは JSON として検証できないため ASCII のみ
+                    value = int(match.group(1), 16)
+                    text = chr(value) if value < 0x80 else None
+                else:
+                    text = token.replace("▁", " ") or None
+            self.texts.append(text)
+
+        self.by_text = {}
+        for token_id, text in enumerate(self.texts):
+            if text is not None:
+                self.by_text.setdefault(text, []).append(token_id)
+
+        def plain(text):
+            return text is not None and not any(ch in '"\\' or ord(ch) < 0x20 for ch in text)
+
+        self.plain = torch.tensor([plain(t) for t in self.texts], dtype=torch.bool)
+        self.lengths = torch.tensor([len(t) if t else 0 for t in self.texts], dtype=torch.long)
+        # 文字列を閉じられるトークン（本文 + 引用符 + 続く記号）
+        self.quote_ids = [
+            i for i, t in enumerate(self.texts)
+            if t and '"' in t and plain(t.split('"', 1)[0])
+        ]
+        self.max_len = min(int(self.lengths.max()), 64)
+        self._device_masks = {}
+
+    def masks(self, device):
+        # plain / lengths をデバイスごとに1回だけ転送する
+        key = str(device)
+        if key not in self._device_masks:
+            self._device_masks[key] = (self.plain.to(device), self.lengths.to(device))
+        return self._device_masks[key]
+
+
+def get_token_vocab(tokenizer):
+    key = getattr(tokenizer, "name_or_path", None) or id(tokenizer)
+    with _vocab_lock:
+        if key not in _vocab_cache:
+            _vocab_cache[key] = TokenVocab(tokenizer)
+        return _vocab_cache[key]
+
+
+# =====
+# Logits processor
+# =====
+class JsonSchemaLogitsProcessor:
+    """
+    Masks every token that cannot continue the schema template.
+
+    Used as a transformers logits processor for a single sequence
+    (batch size 1, greedy or sampled). EOS is only allowed once the
+    template is complete, and free strings are closed early when the
+    remaining token budget is just enough to finish the template.
+    """
+
+    def __init__(self, template, vocab, eos_ids, max_new_tokens):
+        self.template = template
+        self.vocab = vocab
+        self.eos_ids = list(eos_ids)
+        # テンプレートの固定部分 + EOS が必ず入る長さにする
+        self.max_new_tokens = max(max_new_tokens, template.fixed_chars + 1)
+
+        self.state = template.initial()
+        self.prompt_len = None
+        self.consumed = 0
+        self._quote_cache = {}
+
+    def _advance(self, input_ids):
+        if self.prompt_len is None:
+            self.prompt_len = input_ids.shape[-1]
+        generated = input_ids[0, self.prompt_len:].tolist()
+
+        for token_id in generated[self.consumed:]:
+            text = self.vocab.texts[token_id] if token_id < len(self.vocab.texts) else None
+            state = self.template.feed(self.state, text) if text is not None else None
+            if state is not None:
+                self.state = state
+        self.consumed = len(generated)
+
+    def _closing_ids(self, remaining):
+        # 文字列を閉じるトークン（状態ごとにキャッシュ、本文の長さのみ状態に依存）
+        key = (self.state[0], min(remaining, self.vocab.max_len))
+        if key not in self._quote_cache:
+            self._quote_cache[key] = [
+                i for i in self.vocab.quote_ids
+                if self.template.feed(self.state, self.vocab.texts[i]) is not None
+            ]
+        return self._quote_cache[key]
+
+    def allowed(self, size, device):
+        import torch
+
+        mask = torch.zeros(size, dtype=torch.bool, device=device)
+        if self.template.done(self.state):
+            mask[[i for i in self.eos_ids if i < size]] = True
+            return mask
+
+        ids = set()
+        for text in self.template.continuations(self.state, self.vocab.max_len):
+            for k in range(1, min(len(text), self.vocab.max_len) + 1):
+                ids.update(self.vocab.by_text.get(text[:k], ()))
+
+        seg, progress = self.state
+        kind, value = self.template.segments[seg]
+        if kind == "string":
+            remaining = value - progress
+            steps_left = self.max_new_tokens - self.consumed
+            # 残りの生成長が固定部分 + EOS 分しかなければ文字列を閉じる
+            if steps_left > self.template.reserve[seg] + 1 and remaining > 0:
+                plain, lengths = self.vocab.masks(device)
+                n = min(size, plain.shape[0])
+                mask[:n] = plain[:n] & (lengths[:n] <= remaining)
+            ids.update(self._closing_ids(remaining))
+
+        ids = [i for i in ids if i < size]
+        if ids:
+            mask[ids] = True
+        return mask
+
+    def __call__(self, input_ids, scores):
+        if input_ids.shape[0] != 1:
+            raise ValueError("JsonSchemaLogitsProcessor supports batch size 1 only")
+
+        self._advance(input_ids)
+        mask = self.allowed(scores.shape[-1], scores.device)
+        return scores.masked_fill(~mask, float("-inf"))
+
+
+def build_logits_processor(tokenizer, schema, max_new_tokens, eos_ids):
+    """
+    make_model 用の logits processor を作成する
+
+    :param eos_ids: 終了トークン（model.generation_config.eos_token_id）
+    :return: JsonSchemaLogitsProcessor（max_new_tokens は必要に応じて延長済み）
+    """
+    if eos_ids is None:
+        eos_ids = tokenizer.eos_token_id
+    if isinstance(eos_ids, int):
+        eos_ids = [eos_ids]
+    return JsonSchemaLogitsProcessor(JsonTemplate(schema), get_token_vocab(tokenizer), eos_ids, max_new_tokens)
+
+
+# =====
+# プロンプト・結果
+# =====
+def example_output(schema, text=""):
+    """
+    スキーマに沿った出力例（各選択肢は先頭、文字列は text を maxLength で切り詰め）
+    """
+    if "enum" in schema:
+        return schema["enum"][0]
+    if schema["type"] == "object":
+        return {key: example_output(child, text) for key, child in schema["properties"].items()}
+    return text[:schema["maxLength"]]
+
+
+def _describe(schema):
+    if "enum" in schema:
+        return " | ".join(json.dumps(v) for v in schema["enum"])
+    if schema["type"] == "object":
+        return "{" + ", ".join(f'"{key}": {_describe(child)}' for key, child in schema["properties"].items()) + "}"
+    return f"string (max {schema['maxLength']} characters)"
+
+
+def schema_instruction(schema):
+    """
+    プロンプト末尾に追加する出力形式の指示
+    """
+    return (
+        "\n        Respond with a single JSON object and nothing else, in this format:\n"
+        f"        {_describe(schema)}\n"
+    )
+
+
+def validate(value, schema):
+    if "enum" in schema:
+        return value in schema["enum"] and type(value) is type(schema["enum"][0])
+    if schema["type"] == "object":
+        return isinstance(value, dict) and all(
+            key in value and validate(value[key], child) for key, child in schema["properties"].items()
+        )
+    return isinstance(value, str) and len(value) <= schema["maxLength"]
+
+
+def parse_result(text, schema):
+    """
+    LLM の出力をスキーマに沿った辞書として読む（構造化出力でない場合は None）
+    """
+    if not isinstance(text, str) or not text.lstrip().startswith("{"):
+        return None
+    try:
+        value = json.loads(text)
+    except ValueError:
+        return None
+    return value if validate(value, schema) else None
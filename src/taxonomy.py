@@ -0,0 +1,411 @@
+"""
+taxonomy
+参照タクソノミー（禁止令・許可文・感情・ドライバーの定義文）を外部ファイルから読み込み、実行中に差し替える
+
+- 定義ファイル（JSON）を settings.taxonomy_path に置くと、更新を検出して再読み込みする
+- 前のバージョンとの差分を取り、追加・変更された定義文のみエンコードする
+  （文ベクトルは定義文のハッシュごとに保持・キャッシュファイルに保存）
+- 新しい参照ベクトルを作り終えてから現在のスナップショットを1回の代入で差し替える。
+  処理中のリクエストは開始時に取得したスナップショット（旧バージョン）のまま完了する
+- 参照ベクトルには taxonomy バージョンが付き、解析結果（analysis["taxonomy_version"]）に記録される
+
+定義ファイルの形式（ラベルごとに言語別の定義文、permissions は injunctions と同じラベル）:
+    {
+      "version": "2026-03",
+      "injunctions": {"Don't exist": {"en": "...", "ja": "..."}, ...},
+      "permissions": {"Don't exist": {"en": "...", "ja": "..."}, ...},
+      "emotions": {"anger": {"en": "...", "ja": "..."}, ...},
+      "drivers": {"recognition_need": {"en": "...", "ja": "..."}, ...}
+    }
+
+Usage:
+    python taxonomy.py show
+    python taxonomy.py export taxonomy.json      # 組み込みの定義をファイルに書き出す（編集用）
+    python taxonomy.py diff taxonomy.json        # 現在の定義との差分
+"""
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+from settings import mnilm_url, taxonomy_path, taxonomy_reload_seconds
+
+DB_NAMES = ["injunctions", "permissions", "emotions", "drivers"]
+
+# 定義文ベクトルのキャッシュ（定義文のハッシュ → ベクトル、MiniLM のみ保存）
+VECTOR_CACHE_FILE = os.path.join(os.path.dirname(__file__), "cache", "reference_text_vectors.pkl")
+
+_current = None
+_current_lock = threading.Lock()
+_reload_lock = threading.Lock()
+_last_check = 0.0
+
+# {エンコーダの種類: {定義文のハッシュ: ベクトル}}
+_text_vectors = {}
+_vector_lock = threading.Lock()
+
+
+class ReferenceEmbeddings(dict):
+    """
+    get_reference_embeddings() と同じ構造の辞書に taxonomy バージョンを付けたもの
+    """
+    version = None
+    matrix = None # text_analyzer.get_reference_matrix() の結果（初回使用時に作成）
+
+
+def _text_key(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+# =====
+# 定義の読み込み・差分
+# =====
+def builtin_dbs():
+    from constants.injunctions_permissions import INJUNCTIONS_DB, PERMISSIONS_DB, EMOTIONS_DB, DRIVERS_DB
+
+    return {
+        "injunctions": INJUNCTIONS_DB,
+        "permissions": PERMISSIONS_DB,
+        "emotions": EMOTIONS_DB,
+        "drivers": DRIVERS_DB
+    }
+
+
+def definition_texts(lang="en", dbs=None):
+    """
+    全定義文のリスト（ベンチマーク・疑似データ用、1項目 = 1文字列で複数の文を含む）
+
+    :param dbs: 定義（省略時は組み込みの定義）
+    """
+    dbs = dbs or builtin_dbs()
+    return [val[lang] for name in DB_NAMES for val in dbs[name].values() if val.get(lang)]
+
+
+def validate_dbs(dbs):
+    """
+    定義の形式を確認する（不正な場合は ValueError）
+    """
+    for name in DB_NAMES:
+        if not isinstance(dbs.get(name), dict) or not dbs[name]:
+            raise ValueError(f"taxonomy needs a non-empty {name!r} object")
+        for label, texts in dbs[name].items():
+            if not isinstance(texts, dict) or not isinstance(texts.get("en"), str):
+                raise ValueError(f"{name}/{label}: needs at least an 'en' definition")
+
+    if set(dbs["injunctions"]) != set(dbs["permissions"]):
+        raise ValueError("injunctions and permissions must have the same labels")
+
+
+def taxonomy_version(dbs, name=None):
+    """
+    定義内容のハッシュによるバージョン（名前があれば "名前@ハッシュ"）
+    """
+    digest = hashlib.sha1(
+        json.dumps({k: dbs[k] for k in DB_NAMES}, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    ).hexdigest()[:12]
+    return f"{name}@{digest}" if name else digest
+
+
+def load_taxonomy_file(path):
+    """
+    :return: (定義, バージョン)
+    """
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+
+    dbs = {name: data.get(name) for name in DB_NAMES}
+    validate_dbs(dbs)
+    return dbs, taxonomy_version(dbs, data.get("version"))
+
+
+def diff_taxonomies(old, new):
+    """
+    ラベル単位の差分
+
+    :return: {"added", "changed", "removed"}（"db/label" のリスト）
+    """
+    out = {"added": [], "changed": [], "removed": []}
+    for name in DB_NAMES:
+        before, after = old.get(name, {}), new.get(name, {})
+        for label in after:
+            if label not in before:
+                out["added"].append(f"{name}/{label}")
+            elif after[label] != before[label]:
+                out["changed"].append(f"{name}/{label}")
+        out["removed"].extend(f"{name}/{label}" for label in before if label not in after)
+    return out
+
+
+# =====
+# 定義文ベクトル
+# =====
+def _encoder_kind(model):
+    # スタンドインなどは種類ごとにメモリ上のみで保持する
+    return getattr(model, "taxonomy_cache_key", None) or "minilm"
+
+
+def _load_vector_cache():
+    """
+    MiniLM の定義文ベクトルをキャッシュファイルから読み込む。
+    旧形式のキャッシュ（言語ごとの参照ベクトル）があれば組み込み定義の分を引き継ぐ
+    """
+    vectors = {}
+    if os.path.exists(VECTOR_CACHE_FILE):
+        with open(VECTOR_CACHE_FILE, "rb") as f:
+            cached = pickle.load(f)
+        if cached.get("model") == mnilm_url:
+            vectors.update(cached["vectors"])
+
+    from text_analyzer import REFERENCE_LANGS, reference_cache_file
+
+    dbs = builtin_dbs()
+    for lang in REFERENCE_LANGS:
+        legacy_file = reference_cache_file(lang)
+        if not os.path.exists(legacy_file):
+            continue
+        with open(legacy_file, "rb") as f:
+            legacy = pickle.load(f)
+        for label, vecs in legacy.get("inj_per", {}).items():
+            if label in dbs["injunctions"] and lang in dbs["injunctions"][label]:
+                vectors.setdefault(_text_key(dbs["injunctions"][label][lang]), vecs["injunction"])
+                vectors.setdefault(_text_key(dbs["permissions"][label][lang]), vecs["permission"])
+        for name in ["emotions", "drivers"]:
+            for label, vecs in legacy.get(name, {}).items():
+                if label in dbs[name] and lang in dbs[name][label]:
+                    vectors.setdefault(_text_key(dbs[name][label][lang]), vecs[name])
+    return vectors
+
+
+def _save_vector_cache(vectors):
+    os.makedirs(os.path.dirname(VECTOR_CACHE_FILE), exist_ok=True)
+    tmp_file = VECTOR_CACHE_FILE + ".tmp"
+    with open(tmp_file, "wb") as f:
+        pickle.dump({"model": mnilm_url, "vectors": vectors}, f)
+    os.replace(tmp_file, VECTOR_CACHE_FILE)
+
+
+def encode_texts(model, texts):
+    """
+    定義文をベクトル化する（キャッシュにない文のみエンコード）
+
+    :return: ({定義文: ベクトル}, エンコードした文数)
+    """
+    kind = _encoder_kind(model)
+    with _vector_lock:
+        if kind not in _text_vectors:
+            _text_vectors[kind] = _load_vector_cache() if kind == "minilm" else {}
+        cache = _text_vectors[kind]
+
+        missing = sorted({t for t in texts if _text_key(t) not in cache})
+        if missing:
+            for text, vec in zip(missing, model.encode(missing)):
+                cache[_text_key(text)] = vec
+            if kind == "minilm":
+                _save_vector_cache(cache)
+
+        return {t: cache[_text_key(t)] for t in texts}, len(missing)
+
+
+# =====
+# スナップショット
+# =====
+class TaxonomySnapshot:
+    """
+    One immutable version of the reference taxonomy.
+
+    Reference embeddings are built lazily per (encoder kind, language)
+    and cached on the snapshot; a reload builds a new snapshot and swaps
+    it in, so a request keeps using the snapshot it started with.
+    """
+
+    def __init__(self, dbs, version, source=None, diff=None):
+        self.dbs = dbs
+        self.version = version
+        self.source = source
+        self.diff = diff
+        self.loaded_at = time.time()
+        self.mtime = os.path.getmtime(source) if source else None
+        self.encoded = 0 # このスナップショットで新たにエンコードした文数
+        self._refs = {}
+        self._lock = threading.Lock()
+
+    def texts(self, lang):
+        """
+        {(db, label): 定義文}（その言語の定義がなければ英語）
+        """
+        return {
+            (name, label): texts.get(lang) or texts["en"]
+            for name in DB_NAMES
+            for label, texts in self.dbs[name].items()
+        }
+
+    def reference_embeddings(self, model, lang="en"):
+        """
+        text_analyzer.get_reference_embeddings() と同じ構造の参照ベクトル
+        ("multi" は各言語版の平均)
+        """
+        from text_analyzer import REFERENCE_LANGS, merge_reference_embeddings
+
+        key = (_encoder_kind(model), lang)
+        with self._lock:
+            if key in self._refs:
+                return self._refs[key]
+
+        if lang == "multi":
+            refs = ReferenceEmbeddings(merge_reference_embeddings([
+                self.reference_embeddings(model, ref_lang) for ref_lang in REFERENCE_LANGS
+            ]))
+        else:
+            texts = self.texts(lang)
+            vectors, encoded = encode_texts(model, list(texts.values()))
+            vec = {key: vectors[text] for key, text in texts.items()}
+            refs = ReferenceEmbeddings({
+                "inj_per": {
+                    label: {"injunction": vec[("injunctions", label)], "permission": vec[("permissions", label)]}
+                    for label in self.dbs["injunctions"]
+                },
+                "emotions": {label: {"emotions": vec[("emotions", label)]} for label in self.dbs["emotions"]},
+                "drivers": {label: {"drivers": vec[("drivers", label)]} for label in self.dbs["drivers"]}
+            })
+            self.encoded += encoded
+        refs.version = self.version
+
+        with self._lock:
+            return self._refs.setdefault(key, refs)
+
+    def built_keys(self):
+        with self._lock:
+            return list(self._refs)
+
+
+def current():
+    """
+    現在のスナップショット（初回は設定に従って読み込む）
+    """
+    global _current
+
+    if _current is None:
+        with _current_lock:
+            if _current is None:
+                if taxonomy_path:
+                    dbs, version = load_taxonomy_file(taxonomy_path)
+                    _current = TaxonomySnapshot(dbs, version, taxonomy_path)
+                else:
+                    dbs = builtin_dbs()
+                    _current = TaxonomySnapshot(dbs, taxonomy_version(dbs, "builtin"))
+    return _current
+
+
+def swap(dbs, version, model=None, source=None):
+    """
+    新しい定義に差し替える。
+    現在のスナップショットで作成済みの参照ベクトル（エンコーダ・言語）は、差し替え前に新しい定義で作成する
+    （変更された定義文のみエンコード）。
+
+    :param model: 参照ベクトルを作成するエンコーダ（None の場合は初回使用時に作成）
+    :return: 新しいスナップショット
+    """
+    global _current
+
+    old = current()
+    snapshot = TaxonomySnapshot(dbs, version, source, diff_taxonomies(old.dbs, dbs))
+
+    if model is not None:
+        kind = _encoder_kind(model)
+        for built_kind, lang in old.built_keys():
+            if built_kind == kind:
+                snapshot.reference_embeddings(model, lang)
+
+    with _current_lock:
+        _current = snapshot
+    return snapshot
+
+
+def maybe_reload(model=None, force=False):
+    """
+    定義ファイルが更新されていれば読み込み直す（taxonomy_reload_seconds ごとに確認）。
+    他のスレッドが読み込み中の場合や、ファイルが不正な場合は現在のスナップショットのまま。
+
+    :return: 差し替えた場合は新しいスナップショット、それ以外は None
+    """
+    global _last_check
+
+    if not taxonomy_path:
+        return None
+
+    now = time.monotonic()
+    if not force and now - _last_check < taxonomy_reload_seconds:
+        return None
+    _last_check = now
+
+    snapshot = current()
+    try:
+        mtime = os.path.getmtime(taxonomy_path)
+    except OSError:
+        return None
+    if mtime == snapshot.mtime and not force:
+        return None
+
+    if not _reload_lock.acquire(blocking=False):
+        return None
+    try:
+        try:
+            dbs, version = load_taxonomy_file(taxonomy_path)
+        except (OSError, ValueError) as e:
+            print(f"Taxonomy reload skipped ({taxonomy_path}): {e}")
+            return None
+
+        if version == snapshot.version:
+            snapshot.mtime = mtime
+            return None
+
+        new = swap(dbs, version, model, taxonomy_path)
+        print(
+            f"Taxonomy {snapshot.version} -> {new.version}: "
+            f"{', '.join(f'{k} {len(v)}' for k, v in new.diff.items())}, re-encoded {new.encoded} definitions"
+        )
+        return new
+    finally:
+        _reload_lock.release()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MILD-7 reference taxonomy")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    sub.add_parser("show", help="current taxonomy version and label counts")
+
+    export = sub.add_parser("export", help="write the current definitions to a JSON file")
+    export.add_argument("path")
+
+    diff = sub.add_parser("diff", help="labels added / changed / removed by a taxonomy file")
+    diff.add_argument("path")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "show":
+        snapshot = current()
+        print(json.dumps({
+            "version": snapshot.version,
+            "source": snapshot.source or "builtin",
+            "labels": {name: len(snapshot.dbs[name]) for name in DB_NAMES}
+        }, indent=2))
+
+    elif args.command == "export":
+        snapshot = current()
+        with open(args.path, "w", encoding="utf-8") as f:
+            json.dump(dict(version=snapshot.version.split("@")[0], **snapshot.dbs), f, ensure_ascii=False, indent=2)
+        print(f"wrote {args.path}")
+
+    elif args.command == "diff":
+        try:
+            dbs, version = load_taxonomy_file(args.path)
+        except ValueError as e:
+            parser.error(str(e))
+        print(json.dumps({"from": current().version, "to": version, **diff_taxonomies(current().dbs, dbs)}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
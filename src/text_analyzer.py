@@ -1,402 +1,440 @@
-from sklearn.metrics.pairwise import cosine_similarity
-from sentence_transformers import SentenceTransformer
 import json
-import pickle
 import os
-import pysbd
 import gc
-import torch
-from settings import mnilm_url
-from constants.injunctions_permissions import INJUNCTIONS_DB, PERMISSIONS_DB, EMOTIONS_DB, DRIVERS_DB# DB
+import threading
+import time
+from settings import mnilm_url, minilm_resident, analysis_lang, reference_lang, encoding_mode, segmentation_engine
+from settings import prefilter_mode
+from segmenter import get_segmenter
+
+# torch / sentence_transformers / pysbd は重いため、初回使用時に関数内で import する
+# (backend や app.py の import を軽くするため)
 
 # キャッシュファイルパスの定義
 BASE_DIR = os.path.dirname(__file__)
 CACHE_DIR = os.path.join(BASE_DIR, "cache")
 CACHE_FILE = os.path.join(CACHE_DIR, "reference_embeddings_cache.pkl")
 
-def get_reference_embeddings(model):
+# 参照DBが持つ言語
+REFERENCE_LANGS = ["en", "ja"]
+
+# 仮名・漢字がこの割合以上なら日本語と判定
+JA_CHAR_RATIO = 0.2
+
+# ロード済みモデルの保持（プロセス内キャッシュ、文分割器は segmenter が保持）
+_minilm_model = None
+_load_lock = threading.Lock()
+
+
+def load_minilm():
     """
-    MiniMLのベクトル化処理。
-    処理後、ファイルに保存し次回以降、ファイル参照できるようにする。
-    
-    :param model: MiniMLモデル
-    :return: ベクトル化処理した参照項目内容
+    MiniLMモデルを読み込む。
+    settings.minilm_resident が True の場合は初回のみ読み込み、以降は同じモデルを返す。
+
+    :return: SentenceTransformer モデル
     """
+    global _minilm_model
 
-    # 保存先フォルダがなければ作成
-    if not os.path.exists(CACHE_DIR):
-        os.makedirs(CACHE_DIR)
-        print(f"Created directory: {CACHE_DIR}")
-    
-    # キャッシュが存在するか確認
-    if os.path.exists(CACHE_FILE):
-        
-        with open(CACHE_FILE, "rb") as f:
-            print("Loading reference embeddings from cache...")
-            return pickle.load(f)
-        
-    # キャッシュが存在しない場合、生成して保存
-    print("Cache not found. Encoding reference databases")
-    
-    # MiniMLを使用しベクトル化
-    refs = {
-        "inj_per": build_reference_embeddings_inj_per(
-            model,  
-            INJUNCTIONS_DB,
-            PERMISSIONS_DB 
-        ),
-        "emotions": build_reference_embeddings(
-            model,  
-            EMOTIONS_DB,
-            "emotions"
-        ),
-        "drivers": build_reference_embeddings(
-            model, 
-            DRIVERS_DB, 
-            "drivers"
+    with _load_lock:
+        if _minilm_model is not None:
+            return _minilm_model
+
+        from sentence_transformers import SentenceTransformer
+        from autotune import minilm_config, apply_thread_config
+
+        # マシンプロファイル（autotune.py）のデバイスを使用（スレッド数は未設定の場合のみ1回設定）
+        config = minilm_config()
+        apply_thread_config()
+
+        # MniLMモデル定義
+        model = SentenceTransformer(
+            mnilm_url,
+            local_files_only=True,
+            device=config["device"]
         )
-    }
-    # 次回のため保存
-    with open(CACHE_FILE, "wb") as f:
-        pickle.dump(refs, f)
-        
-    return refs
+        if minilm_resident:
+            _minilm_model = model
+        return model
 
-def build_reference_embeddings_inj_per(model, injunctions_db, permissions_db, lang="en"):
+
+def release_minilm(model):
     """
-    参照項目となる禁止令・許可文を MiniML埋め込みモデルでベクトル化
-    
-    :param model: MiniLM　埋め込みモデル
-    :param injunctions_db: 禁止令
-    :param permissions_db: 許可文
-    :param lang: 対応言語
-    """
-    ref_texts = {}
-    for key in injunctions_db.keys():
-        ref_texts[key] = {
-            "injunction": injunctions_db[key][lang],
-            "permission": permissions_db[key][lang]
-        }
+    常駐させない設定の場合のみ、使用後のMiniLMモデルを解放する
+
+    :param model: load_minilm() で取得したモデル
+    """
+    if model is _minilm_model:
+        return
+
+    import torch
 
-    embeddings = {
-        key: {
-            "injunction": model.encode(val["injunction"]),
-            "permission": model.encode(val["permission"])
-        }
-        for key, val in ref_texts.items()
-    }
     # メモリ開放
+    model.to("cpu")
+    del model
+    gc.collect()
     torch.cuda.empty_cache()
-    torch.cuda.ipc_collect()
-    
-    return embeddings
+
+def reference_cache_file(lang):
+    """
+    言語ごとの参照ベクトルキャッシュファイル（英語は従来のファイル名）
+    """
+    if lang == "en":
+        return CACHE_FILE
+    return os.path.join(CACHE_DIR, f"reference_embeddings_cache_{lang}.pkl")
 
 
-def build_reference_embeddings(model, db, target_name, lang="en"):
+def get_reference_embeddings(model, lang="en", snapshot=None):
     """
-    参照項目となる感情、ドライバーをベクトル化
+    MiniMLのベクトル化処理。
+    参照タクソノミー（taxonomy.py）の定義文をベクトル化し、定義文ごとにキャッシュする。
+    定義が更新された場合も、追加・変更された定義文のみエンコードする。
+    "multi" は各言語のベクトルを平均した統合版を返す。
     
-    :param model: MiniLM埋め込みモデル
-    :param db: 対象データ
-    :param target_name: 対象名
-    :param lang: 対応言語
-    """
-    ref_texts = {}
-    for key in db.keys():
-        ref_texts[key] = {
-            target_name: db[key][lang]
-        }
+    :param model: MiniMLモデル
+    :param lang: 参照文の言語（REFERENCE_LANGS のいずれか、または "multi"）
+    :param snapshot: 使用する taxonomy スナップショット（省略時は現在のもの）
+    :return: ベクトル化処理した参照項目内容（.version に taxonomy バージョン）
+    """
+    import taxonomy
 
-    embeddings = {
-        key: {
-            target_name: model.encode(val[target_name])
-        }
-        for key, val in ref_texts.items()
+    snapshot = snapshot or taxonomy.current()
+    return snapshot.reference_embeddings(model, lang)
+
+
+def precompute_reference_embeddings(model):
+    """
+    全言語（と統合版）の参照ベクトルを事前に作成・キャッシュする
+    (言語が混在するバッチで再エンコードが起きないようにする)
+
+    :param model: MiniLMモデル
+    :return: {lang: 参照ベクトル}
+    """
+    return {
+        lang: get_reference_embeddings(model, lang)
+        for lang in REFERENCE_LANGS + ["multi"]
     }
-    # メモリ開放
-    torch.cuda.empty_cache()
-    torch.cuda.ipc_collect()
-    
-    return embeddings
 
 
-def score_injunctions(sentence_embedding, ref_embeddings):
+def merge_reference_embeddings(refs_list):
     """
-        Compute injunction-based psychological tension score.
-        (命令文に基づく心理的緊張スコアを計算)
+    複数言語の参照ベクトルをラベルごとに平均して統合する
+    (各ベクトルを正規化してから平均)
 
-        :param sentence_embedding: テキスト
-        :param ref_embeddings: 判定基準禁止令
-        :return: スコア集計
+    :param refs_list: 言語別の参照ベクトルのリスト
+    :return: 統合した参照ベクトル（同じ構造）
     """
+    import numpy as np
+
+    def unit(vec):
+        vec = np.asarray(vec, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm > 0 else vec
+
+    merged = {}
+    for ref_key, items in refs_list[0].items():
+        merged[ref_key] = {
+            label: {
+                name: np.mean([unit(refs[ref_key][label][name]) for refs in refs_list], axis=0)
+                for name in vectors
+            }
+            for label, vectors in items.items()
+        }
+    return merged
 
 
-    scores = {}
-    for key, emb in ref_embeddings.items():
-        
-        inj_sim = cosine_similarity(
-            [sentence_embedding], [emb["injunction"]]
-        )[0][0]
+def detect_language(text):
+    """
+    文書の言語を簡易判定する（仮名・漢字の割合で判定）
 
-        perm_sim = cosine_similarity(
-            [sentence_embedding], [emb["permission"]]
-        )[0][0]
+    :param text: 会話全文
+    :return: "ja" または "en"
+    """
+    ja_chars = 0
+    letters = 0
+    for ch in text:
+        if ch.isalpha():
+            letters += 1
+            code = ord(ch)
+            # ひらがな・カタカナ・CJK統合漢字・半角カナ
+            if (
+                0x3040 <= code <= 0x30FF
+                or 0x4E00 <= code <= 0x9FFF
+                or 0xFF66 <= code <= 0xFF9F
+            ):
+                ja_chars += 1
+
+    if letters and ja_chars / letters >= JA_CHAR_RATIO:
+        return "ja"
+    return "en"
+
+
+def resolve_languages(text):
+    """
+    文書ごとに文分割の言語と参照ベクトルの言語を決める
 
-        score = inj_sim - perm_sim
-        scores[key] = score
-    return scores
+    :param text: 会話全文
+    :return: (文分割の言語, 参照ベクトルの言語)
+    """
+    lang = detect_language(text) if analysis_lang == "auto" else analysis_lang
+    ref_lang = "multi" if reference_lang == "multi" else (
+        lang if reference_lang == "auto" else reference_lang
+    )
+    return lang, ref_lang
 
 
-def score_other(sentence_embedding, ref_embeddings, target_name):
+def segment_text(text, lang="en"):
     """
-    スコア計算
-    禁止令以外で文ごとに「スコア」を出す
-    
-    :param sentence_embedding: テキスト
-    :param ref_embeddings: 判定基準文字
-    :return: スコア集計結果
-    :rtype: Any
+    言語に合わせた文分割（エンジンは settings.segmentation_engine、segmenter.py 参照）
+
+    :param text: 会話全文
+    :param lang: 言語
+    :return: 文リスト
     """
-    scores = {}
-    for key, emb in ref_embeddings.items():
-        
-        score = cosine_similarity(
-            [sentence_embedding], [emb[target_name]]
-        )[0][0]
+    return get_segmenter(segmentation_engine, lang).segment(text)
 
-        scores[key] = score
-    return scores
 
+FUSED_CATEGORIES = [
+    ("injunctions", "inj_per", "injunction", "permission"),
+    ("emotions", "emotions", "emotions", None),
+    ("drivers", "drivers", "drivers", None),
+]
 
-def analyze_psychological_feature_inj(
-    sentences,
-    sentence_embeddings,
-    ref_embeddings,
-    top_k=5,
-    threshold=0.10
-):
+def build_reference_matrix(ref_embeddings):
     """
-        Aggregate sentence-level injunction tension scores into
-        document-level psychological signals.
+    全カテゴリの参照ベクトルを1つの正規化済み行列に積み上げる
+    (禁止令・許可文・感情・ドライバーの順)
 
-        Process:
-        1. For each sentence, compute injunction tension scores.
-        2. Identify the strongest response in that sentence.
-        3. Select signals that:
-        - Exceed the absolute threshold.
-        - Are within 90% of the sentence's strongest activation.
-        4. Aggregate selected scores across sentences.
-        5. Track:
-        - Total score (signal intensity across document)
-        - Average score (consistency)
-        - Maximum score (peak activation)
-        - Evidence sentences
-
-        Rationale:
-        This design filters weak noise while preserving
-        dominant psychological reactions per sentence,
-        capturing both intensity and recurrence.
+    :param ref_embeddings: get_reference_embeddings() の戻り値
+    :return: (行列 [参照数, 次元], カテゴリごとの行位置レイアウト)
     """
+    import numpy as np
 
-        
-    # 結果格納辞書
-    aggregated = {k: 0.0 for k in ref_embeddings} 
-    evidence = {key: [] for key in ref_embeddings.keys()}
-    max_values = {k: 0.0 for k in ref_embeddings}# 最大値値をフロント表示用に別集計
-    counts = {k: 0 for k in ref_embeddings} # ヒット回数をカウント
-    
-    
-    for sent, emb in zip(sentences, sentence_embeddings):
-        scores = score_injunctions(emb, ref_embeddings) 
-        # もっとも反応が強かったスコアを特定
-        max_scores = max(scores.values())
-        
-        for k, v in scores.items(): 
-            
-            # 項目ごとの過去最高値を更新
-            if v > max_values[k]:
-                max_values[k] = float(v)
-            
-            # 確率しきい値
-            if v > threshold and v >= (max_scores * 0.9):
-            # if v > threshold and (max_scores - v) < 0.08: # 距離ベース（差分）で判定
-                aggregated[k] += v
-                evidence[k].append([sent, float(v)])
-                counts[k] += 1
-    
-    # ラベル、合計、平均、最大をリスト化
+    vectors = []
+    layout = {}
+    for category, ref_key, pos_name, neg_name in FUSED_CATEGORIES:
+        refs = ref_embeddings[ref_key]
+        labels = list(refs.keys())
+
+        # 加点側の行
+        pos = list(range(len(vectors), len(vectors) + len(labels)))
+        vectors.extend(refs[k][pos_name] for k in labels)
+
+        # 減点側の行（禁止令のみ：許可文）
+        neg = None
+        if neg_name is not None:
+            neg = list(range(len(vectors), len(vectors) + len(labels)))
+            vectors.extend(refs[k][neg_name] for k in labels)
+
+        layout[category] = {"labels": labels, "pos": pos, "neg": neg}
+
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix = matrix / np.where(norms == 0, 1.0, norms)
+
+    return matrix, layout
+
+
+def get_reference_matrix(ref_embeddings):
+    """
+    参照行列を取得する（taxonomy の参照ベクトルには行列を付けて保持し、
+    スナップショットと一緒に解放されるようにする）
+
+    :param ref_embeddings: get_reference_embeddings() の戻り値
+    :return: (行列, レイアウト)
+    """
+    cached = getattr(ref_embeddings, "matrix", None)
+
+    if cached is None:
+        cached = build_reference_matrix(ref_embeddings)
+        # 通常の辞書（キャッシュファイルから読み込んだものなど）は毎回作成
+        if hasattr(ref_embeddings, "matrix"):
+            ref_embeddings.matrix = cached
+
+    return cached
+
+
+def normalize_embeddings(sentence_embeddings, dim):
+    """
+    文ベクトルを [文数, 次元] の float32 にして行ごとに正規化する
+
+    :param sentence_embeddings: 文ベクトル
+    :param dim: ベクトルの次元（文が0件の場合の形状用）
+    """
+    import numpy as np
+
+    emb = np.asarray(sentence_embeddings, dtype=np.float32).reshape(-1, dim)
+    norms = np.linalg.norm(emb, axis=1, keepdims=True)
+    return emb / np.where(norms == 0, 1.0, norms)
+
+
+def label_vectors(ref_embeddings):
+    """
+    ラベルごとのスコア算出ベクトル。
+    正規化済みの文ベクトルとの内積がそのままラベルのスコアになる
+    (禁止令は 禁止令ベクトル − 許可文ベクトル)
+
+    :param ref_embeddings: get_reference_embeddings() の戻り値
+    :return: ("category/label" 名のリスト, ベクトル [ラベル数, 次元])
+    """
+    import numpy as np
+
+    matrix, layout = get_reference_matrix(ref_embeddings)
+
+    names = []
+    vectors = []
+    for category, spec in layout.items():
+        vecs = matrix[spec["pos"]]
+        if spec["neg"] is not None:
+            vecs = vecs - matrix[spec["neg"]]
+        vectors.append(vecs)
+        names.extend(f"{category}/{k}" for k in spec["labels"])
+
+    return names, np.concatenate(vectors)
+
+
+def rank_aggregates(labels, aggregated, counts, max_values, top_k):
+    """
+    ラベルごとの合計・件数・最大値から、合計値の高い順に top_k 件を返す
+
+    :return: [[label, total, avg, max], ...]
+    """
     ranked_list = []
-    for k, total_v in aggregated.items():
+    for i, k in enumerate(labels):
+        total_v = float(aggregated[i])
         if total_v > 0:
-            
             # 平均値を計算(ゼロ除算を避ける)
-            if counts[k] > 0:
-                avg_v = total_v / counts[k] 
-            else:
-                avg_v = 0.0
-                
-            # 最大値を計算
-            max_v = max_values[k]
-            
-            # ４つの情報をセットにしてリスト化
-            ranked_list.append([
-                k, 
-                float(total_v), 
-                float(avg_v), 
-                float(max_v)
-            ])
-    # 合計値に元図いて高い順に並べ替え、上位top_k個を取る
-    ranked = sorted(
-        ranked_list,
-        key=lambda x: x[1],
-        reverse=True
-    )[:top_k]
-    
-    return ranked, evidence
+            avg_v = total_v / counts[i] if counts[i] > 0 else 0.0
+            ranked_list.append([k, total_v, float(avg_v), float(max_values[i])])
+
+    # 合計値に基づいて高い順に並べ替え、上位top_k個を取る
+    return sorted(ranked_list, key=lambda x: x[1], reverse=True)[:top_k]
+
+
+def rank_category_scores(scores, labels, top_k=5, threshold=0.10):
+    """
+    Apply the per-sentence selection rule to one category's score matrix.
+    (1カテゴリ分のスコア行列 [文数, ラベル数] を集計する)
+
+    A score is kept when it exceeds the threshold and is within 90% of the
+    sentence's strongest activation in this category.
+
+    :return: (ranked, mask) — ranked は [label, total, avg, max] のリスト、mask はヒット判定
+    """
+    import numpy as np
+
+    if scores.shape[0] == 0:
+        return [], np.zeros(scores.shape, dtype=bool)
+
+    # もっとも反応が強かったスコアを文ごとに特定
+    row_max = scores.max(axis=1, keepdims=True)
+
+    # 確率しきい値
+    mask = (scores > threshold) & (scores >= row_max * 0.9)
+
+    aggregated = np.where(mask, scores, 0.0).sum(axis=0, dtype=np.float64)
+    counts = mask.sum(axis=0)
+    # 最大値は 0.0 を下限とする（既存の集計と同じ）
+    max_values = np.maximum(scores.max(axis=0), 0.0)
+
+    ranked = rank_aggregates(labels, aggregated, counts, max_values, top_k)
+    return ranked, mask
 
 
-def analyze_psychological_feature(
+def analyze_psychological_features_fused(
     sentences,
     sentence_embeddings,
     ref_embeddings,
-    target_name,
     top_k=5,
-    threshold=0.10
+    threshold=0.10,
+    window_embeddings=None,
+    window_rows=None
 ):
     """
-        Aggregate sentence-level similarity scores into
-        document-level psychological features.
+        Score injunctions, emotions and drivers in a single pass.
+        (禁止令・感情・ドライバーを1回の行列積でまとめて判定)
 
         Process:
-        1. Compute cosine similarity for each sentence.
-        2. Identify the strongest response per sentence.
-        3. Select features that:
-        - Exceed the threshold.
-        - Are within 90% of the maximum sentence activation.
-        4. Aggregate scores across sentences.
-        5. Compute total, average, and maximum values.
-
-        Rationale:
-        This ensures only dominant emotional/driver signals
-        are retained while minimizing cross-signal noise.
+        1. Stack every reference vector into one normalized matrix.
+        2. Compute all sentence × reference cosine similarities with one
+        matrix product.
+        3. Split the result per category (injunction minus permission for
+        injunctions) and apply the threshold / 90%-of-max rule per category.
+        4. Store hits as compact arrays in an EvidenceStore.
+
+        Intermediate memory is the [sentences × references] similarity matrix.
+
+        window_embeddings (token_pooling) are scored the same way and each
+        sentence takes the maximum of its own score and the windows covering
+        it, so signals spanning consecutive sentences are kept.
+        With window_rows (prefilter), windows span only those sentences and
+        dropped / merged sentences keep their own score.
+
+        :return: ({category: ranked}, EvidenceStore)
     """
-        
-    # 結果格納辞書
-    aggregated = {k: 0.0 for k in ref_embeddings} 
-    evidence = {key: [] for key in ref_embeddings.keys()}
-    max_values = {k: 0.0 for k in ref_embeddings} # マックス値をフロント表示用に別集計
-    counts = {k: 0 for k in ref_embeddings} # ヒット回数をカウント
-    
-    for sent, emb in zip(sentences, sentence_embeddings):
-        scores = score_other(emb, ref_embeddings, target_name) 
-        # もっとも反応が強かったスコアを特定
-        max_scores = max(scores.values())
-        
-        # 確率しきい値
-        for k, v in scores.items(): 
-            
-            if v > max_values[k]:
-                max_values[k] = float(v)
-            
-            if v > threshold and v >= (max_scores * 0.9):
-            # if v > threshold and (max_scores - v) < 0.08: # 距離ベース（差分）で判定
-                aggregated[k] += v
-                evidence[k].append([ sent, float(v)])
-                counts[k] += 1
-    
-    # ラベル、合計、平均、最大をリスト化
-    ranked_list = []
-    for k, total_v in aggregated.items():
-        if total_v > 0:
-            
-            # 平均値を計算(ゼロ除算を避ける)
-            if counts[k] > 0:
-                avg_v = total_v / counts[k] 
-            else:
-                avg_v = 0.0
-                
-            # 最大値を計算
-            max_v = max_values[k]
-            
-            # ４つの情報をセットにしてリスト化
-            ranked_list.append([
-                k, 
-                float(total_v), 
-                float(avg_v), 
-                float(max_v)
-            ])
-    # 合計値に元図いて高い順に並べ替え、上位top_k個を取る
-    ranked = sorted(
-        ranked_list,
-        key=lambda x: x[1],
-        reverse=True
-    )[:top_k]
-    
-    return ranked, evidence
+    import numpy as np
+    from evidence_store import EvidenceStore
 
+    matrix, layout = get_reference_matrix(ref_embeddings)
 
-def dct_pack(
-    ranked_inj, evidence_inj,
-    ranked_emo, evidence_emo,
-    ranked_drv, evidence_drv
-):
+    # 文ベクトルを正規化（コサイン類似度 = 内積）
+    emb = normalize_embeddings(sentence_embeddings, matrix.shape[1])
+
+    # 全参照との類似度を1回で計算 [文数, 参照数]
+    sims = emb @ matrix.T
+
+    # 窓（連続する複数文）の類似度 [窓数, 参照数]
+    window_sims = None
+    if window_embeddings is not None and len(window_embeddings):
+        window_sims = normalize_embeddings(window_embeddings, matrix.shape[1]) @ matrix.T
+        window = (len(sentences) if window_rows is None else len(window_rows)) - len(window_sims) + 1
+
+    ranked = {}
+    store = EvidenceStore(sentences)
+    for category, spec in layout.items():
+        scores = sims[:, spec["pos"]]
+        if spec["neg"] is not None:
+            # 禁止令は許可文との差分
+            scores = scores - sims[:, spec["neg"]]
+
+        if window_sims is not None:
+            from token_pooling import spread_window_scores
+
+            window_scores = window_sims[:, spec["pos"]]
+            if spec["neg"] is not None:
+                window_scores = window_scores - window_sims[:, spec["neg"]]
+            scores = spread_window_scores(scores, window_scores, window, window_rows)
+
+        ranked[category], mask = rank_category_scores(
+            scores, spec["labels"], top_k, threshold
+        )
+        store.add_category(category, spec["labels"], mask, scores)
+
+    return ranked, store
+
+
+def pack_payload(ranked, store, n_evidence=3):
     """
-    対象のデータを辞書化して返す関数
-    
-    :return: 説明
-    :rtype: tuple[str, Any]
+    融合スコアリングの結果からフロント表示用辞書を作成する
+
+    :param ranked: {category: ranked}
+    :param store: EvidenceStore
+    :param n_evidence: 渡す根拠文の数
     """
-    
-    def pack(ranked, evidence):
-        """
-        Medgemmaに渡せるJson配列を作成する
-        
-        :param ranked: ランキング
-        :param evidence: 証拠辞書
-        """
-        out = []
-
-        for k, total, avg, max_val in ranked:
-            out.append({
-                "label":k,
+    return {
+        category : [
+            {
+                "label" : k,
                 "total_score" : total, # 合計スコア
                 "avg_score" : avg, # 平均スコア
-                "max_score": max_val, # 最大値
-                "evidence": [s for s, _ in evidence[k][:3]] # 上位3までを渡す
-            })
-        return out
-    
-    return {
-        "injunctions":pack(ranked_inj, evidence_inj),
-        "emotions":pack(ranked_emo, evidence_emo),
-        "drivers":pack(ranked_drv, evidence_drv)
+                "max_score" : max_val, # 最大値
+                "evidence" : store.top_sentences(category, k, n_evidence) # 上位3までを渡す
             }
+            for k, total, avg, max_val in ranked[category]
+        ]
+        for category in ["injunctions", "emotions", "drivers"]
+    }
 
 
-def expand_from_payload(payload, sentences, w=1):
-    """
-    ヒットした箇所の前後の文も含めて取得する
-    
-    :param payload: 対象箇所
-    :param sentences: 節ごとに分けた会話全文
-    :param w:前後何行取るか
-    """
-
-    for items_list in payload.values():
-        for items in items_list:
-        
-            # 対象箇所の前後行を取得
-            if items[0] in sentences:
-                i = sentences.index(items[0])
-                start = max(0, i - w)
-                end = min(len(sentences), i + w + 1)
-                ctx =" ". join(sentences[start : end])
-            else:
-                ctx = items[0]
-                    
-            items.append(ctx)
-    return payload
-
 def build_gemma_payload(
     text,
     payload
@@ -589,78 +627,147 @@ def build_medgemma_payload(
     return medgemma_payload
 
 
-def text_analyzer(text):
+def analyze_text(text, model=None, ref_embeddings=None, prefilter=prefilter_mode):
     """
-    text_analyzer の メイン処理
-    
+    MiniLM 層の分析（文分割・ベクトル化・判定）を行う
+
     :param text: 分析対象会話
+    :param model: encode() を持つエンコーダ（省略時は MiniLM、スタンドイン用）
+    :param ref_embeddings: 参照ベクトル（省略時は言語に合わせて取得）
+    :param prefilter: 相づち等をエンコード前に除くモード（"off" / "drop" / "merge"、prefilter.py 参照）
+    :return: 分析結果辞書
+        lang: 文書の言語
+        ref_lang: 使用した参照ベクトルの言語
+        sentences: 文リスト
+        sentence_embeddings: 文ベクトル
+        ranked: {category: ranked}
+        evidence: EvidenceStore
+        ref_embeddings: 使用した参照ベクトル
+        taxonomy_version: 参照ベクトルの taxonomy バージョン
+        window_embeddings: 複数文の窓ベクトル（token_pooled の場合のみ、それ以外は None）
+        window_rows: 窓の各位置に対応する文番号（prefilter 使用時のみ、それ以外は None）
+        prefilter: 除いた文の数・エンコード時間など（prefilter.plan_stats）
     """
-    # 念のため実行前に他月間ているメモリを削除
-    gc.collect()
-    torch.cuda.empty_cache()
-    
-    # MniLMモデル定義
-    model = SentenceTransformer(
-        mnilm_url,
-        local_files_only=True,
-        device="cpu"
-    )
+    own_model = model is None
+    if own_model:
+        import torch
+
+        # 念のため実行前に他月間ているメモリを削除
+        gc.collect()
+        torch.cuda.empty_cache()
+        
+        # MniLMモデル定義（常駐設定ならロード済みモデルを再利用）
+        model = load_minilm()
+
+    # 文書の言語判定（文分割・参照ベクトルの切り替え）
+    lang, ref_lang = resolve_languages(text)
+
     # 文の節分割処理
-    segmenter = pysbd.Segmenter(language="en", clean=False)
-    sentences = segmenter.segment(text)
+    sentences = segment_text(text, lang)
+
+    # 相づち・短い文の判定（文リストは変えず、エンコードする単位と元の文番号の対応を作る）
+    from prefilter import build_plan, scatter_embeddings, pool_embeddings, plan_stats
+    plan = build_plan(sentences, lang, prefilter)
     
     # === 文のベクトル化処理 ===
-    # 会話文エンコード
-    sentence_embeddings = model.encode(sentences)
+    # token_pooled: 会話を長いチャンクで1回エンコードし、文・複数文の窓はトークンのプーリングで作成
+    encoder = None
+    window_embeddings = None
+    window_rows = None
+    if encoding_mode == "token_pooled":
+        from token_pooling import get_token_encoder, encode_transcript
+        encoder = get_token_encoder(model)
+
+    # 会話文エンコード（除いた文は 0 ベクトル = スコア 0、まとめた文は代表の文のベクトル）
+    encode_inputs = sentences if prefilter == "off" else plan["texts"]
+    start = time.perf_counter()
+    if encoder is not None:
+        # 窓は残した単位のみで作る（除いた・まとめた文には窓のスコアを反映しない）
+        pooled = encode_transcript(encoder, text, sentences, units=plan["units"] if prefilter != "off" else None)
+        sentence_embeddings = pooled["sentence_embeddings"]
+        window_embeddings = pooled["window_embeddings"]
+        window_rows = pooled["window_rows"]
+        if prefilter != "off":
+            sentence_embeddings = pool_embeddings(plan, sentence_embeddings)
+    elif own_model:
+        from autotune import minilm_config
+        sentence_embeddings = model.encode(encode_inputs, batch_size=minilm_config()["batch_size"])
+    else:
+        sentence_embeddings = model.encode(encode_inputs)
+    encode_seconds = time.perf_counter() - start
+
+    if encoder is None and prefilter != "off":
+        sentence_embeddings = scatter_embeddings(
+            plan, sentence_embeddings, len(sentences), model.get_sentence_embedding_dimension()
+        )
+
+    # token_pooled は会話全体を1回エンコードするため、除いてもエンコード時間は変わらない
+    prefilter_stats = plan_stats(plan, encode_seconds)
+    if encoder is not None:
+        prefilter_stats["estimated_saved_seconds"] = 0.0
     
-    # ベクトル化した参照データの取得
-    ref_embeddings = get_reference_embeddings(model)
+    # ベクトル化した参照データの取得（定義ファイルが更新されていれば差分のみエンコードして差し替え）
+    if ref_embeddings is None:
+        import taxonomy
+
+        taxonomy.maybe_reload(model)
+        ref_embeddings = get_reference_embeddings(model, ref_lang)
     
-    # メモリ開放
-    model.to("cpu")
-    del model
-    gc.collect()
-    torch.cuda.empty_cache()
+    # メモリ開放（常駐設定でない場合のみ）
+    if own_model:
+        release_minilm(model)
+    del model, encoder
     
     # === 会話と定義DB内容との比較処理 ===
-    # 会話文と禁止令の処理
-    ranked_inj, evidence_inj = analyze_psychological_feature_inj(
-        sentences,
-        sentence_embeddings,
-        ref_embeddings["inj_per"]
-    )
-    # 会話文と感情の処理
-    ranked_emo, evidence_emo = analyze_psychological_feature(
+    # 禁止令・感情・ドライバーを1回の行列積でまとめて処理（窓があれば窓のスコアも各文に反映）
+    ranked, store = analyze_psychological_features_fused(
         sentences,
         sentence_embeddings,
-        ref_embeddings["emotions"], 
-        "emotions"
-    )
-    # 会話文とドライバーの処理
-    ranked_drv, evidence_drv = analyze_psychological_feature(
-        sentences,
-        sentence_embeddings,
-        ref_embeddings["drivers"], 
-        "drivers"
+        ref_embeddings,
+        window_embeddings=window_embeddings,
+        window_rows=window_rows
     )
+
+    return {
+        "lang": lang,
+        "ref_lang": ref_lang,
+        "sentences": sentences,
+        "sentence_embeddings": sentence_embeddings,
+        "ranked": ranked,
+        "evidence": store,
+        "ref_embeddings": ref_embeddings,
+        "taxonomy_version": getattr(ref_embeddings, "version", None),
+        "window_embeddings": window_embeddings,
+        "window_rows": window_rows,
+        "prefilter": prefilter_stats
+    }
+
+
+def text_analyzer(text, return_analysis=False, model=None, ref_embeddings=None):
+    """
+    text_analyzer の メイン処理
+    
+    :param text: 分析対象会話
+    :param return_analysis: True の場合、analyze_text() の結果も4番目に返す
+    :param model: analyze_text() に渡すエンコーダ（スタンドイン用）
+    :param ref_embeddings: analyze_text() に渡す参照ベクトル（スタンドイン用）
+    """
+    analysis = analyze_text(text, model, ref_embeddings)
+    store = analysis["evidence"]
+
     # 上記のデータをフロント表示用辞書へまとめる
-    payload = dct_pack(
-        ranked_inj, evidence_inj,
-        ranked_emo, evidence_emo,
-        ranked_drv, evidence_drv
-    )
+    payload = pack_payload(analysis["ranked"], store)
     
-    # 辞書にまとめた該当箇所の前後の文も含めたものを作成
-    expand_payload = {
-        "injunctions":expand_from_payload(evidence_inj, sentences),
-        "emotions":expand_from_payload(evidence_emo, sentences),
-        "drivers":expand_from_payload(evidence_drv, sentences)
-    }
+    # 該当箇所の前後の文も含めたものを作成（根拠は配列で保持し、ここで初めて辞書化）
+    expand_payload = store.expand_payload(["injunctions", "emotions", "drivers"])
     
     # === Gemma用会話を作成する処理 ===
     gemma_prompt = build_gemma_payload(
     text,
     payload
     )
+
+    if return_analysis:
+        return gemma_prompt, payload, expand_payload, analysis
     
     return gemma_prompt, payload, expand_payload
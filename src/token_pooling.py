@@ -0,0 +1,262 @@
+"""
+token_pooling
+会話全体をトークン単位で1回だけエンコードし、文・複数文の窓をプーリングで作る
+
+文ごとのエンコードでは、短い発話にまたがるシグナル（"I'm fine." "Really, it doesn't matter what I want."）を
+拾えず、窓ごとに再エンコードすると MiniLM の計算量が窓の数だけ増える。
+ここでは文の区切りに合わせた長いチャンクをトランスフォーマーに1回通してトークンベクトルを保持し、
+累積和から任意の文範囲の平均（mean pooling）を O(1) で求める。
+- 文ベクトル: 文に含まれるトークンの平均（前後の文脈を見たトークンベクトルから作成）
+- 窓ベクトル: 連続する window 文に含まれるトークンの平均（追加のフォワードなし）
+
+エンコーダは token_embeddings(chunks) / count_tokens(sentences) を持つこと
+（SentenceTransformer は TransformerTokenEncoder で包む、スタンドインは HashingEncoder が対応）。
+"""
+import numpy as np
+from settings import token_pooling_chunk_tokens, token_pooling_window
+
+
+class TransformerTokenEncoder:
+    """
+    Token-level access to a SentenceTransformer's transformer module.
+
+    Calls the underlying Hugging Face model directly (same as
+    encode(output_value="token_embeddings")) so the shared model's
+    max_seq_length is never changed and offsets come from the same
+    tokenization.
+    """
+
+    def __init__(self, model, max_tokens=token_pooling_chunk_tokens, batch_size=8):
+        self.model = model
+        self.tokenizer = model.tokenizer
+        self.transformer = model[0].auto_model
+        self.batch_size = batch_size
+
+        # 位置埋め込みの上限（XLM-R 系は padding 分の2を除く）
+        limit = getattr(self.transformer.config, "max_position_embeddings", 512) - 2
+        self.max_tokens = min(max_tokens, limit)
+
+    def encode(self, sentences, **kwargs):
+        # トークンが取れなかった文のフォールバック用（文単位のエンコード）
+        return self.model.encode(sentences, **kwargs)
+
+    def count_tokens(self, sentences):
+        ids = self.tokenizer(list(sentences), add_special_tokens=False)["input_ids"]
+        return [len(x) for x in ids]
+
+    def token_embeddings(self, chunks):
+        """
+        :return: [(トークンベクトル [T, D], 文字位置 [T, 2])]（特殊トークンは除く）
+        """
+        import torch
+
+        out = []
+        device = self.model.device
+        for b in range(0, len(chunks), self.batch_size):
+            batch = chunks[b:b + self.batch_size]
+            encoded = self.tokenizer(
+                batch,
+                padding=True,
+                truncation=True,
+                max_length=self.max_tokens + 2,
+                return_offsets_mapping=True,
+                return_special_tokens_mask=True,
+                return_tensors="pt"
+            )
+            offsets = encoded.pop("offset_mapping").numpy()
+            special = encoded.pop("special_tokens_mask").numpy().astype(bool)
+
+            with torch.no_grad():
+                hidden = self.transformer(
+                    **{k: v.to(device) for k, v in encoded.items()}
+                ).last_hidden_state.float().cpu().numpy()
+
+            keep = encoded["attention_mask"].numpy().astype(bool) & ~special
+            for i in range(len(batch)):
+                out.append((hidden[i][keep[i]], offsets[i][keep[i]]))
+        return out
+
+
+def get_token_encoder(model):
+    """
+    トークン単位で使えるエンコーダを返す（対応していない場合は None）
+    """
+    if hasattr(model, "token_embeddings"):
+        return model
+    if hasattr(model, "tokenizer") and hasattr(model, "__getitem__"):
+        from autotune import minilm_config
+        return TransformerTokenEncoder(model, batch_size=minilm_config()["batch_size"])
+    return None
+
+
+def sentence_char_spans(text, sentences):
+    """
+    各文の本文中の文字位置（見つからない文は長さ 0）
+
+    :return: [(start, end)]
+    """
+    spans = []
+    pos = 0
+    for sent in sentences:
+        start = text.find(sent, pos)
+        if start < 0:
+            spans.append((pos, pos))
+            continue
+        spans.append((start, start + len(sent)))
+        pos = start + len(sent)
+    return spans
+
+
+def build_chunks(spans, token_counts, max_tokens):
+    """
+    文の区切りでチャンクを作る（1文が複数チャンクにまたがらないようにする）
+
+    :return: [(文字開始位置, 文字終了位置)]
+    """
+    chunks = []
+    start = None
+    tokens = 0
+    end = 0
+    for (s, e), n in zip(spans, token_counts):
+        if start is not None and tokens + n > max_tokens:
+            chunks.append((start, end))
+            start, tokens = None, 0
+        if start is None:
+            start = s
+        tokens += n
+        end = e
+    if start is not None:
+        chunks.append((start, end))
+    return chunks
+
+
+def encode_transcript(encoder, text, sentences, window=token_pooling_window, max_tokens=None, units=None):
+    """
+    会話を1回エンコードし、文・窓ベクトルをプーリングで作る
+
+    :param encoder: get_token_encoder() の戻り値
+    :param sentences: 文リスト（segment_text の結果）
+    :param window: 窓の文数（1 以下の場合は窓を作らない）
+    :param max_tokens: 1チャンクのトークン数（省略時はエンコーダの上限）
+    :param units: 窓を作る単位 [(代表の文番号, [文番号])]（prefilter の plan["units"]、省略時は1文ずつ）。
+        単位に含まれない文（除いた文）のトークンは窓に入れない
+    :return: {"sentence_embeddings", "window_embeddings", "window_rows", "window", "chunks", "tokens", "fallback"}
+        （window_rows: 窓の各位置に対応する文番号、units を省略した場合は None）
+    """
+    max_tokens = max_tokens or getattr(encoder, "max_tokens", token_pooling_chunk_tokens)
+    spans = sentence_char_spans(text, sentences)
+    chunks = build_chunks(spans, encoder.count_tokens(sentences), max_tokens)
+
+    # === チャンクごとに1回だけフォワード ===
+    results = encoder.token_embeddings([text[s:e] for s, e in chunks]) if chunks else []
+    vectors = [emb for emb, _ in results if len(emb)]
+    starts = [offsets[:, 0] + s for (s, _), (emb, offsets) in zip(chunks, results) if len(emb)]
+
+    if vectors:
+        token_vectors = np.concatenate(vectors).astype(np.float32)
+        token_starts = np.concatenate(starts)
+    else:
+        token_vectors = np.zeros((0, 0), dtype=np.float32)
+        token_starts = np.zeros(0, dtype=np.int64)
+
+    # 文ごとのトークン範囲 [lo, hi)
+    lo = np.searchsorted(token_starts, [s for s, _ in spans], side="left")
+    hi = np.searchsorted(token_starts, [e for _, e in spans], side="left")
+
+    # 累積和: 範囲 [a, b) の平均 = (C[b] - C[a]) / (b - a)
+    dim = token_vectors.shape[1] if len(token_vectors) else None
+    if dim:
+        cumulative = np.zeros((len(token_vectors) + 1, dim), dtype=np.float64)
+        np.cumsum(token_vectors, axis=0, out=cumulative[1:])
+
+    def pool(a, b):
+        counts = (b - a)[:, None]
+        return ((cumulative[b] - cumulative[a]) / np.maximum(counts, 1)).astype(np.float32)
+
+    empty = np.flatnonzero(hi <= lo)
+    if dim:
+        sentence_embeddings = pool(lo, hi)
+    else:
+        sentence_embeddings = None
+
+    # トークンが取れなかった文（切り捨て・位置不明）は文単位でエンコード
+    if len(empty):
+        fallback = np.asarray(encoder.encode([sentences[i] for i in empty]), dtype=np.float32)
+        if sentence_embeddings is None:
+            sentence_embeddings = np.zeros((len(sentences), fallback.shape[1]), dtype=np.float32)
+        sentence_embeddings[empty] = fallback
+
+    if sentence_embeddings is None:
+        sentence_embeddings = np.zeros((0, 0), dtype=np.float32)
+
+    window_embeddings = None
+    window_rows = None
+    if units is not None:
+        window_rows = [host for host, _ in units]
+        if window > 1 and dim and len(units) >= window:
+            window_embeddings = pool_unit_windows(cumulative, lo, hi, units, window)
+            # トークンのない窓は先頭の単位の代表文のベクトル
+            bad = np.flatnonzero(~np.isfinite(window_embeddings).all(axis=1))
+            window_embeddings[bad] = sentence_embeddings[[window_rows[i] for i in bad]]
+    elif window > 1 and dim and len(sentences) >= window:
+        window_embeddings = pool(lo[:len(sentences) - window + 1], hi[window - 1:])
+        # トークンのない窓は先頭文のベクトル
+        bad = np.flatnonzero(hi[window - 1:] <= lo[:len(sentences) - window + 1])
+        window_embeddings[bad] = sentence_embeddings[bad]
+
+    return {
+        "sentence_embeddings": sentence_embeddings,
+        "window_embeddings": window_embeddings,
+        "window_rows": window_rows,
+        "window": window,
+        "chunks": len(chunks),
+        "tokens": int(len(token_vectors)),
+        "fallback": int(len(empty))
+    }
+
+
+def pool_unit_windows(cumulative, lo, hi, units, window):
+    """
+    連続する window 個の単位に含まれる文のトークンの平均（単位の間の除いた文は含めない）
+
+    :param cumulative: トークンベクトルの累積和 [トークン数 + 1, 次元]
+    :param lo: 文ごとのトークン開始位置
+    :param hi: 文ごとのトークン終了位置
+    :return: [単位数 − window + 1, 次元]（トークンのない窓は NaN）
+    """
+    # 文ごと → 単位ごとのトークンベクトルの和・トークン数
+    sentence_counts = np.maximum(hi - lo, 0)
+    sentence_sums = np.where((sentence_counts > 0)[:, None], cumulative[hi] - cumulative[lo], 0.0)
+    members = [np.asarray(m, dtype=np.int64) for _, m in units]
+    sums = np.stack([sentence_sums[m].sum(axis=0) for m in members])
+    counts = np.asarray([sentence_counts[m].sum() for m in members], dtype=np.float64)
+
+    # 単位方向の累積和: 窓 [k, k + window) の和 = S[k + window] − S[k]
+    unit_sums = np.zeros((len(units) + 1, sums.shape[1]), dtype=np.float64)
+    np.cumsum(sums, axis=0, out=unit_sums[1:])
+    unit_counts = np.concatenate([[0.0], np.cumsum(counts)])
+
+    n = len(units) - window + 1
+    total = unit_counts[window:window + n] - unit_counts[:n]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        pooled = (unit_sums[window:window + n] - unit_sums[:n]) / total[:, None]
+    return pooled.astype(np.float32)
+
+
+def spread_window_scores(scores, window_scores, window, rows=None):
+    """
+    窓のスコアを窓に含まれる各文に反映する（文ごとに自身と含まれる窓の最大値）
+
+    :param scores: 文のスコア [文数, ラベル数]
+    :param window_scores: 窓のスコア [窓の位置の数 − window + 1, ラベル数]
+    :param rows: 窓の各位置に対応する文番号（prefilter の代表文、省略時は全文）。
+        含まれない文（除いた文・まとめた文）には反映しない
+    :return: [文数, ラベル数]
+    """
+    out = np.array(scores, copy=True)
+    rows = np.arange(len(out)) if rows is None else np.asarray(rows, dtype=np.int64)
+    n = len(window_scores)
+    for offset in range(window):
+        idx = rows[offset:offset + n]
+        out[idx] = np.maximum(out[idx], window_scores)
+    return out
@@ -0,0 +1,445 @@
+"""
+weight_delta
+Gemma と MedGemma で重みを共有する（Gemma を1回だけ読み込み、MedGemma は差分として保持する）
+
+Gemma 3 4B IT と MedGemma 4B IT は同じ構造のため、MedGemma を「Gemma + 差分」で表す。
+差分はテンソルごとに最も小さい表現を選んで保存する（許容誤差 delta_tolerance 以内）：
+- same     差分なし
+- lowrank  nn.Linear の重みの低ランク近似 u @ v.T（推論時に forward hook で x @ v @ u.T を加算、重みは変更しない）
+- sparse   大きい差分の要素のみ（MedGemma の値を該当位置に書き込み、元の値は切り替え時に戻す）
+- full     MedGemma のテンソルそのもの（パラメータの中身を差し替える）
+
+切り替えはポインタの差し替えと少数の要素の書き込みのみのため、メモリ・時間とも小さい。
+差分の作成は weight_snapshot のスナップショット（mmap）を1テンソルずつ読むため、2モデル分のメモリは不要。
+
+Usage:
+    python weight_delta.py build
+    python weight_delta.py info
+    python weight_delta.py verify
+"""
+import argparse
+import json
+import math
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from settings import gemma_url, medgemma_url, medgemma_delta_dir, delta_tolerance, delta_max_rank
+
+DELTA_FILE = "delta.safetensors"
+MANIFEST_FILE = "delta.json"
+
+# 検証用のプロンプト
+VERIFY_PROMPTS = [
+    "I feel like I don't belong anywhere, even with my family.",
+    "Summarize the clinical risk indicators in this statement: I can't sleep and nothing matters anymore.",
+    "What does the 'Be perfect' driver mean in Transactional Analysis?"
+]
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def read_delta_manifest(delta_dir=medgemma_delta_dir):
+    try:
+        with open(os.path.join(delta_dir, MANIFEST_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def delta_available(delta_dir=medgemma_delta_dir):
+    return read_delta_manifest(delta_dir) is not None
+
+
+# =====
+# 差分の作成
+# =====
+def linear_weight_names(snapshot_dir):
+    """
+    nn.Linear の重みのパラメータ名（meta 上で構築して調べる）
+    """
+    import torch
+    from transformers import AutoConfig, AutoModelForCausalLM
+
+    config = AutoConfig.from_pretrained(snapshot_dir, local_files_only=True)
+    with torch.device("meta"):
+        model = AutoModelForCausalLM.from_config(config)
+
+    return {
+        f"{name}.weight"
+        for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear)
+    }
+
+
+def encode_tensor(target, base, is_linear, tolerance=delta_tolerance, max_rank=delta_max_rank):
+    """
+    1テンソルの差分を最も小さい表現で符号化する
+
+    :param target: MedGemma のテンソル
+    :param base: Gemma のテンソル（存在しない場合は None）
+    :param is_linear: nn.Linear の重みか（低ランク近似は forward hook で適用するため Linear のみ）
+    :return: (情報の辞書, {接尾辞: 保存するテンソル})
+    """
+    import torch
+
+    full_bytes = target.numel() * target.element_size()
+    if base is None or base.shape != target.shape:
+        return {"mode": "full", "bytes": full_bytes, "rel_error": 0.0}, {"full": target.contiguous()}
+
+    diff = target.float() - base.float()
+    energy = float(diff.pow(2).sum())
+    if energy == 0:
+        return {"mode": "same", "bytes": 0, "rel_error": 0.0}, {}
+
+    # 許容する残差の二乗和
+    budget = tolerance ** 2 * energy
+    best = ({"mode": "full", "bytes": full_bytes, "rel_error": 0.0}, {"full": target.contiguous()})
+
+    # === 低ランク近似 ===
+    if is_linear and diff.dim() == 2:
+        U, S, V = torch.svd_lowrank(diff, q=min(max_rank, min(diff.shape)), niter=4)
+        captured = torch.cumsum(S.double() ** 2, 0)
+        enough = torch.nonzero(energy - captured <= budget)
+        if len(enough):
+            rank = int(enough[0]) + 1
+            u = (U[:, :rank] * S[:rank]).to(target.dtype).contiguous()
+            v = V[:, :rank].to(target.dtype).contiguous()
+            residual = float((diff - u.float() @ v.float().T).pow(2).sum())
+            size = (u.numel() + v.numel()) * target.element_size()
+            if residual <= budget and size < best[0]["bytes"]:
+                best = (
+                    {"mode": "lowrank", "bytes": size, "rank": rank, "rel_error": math.sqrt(residual / energy)},
+                    {"u": u, "v": v}
+                )
+
+    # === 疎な差分（差分の大きい要素から、残差が許容内に収まるまで） ===
+    magnitude = diff.flatten().pow(2)
+    order = torch.argsort(magnitude, descending=True)
+    cumulative = torch.cumsum(magnitude[order].double(), 0)
+    nnz = min(int(torch.searchsorted(cumulative, energy - budget)) + 1, magnitude.numel())
+    index_dtype = torch.int32 if magnitude.numel() < 2 ** 31 else torch.int64
+    size = nnz * (torch.empty((), dtype=index_dtype).element_size() + target.element_size())
+    if size < best[0]["bytes"]:
+        index = order[:nnz].sort().values
+        residual = max(0.0, energy - float(cumulative[nnz - 1]))
+        best = (
+            {"mode": "sparse", "bytes": size, "nnz": nnz, "rel_error": math.sqrt(residual / energy)},
+            {"idx": index.to(index_dtype).contiguous(), "val": target.flatten()[index].contiguous()}
+        )
+
+    return best
+
+
+def build_delta(base_url=gemma_url, target_url=medgemma_url, out_dir=medgemma_delta_dir,
+                tolerance=delta_tolerance, max_rank=delta_max_rank):
+    """
+    Gemma（base）と MedGemma（target）の差分を作成して保存する
+
+    :return: 差分の情報
+    """
+    from safetensors.torch import save_file
+    from weight_snapshot import snapshot_path, read_manifest, convert_snapshot, mmap_safetensors, WEIGHTS_FILE
+
+    # 両モデルのスナップショット（state_dict と同じ名前で1テンソルずつ mmap 参照できる）
+    for url in (base_url, target_url):
+        if read_manifest(snapshot_path(url)) is None:
+            convert_snapshot(url)
+
+    base_manifest = read_manifest(snapshot_path(base_url))
+    target_manifest = read_manifest(snapshot_path(target_url))
+    if base_manifest["architecture"] != target_manifest["architecture"]:
+        raise ValueError(
+            f"architectures differ: {base_manifest['architecture']} vs {target_manifest['architecture']}"
+        )
+
+    base, base_mm = mmap_safetensors(os.path.join(snapshot_path(base_url), WEIGHTS_FILE))
+    target, target_mm = mmap_safetensors(os.path.join(snapshot_path(target_url), WEIGHTS_FILE))
+    linear = linear_weight_names(snapshot_path(base_url))
+
+    tensors = {}
+    info = {}
+    for name, tensor in target.items():
+        meta, parts = encode_tensor(tensor, base.get(name), name in linear, tolerance, max_rank)
+        info[name] = meta
+        tensors.update({f"{name}::{suffix}": part for suffix, part in parts.items()})
+
+    os.makedirs(out_dir, exist_ok=True)
+    save_file(tensors, os.path.join(out_dir, DELTA_FILE), metadata={"format": "pt"})
+
+    modes = {}
+    for meta in info.values():
+        modes[meta["mode"]] = modes.get(meta["mode"], 0) + 1
+
+    manifest = {
+        "base": os.path.abspath(base_url),
+        "target": os.path.abspath(target_url),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "dtype": target_manifest["dtype"],
+        "tolerance": tolerance,
+        "max_rank": max_rank,
+        "modes": modes,
+        "delta_bytes": sum(meta["bytes"] for meta in info.values()),
+        "target_bytes": target_manifest["weight_bytes"],
+        "max_rel_error": max((meta["rel_error"] for meta in info.values()), default=0.0),
+        "tensors": info
+    }
+    with open(os.path.join(out_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+    del base, target, base_mm, target_mm
+    return manifest
+
+
+# =====
+# 切り替え
+# =====
+class SharedBaseModels:
+    """
+    One resident Gemma model that can be switched to MedGemma by applying
+    the stored deltas; use() holds a lock so only one variant runs at a time.
+    """
+
+    def __init__(self, model, delta_dir=medgemma_delta_dir):
+        import torch
+        from weight_snapshot import mmap_safetensors
+
+        manifest = read_delta_manifest(delta_dir)
+        if manifest is None:
+            raise FileNotFoundError(f"no MedGemma delta in {delta_dir}; run `python weight_delta.py build`")
+
+        self.model = model
+        self.variant = "gemma"
+        self.lock = threading.Lock()
+        self.delta_bytes = manifest["delta_bytes"]
+
+        tensors, self._mm = mmap_safetensors(os.path.join(delta_dir, DELTA_FILE))
+        params = dict(model.named_parameters())
+
+        self._hooks = []
+        self._sparse = [] # (param, index, values)
+        self._full = [] # [param, 保存側のテンソル]（切り替えのたびに入れ替える）
+        self._backup = []
+
+        for name, meta in manifest["tensors"].items():
+            if meta["mode"] == "same":
+                continue
+            if name not in params:
+                raise ValueError(f"delta tensor {name!r} does not exist in the base model")
+
+            param = params[name]
+            if meta["mode"] == "lowrank":
+                module = model.get_submodule(name.rsplit(".", 1)[0])
+                u = tensors[f"{name}::u"].to(param.device)
+                v = tensors[f"{name}::v"].to(param.device)
+                self._hooks.append(module.register_forward_hook(self._lowrank_hook(u, v)))
+            elif meta["mode"] == "sparse":
+                index = tensors[f"{name}::idx"].to(device=param.device, dtype=torch.long)
+                self._sparse.append((param, index, tensors[f"{name}::val"].to(param.device)))
+            else:
+                self._full.append([param, tensors[f"{name}::full"].to(param.device)])
+
+    def _lowrank_hook(self, u, v):
+        def hook(module, inputs, output):
+            if self.variant != "medgemma":
+                return None
+            x = inputs[0]
+            return output + (x @ v.to(x.device, x.dtype)) @ u.to(x.device, x.dtype).T
+        return hook
+
+    def activate(self, variant):
+        """
+        "gemma" / "medgemma" に切り替える（lock を保持した状態で呼ぶこと）
+        """
+        import torch
+
+        if variant == self.variant:
+            return
+        if variant not in ("gemma", "medgemma"):
+            raise ValueError(f"unknown variant {variant!r}")
+
+        with torch.no_grad():
+            if variant == "medgemma":
+                self._backup = [param.data.view(-1)[index].clone() for param, index, _ in self._sparse]
+                for param, index, values in self._sparse:
+                    param.data.view(-1)[index] = values
+            else:
+                for (param, index, _), backup in zip(self._sparse, self._backup):
+                    param.data.view(-1)[index] = backup
+                self._backup = []
+
+            for slot in self._full:
+                slot[0].data, slot[1] = slot[1], slot[0].data
+
+        self.variant = variant
+
+    @contextmanager
+    def use(self, variant):
+        """
+        指定したモデルに切り替えて使う（他のスレッドの切り替えは待機）
+        """
+        with self.lock:
+            self.activate(variant)
+            yield self.model
+
+    def close(self):
+        with self.lock:
+            self.activate("gemma")
+            for hook in self._hooks:
+                hook.remove()
+            self._hooks = []
+
+
+def load_base_model(config):
+    """
+    Gemma を読み込む（スナップショットがあれば mmap、なければ from_pretrained）
+    """
+    from transformers import AutoModelForCausalLM
+    from autotune import gemma_model_kwargs
+    from weight_snapshot import find_snapshot, load_snapshot
+
+    snapshot = find_snapshot(gemma_url, config)
+    if snapshot:
+        return load_snapshot(snapshot, config["device_map"], config["max_memory"])
+
+    return AutoModelForCausalLM.from_pretrained(
+        gemma_url,
+        **gemma_model_kwargs(config),
+        low_cpu_mem_usage=True,
+        attn_implementation="sdpa",
+        local_files_only=True
+    )
+
+
+def get_shared_models(config):
+    """
+    常駐する共有モデルを取得する（初回のみ読み込み）
+
+    :param config: autotune.gemma_load_config() の結果（量子化なしであること）
+    """
+    global _shared
+
+    with _shared_lock:
+        if _shared is None:
+            if config["quantization"]:
+                raise ValueError("shared base mode needs unquantized weights")
+            _shared = SharedBaseModels(load_base_model(config))
+    return _shared
+
+
+# =====
+# 検証
+# =====
+def _run_prompts(model, tokenizer, prompts, new_tokens):
+    import torch
+
+    out = []
+    for prompt in prompts:
+        messages = [{"role": "user", "content": prompt}]
+        inputs = tokenizer.apply_chat_template(
+            messages, add_generation_prompt=True, return_tensors="pt", return_dict=True
+        ).to(model.device)
+        with torch.no_grad():
+            logits = model(**inputs).logits.float().cpu()
+            generated = model.generate(
+                **inputs, max_new_tokens=new_tokens, do_sample=False, pad_token_id=tokenizer.eos_token_id
+            )[0, inputs["input_ids"].shape[-1]:].tolist()
+        out.append((logits, generated))
+    return out
+
+
+def verify_delta(prompts=VERIFY_PROMPTS, new_tokens=32, device_map="cpu"):
+    """
+    Gemma + 差分と MedGemma 本体の出力を比較する。
+    あわせて、Gemma に戻したときに元の出力と完全に一致するか確認する。
+
+    :return: 検証結果
+    """
+    from transformers import AutoTokenizer
+    from autotune import gemma_load_config
+    from weight_snapshot import find_snapshot, load_snapshot
+
+    config = dict(gemma_load_config(), device_map=device_map, quantization=None)
+    tokenizer = AutoTokenizer.from_pretrained(medgemma_url, local_files_only=True)
+
+    # === MedGemma 本体 ===
+    snapshot = find_snapshot(medgemma_url, config)
+    if snapshot:
+        reference = load_snapshot(snapshot, config["device_map"], config["max_memory"])
+    else:
+        from transformers import AutoModelForCausalLM
+        from autotune import gemma_model_kwargs
+        reference = AutoModelForCausalLM.from_pretrained(
+            medgemma_url, **gemma_model_kwargs(config), low_cpu_mem_usage=True, local_files_only=True
+        )
+    expected = _run_prompts(reference, tokenizer, prompts, new_tokens)
+    del reference
+
+    # === Gemma + 差分 ===
+    shared = SharedBaseModels(load_base_model(config))
+    with shared.use("gemma") as model:
+        base_before = _run_prompts(model, tokenizer, prompts[:1], 1)
+    with shared.use("medgemma") as model:
+        actual = _run_prompts(model, tokenizer, prompts, new_tokens)
+    with shared.use("gemma") as model:
+        base_after = _run_prompts(model, tokenizer, prompts[:1], 1)
+
+    results = []
+    for prompt, (exp_logits, exp_tokens), (act_logits, act_tokens) in zip(prompts, expected, actual):
+        results.append({
+            "prompt": prompt,
+            "max_abs_logit_diff": float((exp_logits - act_logits).abs().max()),
+            "top1_agreement": float((exp_logits.argmax(-1) == act_logits.argmax(-1)).float().mean()),
+            "generated_equal": exp_tokens == act_tokens,
+            "generated_prefix_match": next(
+                (i for i, (a, b) in enumerate(zip(exp_tokens, act_tokens)) if a != b),
+                min(len(exp_tokens), len(act_tokens))
+            )
+        })
+
+    manifest = read_delta_manifest()
+    return {
+        "prompts": results,
+        "restore_exact": bool((base_before[0][0] == base_after[0][0]).all()),
+        "delta_bytes": manifest["delta_bytes"],
+        "target_bytes": manifest["target_bytes"],
+        "delta_ratio": manifest["delta_bytes"] / manifest["target_bytes"]
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MILD-7 shared Gemma base with MedGemma deltas")
+    parser.add_argument("--dir", default=medgemma_delta_dir)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    build = sub.add_parser("build", help="compute the MedGemma delta against Gemma")
+    build.add_argument("--tolerance", type=float, default=delta_tolerance)
+    build.add_argument("--max-rank", type=int, default=delta_max_rank)
+
+    sub.add_parser("info", help="delta size and per-mode tensor counts")
+
+    verify = sub.add_parser("verify", help="compare Gemma + delta with the full MedGemma")
+    verify.add_argument("--new-tokens", type=int, default=32)
+    verify.add_argument("--device-map", default="cpu")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        manifest = build_delta(out_dir=args.dir, tolerance=args.tolerance, max_rank=args.max_rank)
+        print(json.dumps({k: v for k, v in manifest.items() if k != "tensors"}, indent=2))
+
+    elif args.command == "info":
+        manifest = read_delta_manifest(args.dir)
+        if manifest is None:
+            parser.error(f"no delta in {args.dir}")
+        summary = {k: v for k, v in manifest.items() if k != "tensors"}
+        summary["delta_ratio"] = manifest["delta_bytes"] / manifest["target_bytes"]
+        print(json.dumps(summary, indent=2))
+
+    elif args.command == "verify":
+        print(json.dumps(verify_delta(new_tokens=args.new_tokens, device_map=args.device_map), indent=2))
+
+
+if __name__ == "__main__":
+    main()
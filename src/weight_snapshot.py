@@ -0,0 +1,430 @@
+"""
+weight_snapshot
+Gemma / MedGemma の重みを配信時の dtype・配置のまま保存したスナップショットと、その高速ローダー
+
+from_pretrained は起動のたびに config の解析・モジュールの初期化・重みのコピーを行う。
+スナップショットは以下の手順で読み込むため、コールドスタートがほぼ mmap とモジュール構築のみになる。
+1. meta デバイス上でモジュールを構築（重みの確保・初期化をしない）
+2. safetensors ファイルを mmap し、各テンソルをコピーせずにそのまま参照（torch.frombuffer）
+3. load_state_dict(assign=True) でモジュールに結び付ける
+
+スナップショットの内容（weight_snapshot_dir/{モデル名}/）：
+- weights.safetensors  重み（配信時の dtype、共有された重みは1回のみ保存）
+- buffers.safetensors  state_dict に含まれない buffer（rotary の inv_freq など）
+- snapshot.json        dtype・共有重み・変換元などの情報
+- config.json / tokenizer 等  変換元からコピー
+
+量子化（int8 / int4）は bitsandbytes が読み込み時に変換するため対象外（from_pretrained を使用）。
+
+Usage:
+    python weight_snapshot.py convert --model gemma
+    python weight_snapshot.py bench --model gemma --repeat 3
+    python weight_snapshot.py verify --model gemma
+"""
+import argparse
+import json
+import mmap
+import os
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from settings import gemma_url, medgemma_url, weight_snapshot_dir
+
+WEIGHTS_FILE = "weights.safetensors"
+BUFFERS_FILE = "buffers.safetensors"
+MANIFEST_FILE = "snapshot.json"
+
+# 変換元からコピーしない（重み）ファイル
+WEIGHT_SUFFIXES = (".safetensors", ".bin", ".pt", ".pth", ".gguf")
+WEIGHT_INDEX_SUFFIX = ".index.json"
+
+MODELS = {"gemma": gemma_url, "medgemma": medgemma_url}
+
+# safetensors の dtype 名 → torch の dtype 名
+SAFETENSORS_DTYPES = {
+    "BF16": "bfloat16",
+    "F16": "float16",
+    "F32": "float32",
+    "F64": "float64",
+    "I64": "int64",
+    "I32": "int32",
+    "I16": "int16",
+    "I8": "int8",
+    "U8": "uint8",
+    "BOOL": "bool"
+}
+
+
+def resolve_model(name):
+    """
+    "gemma" / "medgemma" またはモデルのパス
+    """
+    return MODELS.get(name, name)
+
+
+def snapshot_path(url):
+    """
+    モデルのパスに対応するスナップショットのディレクトリ
+    """
+    name = os.path.basename(os.path.normpath(url)) or "model"
+    return os.path.join(weight_snapshot_dir, name)
+
+
+def read_manifest(path):
+    """
+    :return: snapshot.json の内容（スナップショットがなければ None）
+    """
+    try:
+        with open(os.path.join(path, MANIFEST_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def find_snapshot(url, config):
+    """
+    読み込み設定（autotune.gemma_load_config()）で使えるスナップショットを探す
+    （変換元のモデルが url と異なる場合は使わない）
+
+    :return: スナップショットのパス or None
+    """
+    if config["quantization"]:
+        return None
+
+    path = snapshot_path(url)
+    manifest = read_manifest(path)
+    if manifest is None or manifest["dtype"] != config["dtype"]:
+        return None
+    if manifest.get("source") != os.path.abspath(url):
+        return None
+    return path
+
+
+# =====
+# mmap
+# =====
+def mmap_safetensors(path):
+    """
+    safetensors ファイルを mmap し、コピーせずにテンソルを作成する
+
+    ACCESS_COPY（書き込み時コピー）で開くため、ページは参照時に読み込まれ、ファイルは変更されない。
+
+    :return: ({名前: テンソル}, mmap オブジェクト) ※テンソルを使う間は mmap を保持すること
+    """
+    import torch
+
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    header_len = struct.unpack("<Q", mm[:8])[0]
+    header = json.loads(mm[8:8 + header_len])
+    header.pop("__metadata__", None)
+    data_start = 8 + header_len
+
+    tensors = {}
+    for name, info in header.items():
+        dtype = getattr(torch, SAFETENSORS_DTYPES[info["dtype"]])
+        begin, end = info["data_offsets"]
+        count = (end - begin) // torch.empty((), dtype=dtype).element_size()
+        if count == 0:
+            tensors[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        tensors[name] = torch.frombuffer(mm, dtype=dtype, count=count, offset=data_start + begin).view(info["shape"])
+
+    return tensors, mm
+
+
+# =====
+# 変換
+# =====
+def convert_snapshot(url, dtype="bfloat16"):
+    """
+    from_pretrained で読み込んだモデルをスナップショットとして保存する
+    (保存先は snapshot_path(url)。find_snapshot・weight_delta はこの場所のみ参照する)
+
+    :param url: 変換元のモデルのパス
+    :param dtype: 配信時の dtype
+    :return: スナップショットの情報
+    """
+    import torch
+    import transformers
+    from transformers import AutoModelForCausalLM
+    from safetensors.torch import save_file
+
+    out_dir = snapshot_path(url)
+    tmp_dir = f"{out_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    model = AutoModelForCausalLM.from_pretrained(
+        url,
+        device_map="cpu",
+        torch_dtype=getattr(torch, dtype),
+        low_cpu_mem_usage=True,
+        local_files_only=True
+    )
+    state = model.state_dict()
+
+    # 共有された重み（入出力の埋め込みなど）は1回だけ保存し、別名を記録する
+    tensors, aliases, seen = {}, {}, {}
+    for name, tensor in state.items():
+        key = (tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tuple(tensor.shape), tensor.stride())
+        if key in seen:
+            aliases[name] = seen[key]
+            continue
+        seen[key] = name
+        tensors[name] = tensor.contiguous()
+
+    save_file(tensors, os.path.join(tmp_dir, WEIGHTS_FILE), metadata={"format": "pt"})
+
+    # state_dict に含まれない buffer（meta 上に構築すると値が失われるため保存）
+    buffers = {
+        name: buf.contiguous()
+        for name, buf in model.named_buffers()
+        if name not in state
+    }
+    if buffers:
+        save_file(buffers, os.path.join(tmp_dir, BUFFERS_FILE), metadata={"format": "pt"})
+
+    # config・tokenizer・generation_config などをコピー
+    for name in os.listdir(url):
+        src = os.path.join(url, name)
+        if os.path.isfile(src) and not name.endswith(WEIGHT_SUFFIXES + (WEIGHT_INDEX_SUFFIX,)):
+            shutil.copy2(src, os.path.join(tmp_dir, name))
+    model.config.save_pretrained(tmp_dir)
+
+    manifest = {
+        "source": os.path.abspath(url),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "architecture": type(model).__name__,
+        "dtype": dtype,
+        "tensors": len(tensors),
+        "aliases": aliases,
+        "buffers": sorted(buffers),
+        "weight_bytes": sum(t.numel() * t.element_size() for t in tensors.values()),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__
+    }
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+    del model, state, tensors, buffers
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    return manifest
+
+
+# =====
+# 読み込み
+# =====
+def load_snapshot(path, device_map="cpu", max_memory=None):
+    """
+    スナップショットからモデルを読み込む（meta 上で構築し、mmap したテンソルを結び付ける）
+
+    :param path: スナップショットのディレクトリ
+    :param device_map: "cpu" / "auto"（max_memory に従って GPU と CPU に配置）/ デバイス名
+    :param max_memory: device_map="auto" の場合の配置上限
+    :return: 推論用モデル
+    """
+    import torch
+    from transformers import AutoConfig, AutoModelForCausalLM
+
+    manifest = read_manifest(path)
+    if manifest is None:
+        raise FileNotFoundError(f"no weight snapshot in {path}")
+
+    dtype = getattr(torch, manifest["dtype"])
+    config = AutoConfig.from_pretrained(path, local_files_only=True)
+
+    # === 構築（重みの確保・初期化なし） ===
+    with torch.device("meta"):
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=dtype, attn_implementation="sdpa")
+
+    # === 重みの結び付け（コピーなし） ===
+    state, weights_mm = mmap_safetensors(os.path.join(path, WEIGHTS_FILE))
+    for name, target in manifest["aliases"].items():
+        state[name] = state[target]
+    model.load_state_dict(state, strict=False, assign=True)
+
+    mms = [weights_mm]
+    if manifest["buffers"]:
+        buffers, buffers_mm = mmap_safetensors(os.path.join(path, BUFFERS_FILE))
+        mms.append(buffers_mm)
+        for name, tensor in buffers.items():
+            module_name, _, leaf = name.rpartition(".")
+            model.get_submodule(module_name).register_buffer(leaf, tensor, persistent=False)
+
+    model.tie_weights()
+
+    missing = [
+        name
+        for name, tensor in list(model.named_parameters()) + list(model.named_buffers())
+        if tensor.is_meta
+    ]
+    if missing:
+        raise RuntimeError(f"snapshot {path} does not cover {len(missing)} tensors, e.g. {missing[:5]}")
+
+    # mmap はテンソルが参照している間、開いたままにする
+    model._weight_snapshot_mmaps = mms
+    model.eval()
+
+    # === 配置 ===
+    if device_map == "auto":
+        from accelerate import dispatch_model, infer_auto_device_map
+
+        placement = infer_auto_device_map(
+            model,
+            max_memory=max_memory,
+            no_split_module_classes=getattr(model, "_no_split_modules", None) or []
+        )
+        model = dispatch_model(model, device_map=placement)
+    elif device_map != "cpu":
+        model = model.to(device_map)
+
+    return model
+
+
+# =====
+# 計測
+# =====
+def time_load(method, url):
+    """
+    このプロセスで1回読み込み、時間とメモリを計測する
+
+    :param method: "pretrained" / "snapshot"
+    :return: {"method", "load_seconds", "rss_gb"}
+    """
+    import psutil
+    import torch
+
+    # from_pretrained もスナップショットと同じ dtype で読み込む
+    dtype = (read_manifest(snapshot_path(url)) or {}).get("dtype", "bfloat16")
+
+    start = time.perf_counter()
+    if method == "snapshot":
+        model = load_snapshot(snapshot_path(url))
+    else:
+        from transformers import AutoModelForCausalLM
+        model = AutoModelForCausalLM.from_pretrained(
+            url,
+            device_map="cpu",
+            torch_dtype=getattr(torch, dtype),
+            low_cpu_mem_usage=True,
+            local_files_only=True
+        )
+    load_seconds = time.perf_counter() - start
+
+    result = {
+        "method": method,
+        "load_seconds": load_seconds,
+        "rss_gb": psutil.Process().memory_info().rss / 2**30
+    }
+    del model
+    return result
+
+
+def benchmark_cold_start(url, repeat=3):
+    """
+    from_pretrained とスナップショットの読み込み時間を、毎回新しいプロセスで比較する
+    （ページキャッシュは共有されるため、1回目以外はファイルがキャッシュ済みの状態）
+
+    :return: 計測結果
+    """
+    results = {}
+    for method in ["pretrained", "snapshot"]:
+        runs = []
+        for _ in range(repeat):
+            proc = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "_time", "--method", method, "--model", url],
+                cwd=os.getcwd(), capture_output=True, text=True
+            )
+            if proc.returncode != 0:
+                raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr else "load failed")
+            runs.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+        results[method] = {
+            "load_seconds": [r["load_seconds"] for r in runs],
+            "median_seconds": statistics.median(r["load_seconds"] for r in runs),
+            "rss_gb": max(r["rss_gb"] for r in runs)
+        }
+
+    results["speedup"] = results["pretrained"]["median_seconds"] / results["snapshot"]["median_seconds"]
+    return results
+
+
+def verify_snapshot(url, prompt="I feel like I don't belong anywhere."):
+    """
+    スナップショットと from_pretrained の出力（logits）が一致するか確認する
+
+    :return: {"max_abs_diff", "argmax_agreement"}
+    """
+    import torch
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+
+    tokenizer = AutoTokenizer.from_pretrained(url, local_files_only=True)
+    inputs = tokenizer(prompt, return_tensors="pt")
+
+    reference = AutoModelForCausalLM.from_pretrained(
+        url,
+        device_map="cpu",
+        torch_dtype=getattr(torch, read_manifest(snapshot_path(url))["dtype"]),
+        low_cpu_mem_usage=True,
+        local_files_only=True
+    )
+    with torch.no_grad():
+        expected = reference(**inputs).logits.float()
+    del reference
+
+    model = load_snapshot(snapshot_path(url))
+    with torch.no_grad():
+        actual = model(**inputs).logits.float()
+
+    return {
+        "max_abs_diff": float((expected - actual).abs().max()),
+        "argmax_agreement": float((expected.argmax(-1) == actual.argmax(-1)).float().mean())
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MILD-7 memory-mapped weight snapshots")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    convert = sub.add_parser("convert", help="write a snapshot in the serving dtype")
+    convert.add_argument("--model", required=True, help="gemma / medgemma / model path")
+    convert.add_argument("--dtype", default="bfloat16", choices=["bfloat16", "float16", "float32"])
+
+    bench = sub.add_parser("bench", help="cold-start time vs from_pretrained (fresh process per load)")
+    bench.add_argument("--model", required=True)
+    bench.add_argument("--repeat", type=int, default=3)
+
+    verify = sub.add_parser("verify", help="compare logits with from_pretrained")
+    verify.add_argument("--model", required=True)
+
+    # bench から子プロセスとして呼ばれる
+    timing = sub.add_parser("_time")
+    timing.add_argument("--method", choices=["pretrained", "snapshot"], required=True)
+    timing.add_argument("--model", required=True)
+
+    args = parser.parse_args(argv)
+    url = resolve_model(args.model)
+
+    if args.command == "convert":
+        manifest = convert_snapshot(url, args.dtype)
+        print(json.dumps({k: v for k, v in manifest.items() if k != "buffers"}, indent=2))
+
+    elif args.command == "bench":
+        print(json.dumps(benchmark_cold_start(url, args.repeat), indent=2))
+
+    elif args.command == "verify":
+        print(json.dumps(verify_snapshot(url), indent=2))
+
+    elif args.command == "_time":
+        print(json.dumps(time_load(args.method, url)))
+
+
+if __name__ == "__main__":
+    main()